@@ -1,40 +1,250 @@
 # backend/ai_agent.py
-import openai
-from typing import List, Dict, Any, Optional
+import time
+import asyncio
+import inspect
+from typing import List, Dict, Any, Optional, AsyncIterator, Awaitable, Callable
 import logging
 from shared.config import config
+from shared.utils import retry_async
+from .concurrency import ConcurrencyLimiter, hedged
+from .context import ContextBuilder, get_token_counter
+from .providers import LLMProvider, Completion, create_provider
+from .response_cache import ResponseCache, CacheLookup
+from .routing import ModelTier, create_model_router
+from .telemetry import LLM_TIME_TO_FIRST_TOKEN, LLM_TOKENS, LLM_REQUESTS, stage, record_stage
 
 logger = logging.getLogger(__name__)
 
+ERROR_RESPONSE = "❌ Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз."
+
+# Системный промпт без отступов исходного кода: неизменная часть каждого запроса
+SYSTEM_PROMPT = inspect.cleandoc("""Ты опытный AI-ассистент программист, специализирующийся на помощи разработчикам.
+    Твои возможности:
+    - Объяснение концепций программирования простым языком
+    - Помощь с отладкой и оптимизацией кода
+    - Рекомендации по архитектуре и best practices
+    - Ответы на технические вопросы
+    - Помощь с выбором технологий и инструментов
+
+    Правила общения:
+    - Отвечай четко и по существу
+    - Приводи примеры кода когда это помогает
+    - Объясняй сложные концепции пошагово
+    - Если не уверен в ответе, честно об этом скажи
+    - Используй эмодзи умеренно для улучшения читаемости
+    - Отвечай на том же языке, на котором задан вопрос
+    Помни контекст предыдущих сообщений в разговоре.""")
+
 
 class AIAgent:
     """AI Agent для обработки сообщений пользователей"""
 
-    def __init__(self):
-        self.client = openai.AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+    def __init__(self, summary_store=None, provider: Optional[LLMProvider] = None):
+        self.provider = provider or create_provider()
         self.model = config.OPENAI_MODEL
+        self.router = create_model_router()
+        self.limiter = ConcurrencyLimiter(
+            global_limit=config.LLM_MAX_CONCURRENCY,
+            per_user_limit=config.LLM_MAX_CONCURRENCY_PER_USER,
+            queue_timeout=config.LLM_QUEUE_TIMEOUT
+        )
+        LLM_REQUESTS.set_function(lambda: self.limiter.in_flight, state="in_flight")
+        LLM_REQUESTS.set_function(lambda: self.limiter.waiting, state="waiting")
+        # Состояние провайдера для /ready: подряд идущие ошибки запросов к модели
+        self.consecutive_failures = 0
+        self.last_error: Optional[str] = None
+        self.usage_totals = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        # Получатель расхода токенов по пользователям (дневные бюджеты)
+        self.on_usage: Optional[Callable[[int, Dict[str, int]], Awaitable[None]]] = None
+        # База знаний (KNOWLEDGE_BASE): подключается при запуске backend
+        self.knowledge = None
         self.system_prompt = self._get_system_prompt()
+        self.context_builder = ContextBuilder(
+            count_tokens=get_token_counter(self.model),
+            budget=config.CONTEXT_TOKEN_BUDGET,
+            summary_store=summary_store,
+            summarize=self._summarize if config.CONTEXT_SUMMARIZATION else None,
+            trim_target=config.CONTEXT_TRIM_TARGET,
+            max_users=config.CONTEXT_SEGMENT_CACHE_USERS,
+            history_turns=config.CONTEXT_HISTORY_TURNS
+        )
+        self.response_cache = ResponseCache(
+            ttl=config.RESPONSE_CACHE_TTL,
+            max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+            embed=self._embed if config.RESPONSE_CACHE_SEMANTIC else None,
+            similarity_threshold=config.RESPONSE_CACHE_SIMILARITY
+        ) if config.RESPONSE_CACHE else None
 
     def _get_system_prompt(self) -> str:
         """Системный промпт для AI ассистента"""
-        return """Ты опытный AI-ассистент программист, специализирующийся на помощи разработчикам.
-            Твои возможности:
-            - Объяснение концепций программирования простым языком
-            - Помощь с отладкой и оптимизацией кода
-            - Рекомендации по архитектуре и best practices
-            - Ответы на технические вопросы
-            - Помощь с выбором технологий и инструментов
-            
-            Правила общения:
-            - Отвечай четко и по существу
-            - Приводи примеры кода когда это помогает
-            - Объясняй сложные концепции пошагово
-            - Если не уверен в ответе, честно об этом скажи
-            - Используй эмодзи умеренно для улучшения читаемости
-            - Отвечай на том же языке, на котором задан вопрос
-            Помни контекст предыдущих сообщений в разговоре."""
+        return SYSTEM_PROMPT
+
+    async def _build_messages(
+            self,
+            message: str,
+            user_id: int,
+            conversation_history: List[Dict[str, Any]] = None
+    ) -> List[Dict[str, str]]:
+        """Формирование контекста разговора в пределах бюджета токенов"""
+        knowledge = await self._retrieve(message)
+        built = await self.context_builder.build(
+            self.system_prompt, message, user_id, conversation_history, knowledge
+        )
+        return built.messages
+
+    async def _retrieve(self, message: str) -> Optional[str]:
+        """Фрагменты документации к вопросу; ошибка поиска не мешает ответу"""
+        if self.knowledge is None:
+            return None
+        try:
+            with stage("retrieval"):
+                return await self.knowledge.context(message)
+        except Exception as e:
+            logger.error("Knowledge retrieval failed: %s", e)
+            return None
+
+    async def _complete(self, user_id: int, messages: List[Dict[str, str]],
+                        tier: Optional[ModelTier] = None, **params) -> Completion:
+        """Запрос к модели уровня tier (по умолчанию основного): слот лимитера, таймаут, хеджирование и повторы"""
+        tier = tier or self.router.default
+
+        async def attempt() -> Completion:
+            return await asyncio.wait_for(
+                self.provider.complete(tier.model, messages, **params),
+                tier.timeout
+            )
+
+        @retry_async(
+            max_retries=config.LLM_RETRIES + 1,
+            delay=config.LLM_RETRY_DELAY,
+            exceptions=self.provider.retryable_errors
+        )
+        async def call() -> Completion:
+            return await hedged(attempt, config.LLM_HEDGE_DELAY, self.limiter)
+
+        async with self.limiter.slot(user_id):
+            started = time.perf_counter()
+            try:
+                completion = await call()
+            except Exception as e:
+                self.router.observe(tier, time.perf_counter() - started, ok=False)
+                self._record_failure(e)
+                raise
+            self.router.observe(tier, time.perf_counter() - started, ok=True, usage=completion.usage)
+        self.consecutive_failures = 0
+        await self._record_usage(user_id, completion.usage)
+        return completion
+
+    async def _record_usage(self, user_id: int, usage: Dict[str, int]):
+        """Учет токенов по usage модели, включая прочитанные из кеша промптов"""
+        for token_type in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+            if token_type in usage:
+                LLM_TOKENS.inc(usage[token_type], type=token_type.split("_")[0])
+                self.usage_totals[token_type] += usage[token_type]
+        if self.on_usage is not None and usage:
+            await self.on_usage(user_id, usage)
+
+    def usage_stats(self) -> Dict[str, Any]:
+        prompt = self.usage_totals["prompt_tokens"]
+        return {
+            **self.usage_totals,
+            "cached_tokens_ratio": round(self.usage_totals["cached_tokens"] / prompt, 3) if prompt else 0.0
+        }
+
+    async def _stream(self, user_id: int, messages: List[Dict[str, str]],
+                      tier: Optional[ModelTier] = None, **params) -> AsyncIterator[str]:
+        """Потоковый запрос к модели в слоте лимитера с таймаутом на каждый фрагмент"""
+        tier = tier or self.router.default
+        async with self.limiter.slot(user_id):
+            usage: Dict[str, int] = {}
+            started = time.perf_counter()
+            stream = self.provider.stream(tier.model, messages, usage=usage, **params)
+            try:
+                while True:
+                    try:
+                        delta = await asyncio.wait_for(stream.__anext__(), tier.timeout)
+                    except StopAsyncIteration:
+                        break
+                    except Exception as e:
+                        self.router.observe(tier, time.perf_counter() - started, ok=False)
+                        self._record_failure(e)
+                        raise
+                    yield delta
+                self.router.observe(tier, time.perf_counter() - started, ok=True, usage=usage)
+                self.consecutive_failures = 0
+                await self._record_usage(user_id, usage)
+            finally:
+                await stream.aclose()
+
+    def _record_failure(self, error: Exception):
+        self.consecutive_failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"
 
+    def health(self) -> Dict[str, Any]:
+        """Состояние провайдера модели для проверки готовности"""
+        return {
+            "provider": self.provider.name,
+            "healthy": (config.LLM_UNHEALTHY_AFTER_FAILURES <= 0
+                        or self.consecutive_failures < config.LLM_UNHEALTHY_AFTER_FAILURES),
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "in_flight": self.limiter.in_flight
+        }
 
+    async def aclose(self, timeout: float):
+        """Остановка: дождаться фоновых запросов к модели и закрыть клиента"""
+        await self.context_builder.drain(timeout)
+        await self.provider.close()
+        if self.knowledge is not None:
+            self.knowledge.close()
+
+    async def _summarize(self, user_id: int, previous_summary: str, turns: List[Dict[str, Any]]) -> str:
+        """Дополнение сводки разговора новыми ходами"""
+        dialogue = "\n\n".join(
+            f"Пользователь: {item['user_message']}\nАссистент: {item['ai_response']}"
+            for item in turns
+        )
+        completion = await self._complete(
+            user_id,
+            [
+                {
+                    "role": "system",
+                    "content": "Обнови краткое содержание разговора с учетом новых сообщений. "
+                               "Сохрани важные факты, решения и фрагменты кода, пиши сжато, "
+                               "на языке разговора."
+                },
+                {
+                    "role": "user",
+                    "content": f"Текущее содержание:\n{previous_summary or '(пусто)'}\n\n"
+                               f"Новые сообщения:\n{dialogue}"
+                }
+            ],
+            max_tokens=config.SUMMARY_MAX_TOKENS,
+            temperature=0.3
+        )
+        return completion.text
+
+    async def _embed(self, text: str) -> List[float]:
+        """Эмбеддинг вопроса для семантического кеша"""
+        return await self.provider.embed(config.RESPONSE_CACHE_EMBEDDING_MODEL, text)
+
+    async def _lookup_cached(
+            self,
+            message: str,
+            tier: ModelTier,
+            conversation_history: List[Dict[str, Any]] = None
+    ) -> Optional[CacheLookup]:
+        """Поиск в кеше ответов модели уровня tier; кеш применяется только к вопросам без длинной истории"""
+        if self.response_cache is None:
+            return None
+        if len(conversation_history or []) > config.RESPONSE_CACHE_MAX_HISTORY:
+            return None
+        # Ответ быстрого уровня или fallback не выдается за ответ основной модели
+        return await self.response_cache.lookup(message, tier.model, self.system_prompt)
+
+    async def _store_cached(self, lookup: Optional[CacheLookup], response: str, started: float):
+        if lookup is not None and response and response != ERROR_RESPONSE:
+            await self.response_cache.store(lookup, response, time.perf_counter() - started)
 
     async def process_message(
             self,
@@ -44,34 +254,86 @@ class AIAgent:
     ) -> str:
         """Обработка сообщения пользователя"""
         try:
-            # Формируем контекст разговора
-            messages = [{"role": "system", "content": self.system_prompt}]
-
-            # Добавляем историю разговора (последние 10 сообщений)
-            if conversation_history:
-                for item in conversation_history[-10:]:
-                    messages.append({"role": "user", "content": item["user_message"]})
-                    messages.append({"role": "assistant", "content": item["ai_response"]})
-
-            # Добавляем текущее сообщение
-            messages.append({"role": "user", "content": message})
-
-            # Отправляем запрос к OpenAI
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=2000,
-                temperature=0.7,
-                top_p=0.9,
-                frequency_penalty=0.1,
-                presence_penalty=0.1
-            )
+            started = time.perf_counter()
+            # Уровень модели по признакам запроса и SLO уровней
+            tier, reason = self.router.choose(message, len(conversation_history or []))
+            lookup = await self._lookup_cached(message, tier, conversation_history)
+            if lookup is not None and lookup.response is not None:
+                logger.info("AI response served from cache for user %s", user_id)
+                return lookup.response
+
+            with stage("prompt_build"):
+                messages = await self._build_messages(message, user_id, conversation_history)
+            self.router.record(tier, reason)
+
+            # Отправляем запрос к модели
+            with stage("llm"):
+                completion = await self._complete(
+                    user_id,
+                    messages,
+                    tier,
+                    max_tokens=tier.max_tokens,
+                    temperature=0.7,
+                    top_p=0.9,
+                    frequency_penalty=0.1,
+                    presence_penalty=0.1
+                )
 
-            ai_response = response.choices[0].message.content.strip()
-            logger.info(f"AI response generated for user {user_id}")
+            ai_response = completion.text
+            logger.info("AI response generated for user %s by %s tier", user_id, tier.name)
 
+            await self._store_cached(lookup, ai_response, started)
             return ai_response
 
         except Exception as e:
-            logger.error(f"Error in AI processing: {e}")
-            return "❌ Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз."
\ No newline at end of file
+            logger.error("Error in AI processing: %s", e)
+            return ERROR_RESPONSE
+
+    async def stream_message(
+            self,
+            message: str,
+            user_id: int,
+            conversation_history: List[Dict[str, Any]] = None
+    ) -> AsyncIterator[str]:
+        """Потоковая обработка сообщения: отдает фрагменты ответа по мере генерации"""
+        received = False
+        try:
+            started = time.perf_counter()
+            tier, reason = self.router.choose(message, len(conversation_history or []))
+            lookup = await self._lookup_cached(message, tier, conversation_history)
+            if lookup is not None and lookup.response is not None:
+                logger.info("AI response served from cache for user %s", user_id)
+                yield lookup.response
+                return
+
+            with stage("prompt_build"):
+                messages = await self._build_messages(message, user_id, conversation_history)
+            self.router.record(tier, reason)
+            parts = []
+            llm_started = time.perf_counter()
+            async for delta in self._stream(
+                    user_id,
+                    messages,
+                    tier,
+                    max_tokens=tier.max_tokens,
+                    temperature=0.7,
+                    top_p=0.9,
+                    frequency_penalty=0.1,
+                    presence_penalty=0.1
+            ):
+                if not received:
+                    LLM_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - llm_started)
+                received = True
+                parts.append(delta)
+                yield delta
+
+            record_stage("llm", time.perf_counter() - llm_started)
+            logger.info("AI response streamed for user %s by %s tier", user_id, tier.name)
+            await self._store_cached(lookup, "".join(parts).strip(), started)
+
+        except Exception as e:
+            logger.error("Error in AI streaming: %s", e)
+            # Если часть ответа уже отправлена, обрыв обрабатывает вызывающий код
+            if received:
+                raise
+            yield ERROR_RESPONSE
@@ -1,12 +1,25 @@
 import os
-from typing import Optional
-from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
+import json
+import logging
+from typing import List, Literal, Optional, AsyncIterator
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, HttpUrl, field_validator
 
 from backend.ai_agent import AIAgent
-from backend.database import DatabaseManager
-from backend.utils import get_db_manager, get_ai_agent
-from shared.config import logger
+from backend.chat import run_chat_turn, stream_chat_turn
+from backend.concurrency import UserSerializer
+from backend.database import DatabaseManager, select_fields
+from backend.jobs import JobManager, JobQueueFullError, callback_allowed
+from backend.quotas import QuotaManager
+from backend.telemetry import CHAT_REQUESTS
+from backend.utils import (
+    get_db_manager, get_ai_agent, get_user_serializer, get_job_manager, get_quota_manager, require_admin
+)
+from shared.config import config
+from shared.utils import user_id_var
+
+logger = logging.getLogger(__name__)
 
 
 router_v1 = APIRouter(prefix='/api/v1', tags=['ToDo'])
@@ -22,32 +35,119 @@ class ChatResponse(BaseModel):
     conversation_id: Optional[str] = None
 
 
+class JobRequest(ChatRequest):
+    priority: Literal["high", "normal", "low"] = "normal"
+    callback_url: Optional[HttpUrl] = None
+
+    @field_validator("callback_url")
+    @classmethod
+    def check_callback_url(cls, value: Optional[HttpUrl]) -> Optional[HttpUrl]:
+        if value is not None and not callback_allowed(str(value)):
+            raise ValueError("callback_url host is not in JOB_CALLBACK_ALLOWED_HOSTS")
+        return value
+
+
 @router_v1.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest,
                ai_agent: AIAgent = Depends(get_ai_agent),
-               db_manager: DatabaseManager = Depends(get_db_manager)):
+               db_manager: DatabaseManager = Depends(get_db_manager),
+               serializer: UserSerializer = Depends(get_user_serializer),
+               quotas: QuotaManager = Depends(get_quota_manager)):
     """Основной endpoint для обработки сообщений"""
+    user_id_var.set(request.user_id)
+    # Превышение лимита - быстрый 429 до истории, модели и БД
+    await quotas.check(request.user_id)
     try:
-        logger.info(f"Chat request from user {request.user_id}: {request.message[:100]}...")
-        conversation_history = await db_manager.get_conversation_history(request.user_id)
-        ai_response = await ai_agent.process_message(
-            message=request.message,
-            user_id=request.user_id,
-            conversation_history=conversation_history
+        logger.info("Chat request from user %s: %.100s", request.user_id, request.message)
+        ai_response = await run_chat_turn(
+            ai_agent, db_manager, serializer, request.user_id, request.message, request.username
         )
+        CHAT_REQUESTS.inc(endpoint="chat", status="ok")
+        return ChatResponse(response=ai_response)
+
+    except Exception as e:
+        CHAT_REQUESTS.inc(endpoint="chat", status="error")
+        logger.error("Error processing chat request: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 
-        await db_manager.save_message(
+@router_v1.post("/jobs", status_code=202)
+async def submit_job(request: JobRequest,
+                     job_manager: JobManager = Depends(get_job_manager),
+                     quotas: QuotaManager = Depends(get_quota_manager)):
+    """Фоновая обработка сообщения: id задачи возвращается сразу, ответ - через GET /jobs/{id} или callback"""
+    user_id_var.set(request.user_id)
+    await quotas.check(request.user_id)
+    try:
+        job = await job_manager.submit(
             user_id=request.user_id,
-            user_message=request.message,
-            ai_response=ai_response,
-            username=request.username
+            message=request.message,
+            username=request.username,
+            priority=request.priority,
+            callback_url=str(request.callback_url) if request.callback_url else None
         )
+    except JobQueueFullError as e:
+        CHAT_REQUESTS.inc(endpoint="jobs", status="rejected")
+        logger.warning(str(e))
+        return JSONResponse({"detail": "Job queue is full"}, status_code=503, headers={"Retry-After": "5"})
 
-        return ChatResponse(response=ai_response)
+    CHAT_REQUESTS.inc(endpoint="jobs", status="ok")
+    logger.info("Chat job %s from user %s: %.100s", job.id, request.user_id, request.message)
+    return job.public()
 
-    except Exception as e:
-        logger.error(f"Error processing chat request: {e}")
-        raise HTTPException(status_code=500, detail="Internal server error")
+
+@router_v1.get("/jobs/{job_id}")
+async def get_job(job_id: str,
+                  wait: float = Query(0.0, ge=0.0, le=config.JOB_LONG_POLL_MAX),
+                  job_manager: JobManager = Depends(get_job_manager)):
+    """Состояние задачи; wait > 0 - ждать завершения до wait секунд (long polling)"""
+    job = await job_manager.get(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.public()
+
+
+def _sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Форматирование события Server-Sent Events"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+
+@router_v1.post("/chat/stream")
+async def chat_stream(request: ChatRequest,
+                      ai_agent: AIAgent = Depends(get_ai_agent),
+                      db_manager: DatabaseManager = Depends(get_db_manager),
+                      serializer: UserSerializer = Depends(get_user_serializer),
+                      quotas: QuotaManager = Depends(get_quota_manager)):
+    """Потоковая обработка сообщения (SSE): фрагменты ответа отправляются по мере генерации"""
+    user_id_var.set(request.user_id)
+    await quotas.check(request.user_id)
+    logger.info("Chat stream request from user %s: %.100s", request.user_id, request.message)
+
+    async def event_generator() -> AsyncIterator[str]:
+        parts = []
+        try:
+            async for delta in stream_chat_turn(
+                    ai_agent, db_manager, serializer, request.user_id, request.message, request.username
+            ):
+                parts.append(delta)
+                yield _sse_event({"delta": delta})
+        except Exception as e:
+            CHAT_REQUESTS.inc(endpoint="chat_stream", status="error")
+            logger.error("Error streaming chat response: %s", e)
+            yield _sse_event({"detail": "Internal server error"}, event="error")
+            return
+
+        CHAT_REQUESTS.inc(endpoint="chat_stream", status="ok")
+        yield _sse_event({"response": "".join(parts).strip()}, event="done")
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @router_v1.delete("/conversations/{user_id}")
@@ -55,30 +155,131 @@ async def clear_conversation(user_id: int, db_manager: DatabaseManager = Depends
     """Очистка истории разговора пользователя"""
     try:
         await db_manager.clear_conversation(user_id)
-        logger.info(f"Cleared conversation for user {user_id}")
+        logger.info("Cleared conversation for user %s", user_id)
         return {"message": "Conversation cleared successfully"}
     except Exception as e:
-        logger.error(f"Error clearing conversation: {e}")
+        logger.error("Error clearing conversation: %s", e)
         raise HTTPException(status_code=500, detail="Failed to clear conversation")
 
 
+def _parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    return [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+
+
 @router_v1.get("/conversations/{user_id}/history")
-async def get_conversation_history(user_id: int, limit: int = 50, db_manager: DatabaseManager = Depends(get_db_manager)):
-    """Получение истории разговора"""
+async def get_conversation_history(user_id: int,
+                                   limit: int = Query(50, ge=1, le=config.HISTORY_PAGE_MAX),
+                                   cursor: Optional[str] = None,
+                                   fields: Optional[str] = None,
+                                   db_manager: DatabaseManager = Depends(get_db_manager)):
+    """Страница истории разговора; next_cursor - для более ранних сообщений"""
     try:
-        history = await db_manager.get_conversation_history(user_id, limit)
-        return {"history": history}
+        return await db_manager.get_history_page(user_id, limit, cursor, _parse_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Error getting conversation history: {e}")
+        logger.error("Error getting conversation history: %s", e)
         raise HTTPException(status_code=500, detail="Failed to get conversation history")
 
 
+@router_v1.get("/conversations/{user_id}/search")
+async def search_conversation(user_id: int,
+                              q: str = Query(..., min_length=1, max_length=config.SEARCH_QUERY_MAX_LENGTH),
+                              limit: int = Query(10, ge=1, le=config.SEARCH_PAGE_MAX),
+                              cursor: Optional[str] = None,
+                              db_manager: DatabaseManager = Depends(get_db_manager)):
+    """Поиск по истории разговора: результаты по релевантности со сниппетами"""
+    try:
+        return await db_manager.search_conversations(user_id, q, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("Error searching conversation for user %s: %s", user_id, e)
+        raise HTTPException(status_code=500, detail="Failed to search conversation")
+
+
+@router_v1.get("/conversations/{user_id}/export")
+async def export_conversation(user_id: int,
+                              fields: Optional[str] = None,
+                              db_manager: DatabaseManager = Depends(get_db_manager)):
+    """Вся история разговора потоком NDJSON, по строке на сообщение"""
+    try:
+        selected = select_fields(_parse_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def ndjson() -> AsyncIterator[str]:
+        lines = []
+        try:
+            async for item in db_manager.iter_conversation(user_id, selected):
+                lines.append(json.dumps(item, ensure_ascii=False) + "\n")
+                if len(lines) >= 100:
+                    yield "".join(lines)
+                    lines = []
+        except Exception as e:
+            # Заголовки уже отправлены: обрываем поток, клиент увидит неполный ответ
+            logger.error("Error exporting conversation for user %s: %s", user_id, e)
+            raise
+        if lines:
+            yield "".join(lines)
+
+    return StreamingResponse(
+        ndjson(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="conversation_{user_id}.ndjson"'}
+    )
+
+
 @router_v1.get("/stats")
-async def get_stats(db_manager: DatabaseManager = Depends(get_db_manager)):
+async def get_stats(ai_agent: AIAgent = Depends(get_ai_agent),
+                    db_manager: DatabaseManager = Depends(get_db_manager),
+                    serializer: UserSerializer = Depends(get_user_serializer),
+                    job_manager: JobManager = Depends(get_job_manager),
+                    quotas: QuotaManager = Depends(get_quota_manager)):
     """Статистика использования"""
     try:
         stats = await db_manager.get_usage_stats()
+        stats["context"] = ai_agent.context_builder.stats()
+        stats["llm"] = {
+            "provider": ai_agent.provider.name,
+            **ai_agent.limiter.stats(),
+            "usage": ai_agent.usage_stats(),
+            "routing": ai_agent.router.stats()
+        }
+        stats["user_serializer"] = serializer.stats()
+        stats["jobs"] = job_manager.stats()
+        stats["quotas"] = quotas.stats()
+        if ai_agent.response_cache:
+            stats["response_cache"] = ai_agent.response_cache.stats()
+        if ai_agent.knowledge:
+            stats["knowledge"] = ai_agent.knowledge.stats()
         return stats
     except Exception as e:
-        logger.error(f"Error getting stats: {e}")
+        logger.error("Error getting stats: %s", e)
         raise HTTPException(status_code=500, detail="Failed to get stats")
+
+
+@router_v1.get("/stats/series")
+async def get_stats_series(hours: int = Query(24, ge=1, le=24 * 31),
+                           days: int = Query(30, ge=1, le=366),
+                           db_manager: DatabaseManager = Depends(get_db_manager)):
+    """Сообщения по часам и активные пользователи по дням"""
+    try:
+        return await db_manager.get_usage_series(hours, days)
+    except Exception as e:
+        logger.error("Error getting stats series: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to get stats series")
+
+
+@router_v1.get("/admin/quotas/{user_id}", dependencies=[Depends(require_admin)])
+async def get_quota(user_id: int, quotas: QuotaManager = Depends(get_quota_manager)):
+    """Лимиты пользователя: запросы в текущем окне и токены за сутки (UTC)"""
+    return await quotas.status(user_id)
+
+
+@router_v1.delete("/admin/quotas/{user_id}", dependencies=[Depends(require_admin)])
+async def reset_quota(user_id: int, quotas: QuotaManager = Depends(get_quota_manager)):
+    """Сброс лимитов пользователя"""
+    await quotas.reset(user_id)
+    logger.info("Reset quotas for user %s", user_id)
+    return await quotas.status(user_id)
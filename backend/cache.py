@@ -0,0 +1,238 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+from shared.config import config
+
+logger = logging.getLogger(__name__)
+
+# Запись списка, только если версия истории не изменилась с начала чтения из БД
+SET_IF_VERSION_SCRIPT = """
+if (redis.call("get", KEYS[2]) or "") ~= ARGV[1] then
+    return 0
+end
+redis.call("del", KEYS[1])
+redis.call("rpush", KEYS[1], unpack(ARGV, 3))
+redis.call("expire", KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class HistoryCache:
+    """Write-through кеш последних сообщений пользователя перед БД.
+
+    append и invalidate меняют версию истории пользователя. Чтение из БД берет
+    версию до запроса и передает ее в set: если история за это время изменилась
+    (в том числе в другом воркере), устаревший список в кеш не попадает.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def get(self, user_id: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Последние limit сообщений или None, если пользователя нет в кеше"""
+        raise NotImplementedError
+
+    async def version(self, user_id: int) -> Optional[str]:
+        """Версия истории перед чтением из БД; None - кеш заполнять нельзя"""
+        raise NotImplementedError
+
+    async def set(self, user_id: int, items: List[Dict[str, Any]], version: Optional[str]):
+        """Заполнение кеша после чтения из БД, если версия истории не изменилась"""
+        raise NotImplementedError
+
+    async def append(self, user_id: int, item: Dict[str, Any]):
+        """Добавление нового сообщения, только если пользователь уже в кеше; версия меняется всегда"""
+        raise NotImplementedError
+
+    async def invalidate(self, user_id: int):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def _count(self, items: Optional[list]) -> Optional[list]:
+        if items is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return items
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+
+class MemoryHistoryCache(HistoryCache):
+    """In-process LRU кеш с TTL (fallback без Redis)"""
+
+    backend = "memory"
+
+    def __init__(self, size: int, ttl: float, max_users: int):
+        super().__init__(size, ttl)
+        self.max_users = max_users
+        self._data: "OrderedDict[int, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._versions: Dict[int, int] = {}
+
+    def _entry(self, user_id: int) -> Optional[List[Dict[str, Any]]]:
+        entry = self._data.get(user_id)
+        if entry is None:
+            return None
+        expires_at, items = entry
+        if expires_at < time.monotonic():
+            del self._data[user_id]
+            return None
+        self._data.move_to_end(user_id)
+        return items
+
+    async def get(self, user_id: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        items = self._entry(user_id)
+        return self._count(None if items is None else items[-limit:])
+
+    def _bump(self, user_id: int):
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    async def version(self, user_id: int) -> Optional[str]:
+        return str(self._versions.get(user_id, 0))
+
+    async def set(self, user_id: int, items: List[Dict[str, Any]], version: Optional[str]):
+        if version is None or version != await self.version(user_id):
+            return
+        self._data[user_id] = (time.monotonic() + self.ttl, list(items[-self.size:]))
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_users:
+            self._data.popitem(last=False)
+
+    async def append(self, user_id: int, item: Dict[str, Any]):
+        self._bump(user_id)
+        items = self._entry(user_id)
+        if items is None:
+            return
+        items.append(item)
+        del items[:-self.size]
+        self._data[user_id] = (time.monotonic() + self.ttl, items)
+
+    async def invalidate(self, user_id: int):
+        self._bump(user_id)
+        self._data.pop(user_id, None)
+
+
+class RedisHistoryCache(HistoryCache):
+    """Кеш на ограниченных списках Redis, общий для всех реплик backend; версия истории - счетчик INCR"""
+
+    backend = "redis"
+
+    def __init__(self, redis, size: int, ttl: float):
+        super().__init__(size, ttl)
+        self.redis = redis
+        self._set_if_version = redis.register_script(SET_IF_VERSION_SCRIPT)
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"history:{user_id}"
+
+    @staticmethod
+    def _version_key(user_id: int) -> str:
+        return f"history:{user_id}:version"
+
+    def _failed(self, operation: str, error: Exception):
+        # Ошибка Redis не должна ломать запрос: история читается из БД
+        self.errors += 1
+        logger.warning(f"History cache {operation} failed: {error}")
+
+    async def get(self, user_id: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        try:
+            raw = await self.redis.lrange(self._key(user_id), -limit, -1)
+        except Exception as e:
+            self._failed("get", e)
+            raw = None
+        # Пустой список в Redis не хранится, поэтому [] означает промах
+        return self._count([json.loads(item) for item in raw] if raw else None)
+
+    async def version(self, user_id: int) -> Optional[str]:
+        try:
+            value = await self.redis.get(self._version_key(user_id))
+        except Exception as e:
+            self._failed("version", e)
+            return None
+        return value.decode() if value else ""
+
+    async def set(self, user_id: int, items: List[Dict[str, Any]], version: Optional[str]):
+        if not items or version is None:
+            return
+        try:
+            await self._set_if_version(
+                keys=[self._key(user_id), self._version_key(user_id)],
+                args=[version, int(self.ttl), *[json.dumps(item, ensure_ascii=False) for item in items[-self.size:]]]
+            )
+        except Exception as e:
+            self._failed("set", e)
+
+    async def append(self, user_id: int, item: Dict[str, Any]):
+        key = self._key(user_id)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                self._bump(pipe, user_id)
+                # RPUSHX не создает неполный список для пользователя, которого нет в кеше
+                pipe.rpushx(key, json.dumps(item, ensure_ascii=False))
+                pipe.ltrim(key, -self.size, -1)
+                pipe.expire(key, int(self.ttl))
+                await pipe.execute()
+        except Exception as e:
+            self._failed("append", e)
+            # Список без нового сообщения устарел: пусть следующий запрос прочитает БД
+            await self.invalidate(user_id)
+
+    async def invalidate(self, user_id: int):
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                self._bump(pipe, user_id)
+                pipe.delete(self._key(user_id))
+                await pipe.execute()
+        except Exception as e:
+            self._failed("invalidate", e)
+
+    def _bump(self, pipe, user_id: int):
+        # Версия живет дольше списка: чтение, начатое до истечения TTL, не застанет ее сброшенной
+        pipe.incr(self._version_key(user_id))
+        pipe.expire(self._version_key(user_id), int(self.ttl) * 2)
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+async def create_history_cache() -> Optional[HistoryCache]:
+    """Создание кеша истории по HISTORY_CACHE_BACKEND (redis, memory или none)"""
+    backend = config.HISTORY_CACHE_BACKEND.lower()
+    if backend == "none":
+        return None
+
+    if backend == "redis":
+        try:
+            import redis.asyncio as aioredis
+
+            redis = aioredis.from_url(config.REDIS_URL, socket_connect_timeout=2)
+            await redis.ping()
+            logger.info("History cache: redis")
+            return RedisHistoryCache(redis, config.HISTORY_CACHE_SIZE, config.HISTORY_CACHE_TTL)
+        except Exception as e:
+            if config.BACKEND_WORKERS > 1:
+                # Кеш в памяти воркера не видит сообщений, сохраненных другими воркерами
+                logger.warning(f"Redis is unavailable for history cache, caching is disabled: {e}")
+                return None
+            logger.warning(f"Redis is unavailable for history cache, using in-process cache: {e}")
+
+    logger.info("History cache: memory")
+    return MemoryHistoryCache(config.HISTORY_CACHE_SIZE, config.HISTORY_CACHE_TTL, config.HISTORY_CACHE_MAX_USERS)
@@ -0,0 +1,109 @@
+import asyncio
+from typing import AsyncIterator, Optional, Set
+
+from .ai_agent import AIAgent
+from .concurrency import UserSerializer
+from .database import DatabaseManager
+from .telemetry import stage
+from shared.config import config
+
+
+async def run_chat_turn(
+        ai_agent: AIAgent,
+        db_manager: DatabaseManager,
+        serializer: UserSerializer,
+        user_id: int,
+        message: str,
+        username: Optional[str] = None
+) -> str:
+    """Ход разговора: история, ответ модели, сохранение. Общий для /chat и фоновых задач"""
+    async def handle() -> str:
+        # Запросы пользователя обрабатываются по очереди, чтобы каждый видел предыдущий ответ
+        async with serializer.lock(user_id):
+            with stage("history_fetch"):
+                conversation_history = await db_manager.get_conversation_history(
+                    user_id, config.CONTEXT_HISTORY_TURNS
+                )
+            ai_response = await ai_agent.process_message(
+                message=message,
+                user_id=user_id,
+                conversation_history=conversation_history
+            )
+
+            with stage("db_save"):
+                await db_manager.save_message(
+                    user_id=user_id,
+                    user_message=message,
+                    ai_response=ai_response,
+                    username=username
+                )
+            return ai_response
+
+    # Повторная отправка того же сообщения присоединяется к уже выполняющемуся запросу
+    return await serializer.run_once((user_id, message), handle)
+
+
+# Потоковые ходы, которые дорабатываются без клиента; дожидаются при остановке
+_stream_turns: Set[asyncio.Task] = set()
+_DONE = object()
+
+
+async def stream_chat_turn(
+        ai_agent: AIAgent,
+        db_manager: DatabaseManager,
+        serializer: UserSerializer,
+        user_id: int,
+        message: str,
+        username: Optional[str] = None
+) -> AsyncIterator[str]:
+    """Потоковый ход разговора: фрагменты ответа по мере генерации.
+
+    Генерация и сохранение идут в отдельной задаче: если клиент отключился,
+    ответ все равно дописывается и попадает в историю.
+    """
+    deltas: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async with serializer.lock(user_id):
+                with stage("history_fetch"):
+                    conversation_history = await db_manager.get_conversation_history(
+                        user_id, config.CONTEXT_HISTORY_TURNS
+                    )
+                parts = []
+                async for delta in ai_agent.stream_message(
+                        message=message,
+                        user_id=user_id,
+                        conversation_history=conversation_history
+                ):
+                    parts.append(delta)
+                    deltas.put_nowait(delta)
+
+                # Сохраняем полный ответ только после завершения потока
+                with stage("db_save"):
+                    await db_manager.save_message(
+                        user_id=user_id,
+                        user_message=message,
+                        ai_response="".join(parts).strip(),
+                        username=username
+                    )
+            deltas.put_nowait(_DONE)
+        except Exception as e:
+            deltas.put_nowait(e)
+
+    task = asyncio.create_task(produce())
+    _stream_turns.add(task)
+    task.add_done_callback(_stream_turns.discard)
+    while True:
+        item = await deltas.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+async def drain_stream_turns(timeout: float):
+    """Ожидание потоковых ходов, чьи клиенты отключились, при остановке"""
+    if _stream_turns:
+        await asyncio.wait(set(_stream_turns), timeout=timeout)
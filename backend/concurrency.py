@@ -0,0 +1,345 @@
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncIterator, Optional, Callable, Awaitable, TypeVar, Hashable
+
+from shared.config import config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Снятие и продление блокировки, только если она все еще наша
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+REFRESH_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Результат и снятие блокировки одним шагом: ожидающий видит либо блокировку, либо результат
+FINISH_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    redis.call("set", KEYS[2], ARGV[2], "PX", ARGV[3])
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class LLMOverloadedError(Exception):
+    """Слот для запроса к модели не освободился за отведенное время"""
+
+
+class ConcurrencyLimiter:
+    """Глобальное и пользовательское ограничение одновременных запросов к модели.
+
+    Сначала занимается слот пользователя, затем глобальный: в общей FIFO-очереди
+    каждый пользователь держит не больше per_user_limit ожидающих, поэтому
+    всплеск одного пользователя не вытесняет остальных.
+    """
+
+    def __init__(self, global_limit: int, per_user_limit: int, queue_timeout: float):
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self.queue_timeout = queue_timeout
+        self._global = asyncio.Semaphore(global_limit)
+        self._users: Dict[int, asyncio.Semaphore] = {}
+        self._user_refs: Dict[int, int] = {}
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.hedges = 0
+        self.hedges_skipped = 0
+
+    def _user_semaphore(self, user_id: int) -> asyncio.Semaphore:
+        if user_id not in self._users:
+            self._users[user_id] = asyncio.Semaphore(self.per_user_limit)
+            self._user_refs[user_id] = 0
+        self._user_refs[user_id] += 1
+        return self._users[user_id]
+
+    def _release_user(self, user_id: int):
+        self._user_refs[user_id] -= 1
+        if not self._user_refs[user_id]:
+            del self._users[user_id]
+            del self._user_refs[user_id]
+
+    @asynccontextmanager
+    async def slot(self, user_id: int) -> AsyncIterator[None]:
+        user_semaphore = self._user_semaphore(user_id)
+        self.waiting += 1
+        acquired_user = acquired_global = False
+        try:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.queue_timeout
+            try:
+                await asyncio.wait_for(user_semaphore.acquire(), self.queue_timeout)
+                acquired_user = True
+                await asyncio.wait_for(self._global.acquire(), max(0.0, deadline - loop.time()))
+                acquired_global = True
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise LLMOverloadedError(f"No LLM slot for user {user_id} within {self.queue_timeout}s")
+            finally:
+                self.waiting -= 1
+
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+        finally:
+            if acquired_global:
+                self._global.release()
+            if acquired_user:
+                user_semaphore.release()
+            self._release_user(user_id)
+
+    async def try_acquire(self) -> bool:
+        """Свободный глобальный слот без ожидания (для хеджированного запроса); освобождается release"""
+        if self._global.locked():
+            self.hedges_skipped += 1
+            return False
+        await self._global.acquire()
+        self.hedges += 1
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._global.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "global_limit": self.global_limit,
+            "per_user_limit": self.per_user_limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "hedges": self.hedges,
+            "hedges_skipped": self.hedges_skipped
+        }
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: float,
+                 limiter: Optional[ConcurrencyLimiter] = None) -> T:
+    """Запуск дублирующего запроса, если первый не ответил за delay секунд.
+
+    Возвращается первый успешный результат, оставшийся запрос отменяется.
+    С limiter дубликат занимает собственный глобальный слот и не запускается,
+    если свободного нет: хеджирование не превышает общий лимит запросов к модели.
+    """
+    if delay <= 0:
+        return await call()
+
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done and (limiter is None or await limiter.try_acquire()):
+            hedge = asyncio.ensure_future(call())
+            if limiter is not None:
+                # Слот освобождается и при отмене задачи, которая еще не начала выполняться
+                hedge.add_done_callback(lambda _: limiter.release())
+            tasks.append(hedge)
+
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+class SharedUserLocks:
+    """Блокировки пользователей и объединение дубликатов в Redis: общие для всех воркеров.
+
+    Блокировка - ключ с TTL, который продлевается, пока запрос выполняется; если
+    воркер упал, ее снимает TTL. Результат запроса, к которому присоединяются
+    дубликаты из других воркеров, хранится result_ttl секунд. Без Redis
+    запросы упорядочены только внутри воркера.
+    """
+
+    def __init__(self, client, ttl: float, result_ttl: float = 10.0, poll_interval: float = 0.05):
+        self.client = client
+        self.ttl_ms = int(ttl * 1000)
+        self.result_ttl_ms = int(result_ttl * 1000)
+        self.poll_interval = poll_interval
+        self._unlock = client.register_script(UNLOCK_SCRIPT)
+        self._refresh = client.register_script(REFRESH_SCRIPT)
+        self._finish = client.register_script(FINISH_SCRIPT)
+
+    async def _keep_alive(self, key: str, token: str):
+        while True:
+            await asyncio.sleep(self.ttl_ms / 3000)
+            try:
+                await self._refresh(keys=[key], args=[token, self.ttl_ms])
+            except Exception as e:
+                logger.warning(f"Failed to refresh lock {key}: {e}")
+
+    async def _release(self, key: str, token: str, result: Optional[str] = None, result_key: str = ""):
+        try:
+            if result is None:
+                await self._unlock(keys=[key], args=[token])
+            else:
+                await self._finish(keys=[key, result_key], args=[token, result, self.result_ttl_ms])
+        except Exception as e:
+            logger.warning(f"Failed to release lock {key}, it expires by TTL: {e}")
+
+    @asynccontextmanager
+    async def lock(self, user_id: int) -> AsyncIterator[None]:
+        key = f"user:{user_id}:lock"
+        token = uuid.uuid4().hex
+        try:
+            while not await self.client.set(key, token, nx=True, px=self.ttl_ms):
+                await asyncio.sleep(self.poll_interval)
+        except Exception as e:
+            logger.warning(f"Shared user lock is unavailable: {e}")
+            yield
+            return
+
+        heartbeat = asyncio.create_task(self._keep_alive(key, token))
+        try:
+            yield
+        finally:
+            heartbeat.cancel()
+            await asyncio.shield(self._release(key, token))
+
+    async def run_once(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        """factory в одном воркере, остальные ждут его результат; результат должен сериализоваться в JSON"""
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        running_key, result_key = f"once:{digest}", f"once:{digest}:result"
+        token = uuid.uuid4().hex
+        try:
+            while not await self.client.set(running_key, token, nx=True, px=self.ttl_ms):
+                # Запрос выполняет другой воркер: ждем результат или снятия блокировки (ошибка, падение)
+                while await self.client.exists(running_key):
+                    await asyncio.sleep(self.poll_interval)
+                raw = await self.client.get(result_key)
+                if raw is not None:
+                    return json.loads(raw)
+        except Exception as e:
+            logger.warning(f"Shared request dedup is unavailable: {e}")
+            return await factory()
+
+        heartbeat = asyncio.create_task(self._keep_alive(running_key, token))
+        result = None
+        try:
+            value = await factory()
+            result = json.dumps(value)
+            return value
+        finally:
+            heartbeat.cancel()
+            await asyncio.shield(self._release(running_key, token, result, result_key))
+
+
+class UserSerializer:
+    """Последовательная обработка запросов одного пользователя и объединение дубликатов.
+
+    Внутри процесса порядок держат asyncio.Lock; с shared (SharedUserLocks)
+    запросы одного пользователя упорядочены и между воркерами.
+    """
+
+    def __init__(self, shared: Optional[SharedUserLocks] = None):
+        self.shared = shared
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._refs: Dict[int, int] = {}
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+        self.serialized = 0
+        self.joined = 0
+
+    @asynccontextmanager
+    async def lock(self, user_id: int) -> AsyncIterator[None]:
+        """Запросы пользователя выполняются по очереди в порядке поступления"""
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._refs[user_id] = self._refs.get(user_id, 0) + 1
+        if lock.locked():
+            self.serialized += 1
+        try:
+            async with lock:
+                if self.shared is None:
+                    yield
+                else:
+                    async with self.shared.lock(user_id):
+                        yield
+        finally:
+            self._refs[user_id] -= 1
+            if not self._refs[user_id]:
+                del self._refs[user_id]
+                del self._locks[user_id]
+
+    async def run_once(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        """Одинаковый запрос, который уже выполняется, не запускается повторно, а ждет результат"""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.joined += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            if self.shared is None:
+                result = await factory()
+            else:
+                result = await self.shared.run_once(key, factory)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # Помечаем исключение как полученное, даже если дубликатов не было
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def close(self):
+        if self.shared is not None:
+            await self.shared.client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "shared": self.shared is not None,
+            "active_users": len(self._locks),
+            "in_flight": len(self._in_flight),
+            "serialized": self.serialized,
+            "joined": self.joined
+        }
+
+
+async def create_user_serializer() -> UserSerializer:
+    """Сериализатор запросов по USER_LOCK_STORE (redis или memory)"""
+    if config.USER_LOCK_STORE.lower() == "redis":
+        try:
+            import redis.asyncio as aioredis
+
+            redis = aioredis.from_url(config.REDIS_URL, socket_connect_timeout=2)
+            await redis.ping()
+            logger.info("User locks: redis")
+            return UserSerializer(SharedUserLocks(redis, config.USER_LOCK_TTL))
+        except Exception as e:
+            logger.warning(f"Redis is unavailable for user locks, using in-process locks: {e}")
+
+    logger.info("User locks: memory")
+    return UserSerializer()
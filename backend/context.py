@@ -0,0 +1,355 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены на каждое сообщение в формате chat completions
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Ходов старше выборки истории за одно обновление сводки
+GAP_TURNS_PER_SUMMARY = 50
+
+TokenCounter = Callable[[str], int]
+Summarizer = Callable[[int, str, List[Dict[str, Any]]], Awaitable[str]]
+
+
+def approximate_token_counter(text: str) -> int:
+    """Грубая оценка: ~4 символа на токен"""
+    return len(text) // 4 + 1
+
+
+def get_token_counter(model: str) -> TokenCounter:
+    """Счетчик токенов tiktoken для модели, либо приблизительный без него.
+
+    Кодировка загружается при первом подсчете: tiktoken может скачивать ее по сети.
+    """
+    counter: Optional[TokenCounter] = None
+
+    def load() -> TokenCounter:
+        try:
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode(text))
+        except Exception as e:
+            logger.warning(f"tiktoken is unavailable, using approximate token counter: {e}")
+            return approximate_token_counter
+
+    def count(text: str) -> int:
+        nonlocal counter
+        if counter is None:
+            counter = load()
+        return counter(text)
+
+    return count
+
+
+@dataclass
+class BuiltContext:
+    messages: List[Dict[str, str]]
+    prompt_tokens: int
+    # Сколько токенов заняли бы все доступные ходы истории без бюджета
+    unbudgeted_tokens: int
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    """Неизменяемое начало промпта, одинаковое для всех запросов с этим системным промптом.
+
+    Словари сообщений общие для всех запросов, изменять их нельзя.
+    """
+    messages: Tuple[Dict[str, str], ...]
+    tokens: int
+
+
+@dataclass(frozen=True)
+class Segment:
+    """Готовые сообщения хода истории и их размер в токенах"""
+    messages: Tuple[Dict[str, str], ...]
+    tokens: int
+
+
+@dataclass
+class UserSegments:
+    """Закодированные ходы пользователя между запросами и начало окна истории"""
+    turns: Dict[Tuple[str, str], Segment] = field(default_factory=dict)
+    summary: Optional[Segment] = None
+    summary_text: Optional[str] = None
+    window_start: Optional[Tuple[str, str]] = None
+
+
+def _turn_key(item: Dict[str, Any]) -> Tuple[str, str]:
+    return str(item.get("created_at")), item["user_message"]
+
+
+def _turn_time(item: Dict[str, Any]) -> datetime:
+    """Время хода: в истории created_at - строка ISO 8601, сравнивать ее как строку нельзя"""
+    created_at = item["created_at"]
+    return datetime.fromisoformat(created_at) if isinstance(created_at, str) else created_at
+
+
+class ContextBuilder:
+    """Заполнение бюджета токенов последними ходами и сворачивание старых в сводку.
+
+    Промпт собирается так, чтобы его начало менялось как можно реже: системный
+    промпт, сводка, ходы истории от закрепленного начала окна, новое сообщение.
+    Когда история перестает помещаться в бюджет, окно сдвигается сразу на блок
+    ходов (до trim_target от бюджета), а не на один ход за запрос, и следующие
+    запросы продолжают тот же префикс - его переиспользует кеш промптов провайдера.
+
+    Из БД читаются последние history_turns ходов. Если окно начинается с самого
+    старого из них, оно тоже сдвигается блоком: иначе ход выпал бы из выборки, не
+    попав в сводку. Ходы старше выборки, которых нет в сводке (сводка не
+    обновилась, давняя история), дочитываются из summary_store.
+    """
+
+    def __init__(
+            self,
+            count_tokens: TokenCounter,
+            budget: int,
+            summary_store=None,
+            summarize: Optional[Summarizer] = None,
+            trim_target: float = 1.0,
+            max_users: int = 10000,
+            history_turns: int = 20
+    ):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.summary_store = summary_store
+        self.summarize = summarize
+        self.trim_target = trim_target
+        self.max_users = max_users
+        self.history_turns = history_turns
+        self._prefixes: Dict[str, PromptPrefix] = {}
+        self._users: "OrderedDict[int, UserSegments]" = OrderedDict()
+        self.encoded_turns = 0
+        self.reused_turns = 0
+
+        self.requests = 0
+        self.prompt_tokens_total = 0
+        self.unbudgeted_tokens_total = 0
+        self._pending: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _message_tokens(self, content: str) -> int:
+        return self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def prefix(self, system_prompt: str) -> PromptPrefix:
+        """Префикс промпта: кодируется один раз на системный промпт"""
+        prefix = self._prefixes.get(system_prompt)
+        if prefix is None:
+            prefix = PromptPrefix(
+                messages=({"role": "system", "content": system_prompt},),
+                tokens=self._message_tokens(system_prompt)
+            )
+            self._prefixes[system_prompt] = prefix
+        return prefix
+
+    def _user_segments(self, user_id: int) -> UserSegments:
+        segments = self._users.get(user_id)
+        if segments is None:
+            segments = UserSegments()
+            self._users[user_id] = segments
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return segments
+
+    def _summary_segment(self, segments: UserSegments, summary: Optional[Dict[str, Any]]) -> Optional[Segment]:
+        text = summary["summary"] if summary else None
+        if not text:
+            return None
+        if segments.summary_text != text:
+            content = f"Краткое содержание предыдущей части разговора:\n{text}"
+            segments.summary = Segment(
+                messages=({"role": "system", "content": content},),
+                tokens=self._message_tokens(content)
+            )
+            segments.summary_text = text
+        return segments.summary
+
+    def _turn_segments(self, segments: UserSegments, history: List[Dict[str, Any]]) -> List[Segment]:
+        """Ходы истории: закодированные на прошлых запросах берутся из кеша, кодируются только новые"""
+        turns: Dict[Tuple[str, str], Segment] = {}
+        result = []
+        for item in history:
+            key = _turn_key(item)
+            segment = segments.turns.get(key)
+            if segment is None or segment.messages[1]["content"] != item["ai_response"]:
+                segment = Segment(
+                    messages=(
+                        {"role": "user", "content": item["user_message"]},
+                        {"role": "assistant", "content": item["ai_response"]}
+                    ),
+                    tokens=self._message_tokens(item["user_message"]) + self._message_tokens(item["ai_response"])
+                )
+                self.encoded_turns += 1
+            else:
+                self.reused_turns += 1
+            turns[key] = segment
+            result.append(segment)
+        # В кеше остаются только ходы текущей истории
+        segments.turns = turns
+        return result
+
+    def _fill(self, turn_tokens: List[int], available: float) -> int:
+        """Начало окна: самые свежие ходы, пока помещаются в available токенов"""
+        used = 0
+        start = len(turn_tokens)
+        while start > 0 and used + turn_tokens[start - 1] <= available:
+            start -= 1
+            used += turn_tokens[start]
+        return start
+
+    def _window_start(self, segments: UserSegments, history: List[Dict[str, Any]],
+                      turn_tokens: List[int], available: int) -> int:
+        """Закрепленное начало окна, пока история от него помещается в бюджет"""
+        if segments.window_start is not None:
+            for index, item in enumerate(history):
+                if _turn_key(item) == segments.window_start:
+                    if sum(turn_tokens[index:]) <= available:
+                        return index
+                    break
+            start = self._fill(turn_tokens, available * self.trim_target)
+        else:
+            start = self._fill(turn_tokens, available)
+        segments.window_start = _turn_key(history[start]) if start < len(history) else None
+        return start
+
+    async def build(
+            self,
+            system_prompt: str,
+            message: str,
+            user_id: int,
+            conversation_history: List[Dict[str, Any]] = None,
+            knowledge: Optional[str] = None
+    ) -> BuiltContext:
+        """Промпт в пределах бюджета; knowledge ставится перед вопросом, чтобы не менять кешируемое начало"""
+        history = conversation_history or []
+        summary = await self._get_summary(user_id)
+
+        prefix = self.prefix(system_prompt)
+        segments = self._user_segments(user_id)
+        summary_segment = self._summary_segment(segments, summary)
+        head = list(prefix.messages)
+        fixed_tokens = prefix.tokens + self._message_tokens(message)
+        if knowledge:
+            fixed_tokens += self._message_tokens(knowledge)
+        if summary_segment:
+            head.extend(summary_segment.messages)
+            fixed_tokens += summary_segment.tokens
+
+        turns = self._turn_segments(segments, history)
+        turn_tokens = [segment.tokens for segment in turns]
+        start = self._window_start(segments, history, turn_tokens, self.budget - fixed_tokens)
+        full = len(history) >= self.history_turns
+        if full and start == 0 and self._summarizing:
+            # Самый старый ход выпадет из выборки на следующем запросе: сворачиваем блок заранее
+            start = max(1, int(len(history) * (1 - self.trim_target)))
+            segments.window_start = _turn_key(history[start]) if start < len(history) else None
+        used = fixed_tokens + sum(turn_tokens[start:])
+
+        messages = head
+        for segment in turns[start:]:
+            messages.extend(segment.messages)
+        if knowledge:
+            messages.append({"role": "system", "content": knowledge})
+        messages.append({"role": "user", "content": message})
+
+        if history and (start or full):
+            self._schedule_summary(user_id, summary, history[:start], history[0] if full else None)
+
+        built = BuiltContext(
+            messages=messages,
+            prompt_tokens=used,
+            unbudgeted_tokens=fixed_tokens + sum(turn_tokens)
+        )
+        self.requests += 1
+        self.prompt_tokens_total += built.prompt_tokens
+        self.unbudgeted_tokens_total += built.unbudgeted_tokens
+        logger.debug(
+            f"Prompt for user {user_id}: {built.prompt_tokens} tokens "
+            f"({len(history) - start}/{len(history)} turns, {built.unbudgeted_tokens} without budget)"
+        )
+        return built
+
+    async def _get_summary(self, user_id: int) -> Optional[Dict[str, Any]]:
+        if self.summary_store is None:
+            return None
+        try:
+            return await self.summary_store.get_summary(user_id)
+        except Exception as e:
+            logger.error(f"Failed to load conversation summary: {e}")
+            return None
+
+    @property
+    def _summarizing(self) -> bool:
+        return self.summary_store is not None and self.summarize is not None
+
+    def _schedule_summary(self, user_id: int, summary: Optional[Dict[str, Any]], dropped: List[Dict[str, Any]],
+                          oldest_fetched: Optional[Dict[str, Any]]):
+        """Фоновое дополнение сводки ходами, вышедшими из окна, и ходами старше выборки истории"""
+        if not self._summarizing or user_id in self._pending:
+            return
+
+        summarized_until = summary["summarized_until"] if summary else None
+        new_turns = [
+            item for item in dropped
+            if summarized_until is None or _turn_time(item) > summarized_until
+        ]
+        # Сводка отстает от выборки: между ними могут быть ходы, которых нет ни в промпте, ни в сводке
+        gap_before = None
+        if oldest_fetched is not None and (summarized_until is None or _turn_time(oldest_fetched) > summarized_until):
+            gap_before = _turn_time(oldest_fetched)
+        if not new_turns and gap_before is None:
+            return
+
+        self._pending.add(user_id)
+        task = asyncio.create_task(self._update_summary(user_id, summary, new_turns, gap_before))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update_summary(self, user_id: int, summary: Optional[Dict[str, Any]], new_turns: List[Dict[str, Any]],
+                              gap_before: Optional[datetime] = None):
+        try:
+            if gap_before is not None:
+                older = await self.summary_store.get_turns_between(
+                    user_id, summary["summarized_until"] if summary else None, gap_before, GAP_TURNS_PER_SUMMARY
+                )
+                # Длинный пропуск сворачивается по частям: сводка не должна перескочить его остаток
+                new_turns = older if len(older) >= GAP_TURNS_PER_SUMMARY else older + new_turns
+            if not new_turns:
+                return
+            previous = summary["summary"] if summary else ""
+            updated = await self.summarize(user_id, previous, new_turns)
+            if updated:
+                await self.summary_store.save_summary(user_id, updated, _turn_time(new_turns[-1]))
+        except Exception as e:
+            logger.error(f"Failed to update conversation summary: {e}")
+        finally:
+            self._pending.discard(user_id)
+
+    async def drain(self, timeout: float):
+        """Ожидание фоновых обновлений сводок при остановке"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        saved = self.unbudgeted_tokens_total - self.prompt_tokens_total
+        return {
+            "requests": self.requests,
+            "prompt_tokens_total": self.prompt_tokens_total,
+            "avg_prompt_tokens": round(self.prompt_tokens_total / self.requests, 1) if self.requests else 0.0,
+            "unbudgeted_tokens_total": self.unbudgeted_tokens_total,
+            "saved_tokens_ratio": round(saved / self.unbudgeted_tokens_total, 3) if self.unbudgeted_tokens_total else 0.0,
+            "encoded_turns": self.encoded_turns,
+            "reused_turns": self.reused_turns
+        }
@@ -1,49 +1,188 @@
+import asyncio
 import asyncpg
+import base64
+import binascii
 import json
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, AsyncIterator, Optional, Sequence, Tuple
 import logging
 from shared.config import config
+from .cache import HistoryCache, create_history_cache
+from .migrations import migrate
+from .search import HEADLINE_OPTIONS, SEARCH_TS_CONFIG, decode_search_cursor, encode_search_cursor
+from .server import resolve_workers
+from .telemetry import DB_POOL_ACQUIRE_SECONDS, DB_POOL_CONNECTIONS, DB_WRITE_DROPPED, DB_WRITE_QUEUE_DEPTH
 
 logger = logging.getLogger(__name__)
 
+CONVERSATION_COLUMNS = ["user_id", "username", "user_message", "ai_response", "created_at"]
+
+# Поля, доступные в выдаче истории и экспорте
+HISTORY_FIELDS = ("id", "username", "user_message", "ai_response", "created_at")
+DEFAULT_HISTORY_FIELDS = ("user_message", "ai_response", "created_at")
+
+# id для еще не записанных ходов: в порядке (created_at, id) они новее записанных
+PENDING_TURN_ID = 2 ** 63 - 1
+
+def pool_max_size() -> int:
+    """Размер пула одного процесса: общий бюджет соединений делится между воркерами"""
+    return max(1, config.DB_POOL_TOTAL_CONNECTIONS // resolve_workers())
+
+
+def utcnow() -> datetime:
+    """Текущее время UTC без часового пояса (как в колонке TIMESTAMP)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@dataclass(eq=False)
+class PendingTurn:
+    """Ход разговора, ожидающий записи в БД"""
+    user_id: int
+    username: Optional[str]
+    user_message: str
+    ai_response: str
+    created_at: datetime
+    discarded: bool = False
+
+    def as_record(self) -> tuple:
+        return self.user_id, self.username, self.user_message, self.ai_response, self.created_at
+
+    def as_history_item(self) -> Dict[str, Any]:
+        return {
+            "user_message": self.user_message,
+            "ai_response": self.ai_response,
+            "created_at": self.created_at.isoformat()
+        }
+
+    def as_row(self) -> Dict[str, Any]:
+        return {
+            "id": PENDING_TURN_ID,
+            "username": self.username,
+            "user_message": self.user_message,
+            "ai_response": self.ai_response,
+            "created_at": self.created_at
+        }
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Непрозрачный курсор пагинации по ключу (created_at, id)"""
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def select_fields(fields: Optional[Sequence[str]]) -> Tuple[str, ...]:
+    """Проверка списка полей истории; пустой список - поля по умолчанию"""
+    if not fields:
+        return DEFAULT_HISTORY_FIELDS
+    unknown = [field for field in fields if field not in HISTORY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return tuple(dict.fromkeys(fields))
+
+
+def _history_item(row, fields: Sequence[str]) -> Dict[str, Any]:
+    item = {field: row[field] for field in fields}
+    if "created_at" in item:
+        item["created_at"] = item["created_at"].isoformat()
+    if item.get("id") == PENDING_TURN_ID:
+        item["id"] = None
+    return item
+
 
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, history_cache: Optional[HistoryCache] = None):
         self.pool = None
+        self.history_cache = history_cache
+        # Сводки разговоров читаются на каждом запросе, держим их в памяти
+        self._summaries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+
+        # Write-behind: ходы буферизуются в очереди и пишутся пачками
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+        self._pending: Dict[int, List[PendingTurn]] = {}
+        self.write_stats = {"queued": 0, "written": 0, "failed": 0, "dropped": 0, "batches": 0}
+
+        # Короткий кеш агрегатов: частые /stats не ходят в БД
+        self._stats_cache: Dict[Tuple, Tuple[float, Dict[str, Any]]] = {}
+        self._stats_lock = asyncio.Lock()
 
     async def initialize(self):
+        """Пул, миграции и фоновая запись; повторный вызов ничего не делает"""
+        if self.pool is not None:
+            return
         try:
+            max_size = pool_max_size()
             self.pool = await asyncpg.create_pool(
                 config.DATABASE_URL,
-                min_size=1,
-                max_size=10,
+                min_size=min(config.DB_POOL_MIN_SIZE, max_size),
+                max_size=max_size,
                 command_timeout=60
             )
+            logger.info(f"Database pool: max {max_size} connections per worker")
+            DB_POOL_CONNECTIONS.set_function(
+                lambda: self.pool.get_size() - self.pool.get_idle_size(), state="in_use"
+            )
+            DB_POOL_CONNECTIONS.set_function(lambda: self.pool.get_idle_size(), state="idle")
             await self._create_tables()
+            if self.history_cache is None:
+                self.history_cache = await create_history_cache()
+            if config.WRITE_BEHIND:
+                self._write_queue = asyncio.Queue(maxsize=config.WRITE_QUEUE_SIZE)
+                self._writer_task = asyncio.create_task(self._writer())
+                DB_WRITE_QUEUE_DEPTH.set_function(self._write_queue.qsize)
             logger.info("Database initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}")
             raise
 
-    async def _create_tables(self):
+    @asynccontextmanager
+    async def _acquire(self):
+        """Соединение из пула с замером ожидания"""
+        started = time.perf_counter()
         async with self.pool.acquire() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    username VARCHAR(255),
-                    user_message TEXT NOT NULL,
-                    ai_response TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-
-                CREATE INDEX IF NOT EXISTS idx_conversations_user_id 
-                ON conversations(user_id);
-
-                CREATE INDEX IF NOT EXISTS idx_conversations_created_at 
-                ON conversations(created_at);
-            """)
+            DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+            yield conn
+
+    async def check(self, timeout: float = 1.0) -> Dict[str, Any]:
+        """Проверка БД для /ready: соединение из пула за timeout и SELECT 1"""
+        status = {"ok": False}
+        if self.pool is None:
+            return status
+        status["pool"] = {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "max": self.pool.get_max_size()
+        }
+        try:
+            async with self.pool.acquire(timeout=timeout) as conn:
+                await conn.fetchval("SELECT 1", timeout=timeout)
+            status["ok"] = True
+        except Exception as e:
+            status["error"] = f"{type(e).__name__}: {e}"
+        if self._write_queue is not None:
+            status["write_queue_depth"] = self._write_queue.qsize()
+        return status
+
+    async def _create_tables(self):
+        """Применение миграций схемы"""
+        async with self._acquire() as conn:
+            applied = await migrate(conn)
+        if applied:
+            logger.info(f"Applied migrations: {applied}")
 
     async def save_message(
             self,
@@ -53,83 +192,451 @@ class DatabaseManager:
             username: Optional[str] = None
     ):
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO conversations (user_id, username, user_message, ai_response)
-                    VALUES ($1, $2, $3, $4)
-                """, user_id, username, user_message, ai_response)
+            turn = PendingTurn(user_id, username, user_message, ai_response, utcnow())
+            if self._write_queue is not None:
+                # Ход виден в истории сразу, запись в БД происходит в фоне
+                self._pending.setdefault(user_id, []).append(turn)
+            else:
+                await self._write_batch([turn])
+
+            if self.history_cache:
+                # append меняет версию истории: чтения, начатые раньше, не заполнят кеш
+                await self.history_cache.append(user_id, turn.as_history_item())
+
+            if self._write_queue is not None:
+                # При заполненной очереди put() ждет (backpressure)
+                self.write_stats["queued"] += 1
+                await self._write_queue.put(turn)
         except Exception as e:
             logger.error(f"Failed to save message: {e}")
 
+    async def _copy_batch(self, batch: List[PendingTurn]) -> int:
+        """Один COPY под блокировкой записи; ходы, очищенные к этому моменту, не записываются"""
+        async with self._write_lock:
+            records = [turn.as_record() for turn in batch if not turn.discarded]
+            if records:
+                async with self._acquire() as conn:
+                    await conn.copy_records_to_table(
+                        "conversations", records=records, columns=CONVERSATION_COLUMNS
+                    )
+            return len(records)
+
+    async def _write_batch(self, batch: List[PendingTurn]):
+        """Запись пачки ходов одним COPY.
+
+        В режиме write-behind ошибка БД повторяется с нарастающей паузой, пока ходы
+        остаются в _pending (видны в истории); после WRITE_RETRIES повторов пачка отбрасывается.
+        Блокировка записи держится только на время COPY: очистка истории не ждет пауз.
+        """
+        try:
+            for attempt in range(config.WRITE_RETRIES + 1):
+                try:
+                    written = await self._copy_batch(batch)
+                    self.write_stats["written"] += written
+                    self.write_stats["batches"] += 1
+                    return
+                except Exception as e:
+                    count = sum(not turn.discarded for turn in batch)
+                    self.write_stats["failed"] += count
+                    if self._write_queue is None:
+                        logger.error(f"Failed to write {count} messages: {e}")
+                        raise
+                    if attempt == config.WRITE_RETRIES:
+                        self.write_stats["dropped"] += count
+                        DB_WRITE_DROPPED.inc(count)
+                        logger.error(f"Dropping {count} messages after {attempt + 1} attempts: {e}")
+                        return
+                    delay = config.WRITE_RETRY_DELAY * (2 ** attempt)
+                    logger.warning(f"Failed to write {count} messages, retrying in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+        finally:
+            for turn in batch:
+                pending = self._pending.get(turn.user_id)
+                if pending and turn in pending:
+                    pending.remove(turn)
+                    if not pending:
+                        del self._pending[turn.user_id]
+
+    async def _writer(self):
+        """Фоновая запись: пачка сбрасывается по размеру или по времени"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._write_queue.get()]
+            deadline = loop.time() + config.WRITE_FLUSH_INTERVAL
+            while len(batch) < config.WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._write_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+
+    async def drain_writes(self):
+        """Дождаться записи всех буферизованных ходов и остановить writer"""
+        if self._writer_task is None:
+            return
+        await self._write_queue.join()
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        self._writer_task = None
+        self._write_queue = None
+        logger.info(f"Write-behind queue drained: {self.write_stats}")
+
     async def get_conversation_history(
             self,
             user_id: int,
             limit: int = 20
     ) -> List[Dict[str, Any]]:
         try:
-            async with self.pool.acquire() as conn:
+            cache = self.history_cache
+            if cache and limit <= cache.size:
+                cached = await cache.get(user_id, limit)
+                if cached is not None:
+                    return cached
+
+            version = await cache.version(user_id) if cache else None
+            # Снимок незаписанных ходов берем до запроса, дубликаты отсекаем по created_at
+            pending = list(self._pending.get(user_id, ()))
+            fetch_limit = max(limit, cache.size) if cache else limit
+            async with self._acquire() as conn:
                 rows = await conn.fetch("""
                     SELECT user_message, ai_response, created_at
                     FROM conversations
                     WHERE user_id = $1
-                    ORDER BY created_at DESC
+                    ORDER BY created_at DESC, id DESC
                     LIMIT $2
-                """, user_id, limit)
-
-                return [
-                    {
-                        "user_message": row["user_message"],
-                        "ai_response": row["ai_response"],
-                        "created_at": row["created_at"].isoformat()
-                    }
-                    for row in reversed(rows)
-                ]
+                """, user_id, fetch_limit)
+
+            history = [
+                {
+                    "user_message": row["user_message"],
+                    "ai_response": row["ai_response"],
+                    "created_at": row["created_at"].isoformat()
+                }
+                for row in reversed(rows)
+            ]
+            last_saved = rows[0]["created_at"] if rows else None
+            history.extend(
+                turn.as_history_item() for turn in pending
+                if last_saved is None or turn.created_at > last_saved
+            )
+
+            # Кеш не заполняется, если за время запроса история изменилась
+            if cache:
+                await cache.set(user_id, history, version)
+
+            return history[-limit:] if limit > 0 else []
         except Exception as e:
             logger.error(f"Failed to get conversation history: {e}")
             return []
 
+    async def get_history_page(
+            self,
+            user_id: int,
+            limit: int = 50,
+            cursor: Optional[str] = None,
+            fields: Optional[Sequence[str]] = None
+    ) -> Dict[str, Any]:
+        """Страница истории по ключу (created_at, id): от новых к старым, внутри страницы - по времени.
+
+        next_cursor указывает на более ранние сообщения, None - история закончилась.
+        """
+        fields = select_fields(fields)
+        # Для ключа пагинации created_at и id читаются всегда
+        columns = ", ".join(dict.fromkeys(("id", "created_at") + fields))
+
+        before = decode_cursor(cursor) if cursor else None
+        # Снимок незаписанных ходов берем до запроса, записанные отсекаем по created_at
+        pending = [turn.as_row() for turn in self._pending.get(user_id, ()) if not turn.discarded]
+        if before:
+            pending = [row for row in pending if (row["created_at"], row["id"]) < before]
+            key_filter, params = "AND (created_at, id) < ($3, $4)", (user_id, limit + 1, *before)
+        else:
+            key_filter, params = "", (user_id, limit + 1)
+
+        async with self._acquire() as conn:
+            db_rows = await conn.fetch(f"""
+                SELECT {columns}
+                FROM conversations
+                WHERE user_id = $1 {key_filter}
+                ORDER BY created_at DESC, id DESC
+                LIMIT $2
+            """, *params)
+
+        saved = {row["created_at"] for row in db_rows}
+        rows = sorted(
+            [row for row in pending if row["created_at"] not in saved] + list(db_rows),
+            key=lambda row: (row["created_at"], row["id"]),
+            reverse=True
+        )
+        page = rows[:limit]
+        has_more = len(rows) > limit
+        return {
+            "history": [_history_item(row, fields) for row in reversed(page)],
+            "next_cursor": encode_cursor(page[-1]["created_at"], page[-1]["id"]) if has_more else None
+        }
+
+    async def iter_conversation(
+            self,
+            user_id: int,
+            fields: Optional[Sequence[str]] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Вся история пользователя по времени через серверный курсор: память не растет с длиной истории"""
+        fields = select_fields(fields)
+        columns = ", ".join(dict.fromkeys(("created_at",) + fields))
+        pending = list(self._pending.get(user_id, ()))
+        last_saved = None
+
+        async with self._acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                async for row in conn.cursor(f"""
+                    SELECT {columns}
+                    FROM conversations
+                    WHERE user_id = $1
+                    ORDER BY created_at, id
+                """, user_id, prefetch=config.EXPORT_PREFETCH):
+                    last_saved = row["created_at"]
+                    yield _history_item(row, fields)
+
+        for turn in pending:
+            if not turn.discarded and (last_saved is None or turn.created_at > last_saved):
+                yield _history_item(turn.as_row(), fields)
+
+    async def search_conversations(
+            self,
+            user_id: int,
+            query: str,
+            limit: int = 20,
+            cursor: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Полнотекстовый поиск по истории пользователя: от релевантных к менее релевантным.
+
+        Совпадения берутся из GIN-индекса search_vector, сниппеты (ts_headline)
+        строятся только для строк страницы. Ходы, еще не записанные write-behind,
+        в поиск не попадают.
+        """
+        after = decode_search_cursor(cursor) if cursor else None
+        if after:
+            key_filter, params = "WHERE (rank, created_at, id) < ($4, $5, $6)", (user_id, query, limit + 1, *after)
+        else:
+            key_filter, params = "", (user_id, query, limit + 1)
+
+        async with self._acquire() as conn:
+            rows = await conn.fetch(f"""
+                WITH q AS (
+                    SELECT websearch_to_tsquery('{SEARCH_TS_CONFIG}', $2) AS query
+                ),
+                matches AS (
+                    SELECT c.id, c.created_at, c.user_message, c.ai_response,
+                           ts_rank_cd(c.search_vector, q.query)::float8 AS rank
+                    FROM conversations c, q
+                    WHERE c.user_id = $1 AND c.search_vector @@ q.query
+                ),
+                page AS (
+                    SELECT * FROM matches
+                    {key_filter}
+                    ORDER BY rank DESC, created_at DESC, id DESC
+                    LIMIT $3
+                )
+                SELECT page.id, page.created_at, page.rank, page.user_message,
+                       ts_headline('{SEARCH_TS_CONFIG}', page.user_message || E'\\n' || page.ai_response,
+                                   q.query, '{HEADLINE_OPTIONS}') AS snippet
+                FROM page, q
+                ORDER BY page.rank DESC, page.created_at DESC, page.id DESC
+            """, *params)
+
+        page = rows[:limit]
+        has_more = len(rows) > limit
+        return {
+            "results": [
+                {
+                    "id": row["id"],
+                    "created_at": row["created_at"].isoformat(),
+                    "rank": row["rank"],
+                    "user_message": row["user_message"],
+                    "snippet": row["snippet"]
+                }
+                for row in page
+            ],
+            "next_cursor": encode_search_cursor(
+                page[-1]["rank"], page[-1]["created_at"], page[-1]["id"]
+            ) if has_more else None
+        }
+
+    def _remember_summary(self, user_id: int, summary: Dict[str, Any]):
+        self._summaries[user_id] = summary
+        self._summaries.move_to_end(user_id)
+        while len(self._summaries) > config.HISTORY_CACHE_MAX_USERS:
+            self._summaries.popitem(last=False)
+
+    async def get_summary(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Сводка ранней части разговора пользователя"""
+        if user_id in self._summaries:
+            self._summaries.move_to_end(user_id)
+            return self._summaries[user_id] or None
+
+        async with self._acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT summary, summarized_until
+                FROM conversation_summaries
+                WHERE user_id = $1
+            """, user_id)
+
+        summary = {
+            "summary": row["summary"],
+            "summarized_until": row["summarized_until"]
+        } if row else {}
+        self._remember_summary(user_id, summary)
+        return summary or None
+
+    async def get_turns_between(self, user_id: int, after: Optional[datetime], before: datetime,
+                                limit: int) -> List[Dict[str, Any]]:
+        """Ходы после after (None - с начала) и до before, от старых к новым: дочитывание в сводку"""
+        async with self._acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT user_message, ai_response, created_at
+                FROM conversations
+                WHERE user_id = $1 AND created_at < $2 AND ($3::timestamp IS NULL OR created_at > $3)
+                ORDER BY created_at, id
+                LIMIT $4
+            """, user_id, before, after, limit)
+        return [
+            {
+                "user_message": row["user_message"],
+                "ai_response": row["ai_response"],
+                "created_at": row["created_at"].isoformat()
+            }
+            for row in rows
+        ]
+
+    async def save_summary(self, user_id: int, summary: str, summarized_until: datetime):
+        """Сохранение обновленной сводки разговора"""
+        async with self._acquire() as conn:
+            await conn.execute("""
+                INSERT INTO conversation_summaries (user_id, summary, summarized_until)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO UPDATE
+                SET summary = EXCLUDED.summary,
+                    summarized_until = EXCLUDED.summarized_until,
+                    updated_at = CURRENT_TIMESTAMP
+            """, user_id, summary, summarized_until)
+        self._remember_summary(user_id, {"summary": summary, "summarized_until": summarized_until})
+
     async def clear_conversation(self, user_id: int):
         """Очистка истории разговора пользователя"""
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute("""
-                    DELETE FROM conversations WHERE user_id = $1
-                """, user_id)
+            # Блокировка записи: незаписанные ходы либо попадут в БД до DELETE, либо будут отброшены
+            async with self._write_lock:
+                for turn in self._pending.pop(user_id, []):
+                    turn.discarded = True
+
+                async with self._acquire() as conn:
+                    async with conn.transaction():
+                        await conn.execute("""
+                            DELETE FROM conversations WHERE user_id = $1
+                        """, user_id)
+                        await conn.execute("""
+                            DELETE FROM conversation_summaries WHERE user_id = $1
+                        """, user_id)
+
+            self._summaries.pop(user_id, None)
+            if self.history_cache:
+                await self.history_cache.invalidate(user_id)
         except Exception as e:
             logger.error(f"Failed to clear conversation: {e}")
             raise
 
+    async def _cached_stats(self, key: Tuple, load) -> Dict[str, Any]:
+        """Агрегаты из кеша с TTL; одновременные промахи выполняют один запрос"""
+        cached = self._stats_cache.get(key)
+        if cached and time.monotonic() - cached[0] < config.USAGE_STATS_CACHE_TTL:
+            return cached[1]
+
+        async with self._stats_lock:
+            cached = self._stats_cache.get(key)
+            if cached and time.monotonic() - cached[0] < config.USAGE_STATS_CACHE_TTL:
+                return cached[1]
+            async with self._acquire() as conn:
+                value = await load(conn)
+            now = time.monotonic()
+            self._stats_cache = {
+                k: v for k, v in self._stats_cache.items() if now - v[0] < config.USAGE_STATS_CACHE_TTL
+            }
+            self._stats_cache[key] = (now, value)
+            return value
+
     async def get_usage_stats(self) -> Dict[str, Any]:
         """Получение статистики использования"""
+        async def load(conn) -> Dict[str, Any]:
+            totals = await conn.fetchrow("""
+                SELECT total_messages, unique_users FROM usage_totals WHERE id = 1
+            """)
+            # Сообщения за последние 24 часа: сумма по почасовым корзинам
+            messages_24h = await conn.fetchval("""
+                SELECT COALESCE(SUM(message_count), 0) FROM usage_hourly
+                WHERE hour >= $1
+            """, utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=23))
+            return {
+                "total_messages": totals["total_messages"] if totals else 0,
+                "unique_users": totals["unique_users"] if totals else 0,
+                "messages_last_24h": messages_24h
+            }
+
         try:
-            async with self.pool.acquire() as conn:
-                # Общее количество сообщений
-                total_messages = await conn.fetchval("""
-                    SELECT COUNT(*) FROM conversations
-                """)
-
-                # Уникальные пользователи
-                unique_users = await conn.fetchval("""
-                    SELECT COUNT(DISTINCT user_id) FROM conversations
-                """)
-
-                # Сообщения за последние 24 часа
-                messages_24h = await conn.fetchval("""
-                    SELECT COUNT(*) FROM conversations
-                    WHERE created_at > NOW() - INTERVAL '24 hours'
-                """)
-
-                return {
-                    "total_messages": total_messages,
-                    "unique_users": unique_users,
-                    "messages_last_24h": messages_24h
-                }
+            stats = dict(await self._cached_stats(("totals",), load))
+            if self.history_cache:
+                stats["history_cache"] = self.history_cache.stats()
+            if self._write_queue is not None:
+                stats["write_behind"] = {**self.write_stats, "queue_depth": self._write_queue.qsize()}
+            return stats
         except Exception as e:
             logger.error(f"Failed to get usage stats: {e}")
             return {}
 
+    async def get_usage_series(self, hours: int = 24, days: int = 30) -> Dict[str, Any]:
+        """Ряды по времени: сообщения по часам и активные пользователи по дням"""
+        async def load(conn) -> Dict[str, Any]:
+            current_hour = utcnow().replace(minute=0, second=0, microsecond=0)
+            hourly = await conn.fetch("""
+                SELECT hour, message_count FROM usage_hourly
+                WHERE hour > $1 ORDER BY hour
+            """, current_hour - timedelta(hours=hours))
+            daily = await conn.fetch("""
+                SELECT day, active_users FROM usage_daily
+                WHERE day > $1 ORDER BY day
+            """, current_hour.date() - timedelta(days=days))
+
+            # Пустые корзины заполняем нулями, чтобы ряд был непрерывным
+            messages = {row["hour"]: row["message_count"] for row in hourly}
+            users = {row["day"]: row["active_users"] for row in daily}
+            return {
+                "messages_per_hour": [
+                    {"hour": hour.isoformat(), "messages": messages.get(hour, 0)}
+                    for hour in (current_hour - timedelta(hours=i) for i in reversed(range(hours)))
+                ],
+                "active_users_per_day": [
+                    {"day": day.isoformat(), "users": users.get(day, 0)}
+                    for day in (current_hour.date() - timedelta(days=i) for i in reversed(range(days)))
+                ]
+            }
+
+        return await self._cached_stats(("series", hours, days), load)
+
     async def close(self):
         """Закрытие подключения к БД"""
+        await self.drain_writes()
+        if self.history_cache:
+            await self.history_cache.close()
         if self.pool:
             await self.pool.close()
 
@@ -0,0 +1,336 @@
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from shared.config import config
+from shared.metrics import registry
+from shared.utils import user_id_var
+
+logger = logging.getLogger(__name__)
+
+# Меньшее значение обрабатывается раньше
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+FINISHED = ("done", "failed")
+SIGNATURE_HEADER = "X-Job-Signature"
+
+JOBS = registry.counter("chat_jobs_total", "Фоновые задачи чата по итоговому статусу", ["status"])
+JOB_QUEUE_DEPTH = registry.gauge("chat_job_queue_depth", "Фоновые задачи чата в очереди")
+JOB_QUEUE_SECONDS = registry.histogram("chat_job_queue_seconds", "Ожидание фоновой задачи в очереди")
+
+
+class JobQueueFullError(Exception):
+    """Очередь фоновых задач заполнена"""
+
+
+def callback_allowed(url: str) -> bool:
+    """callback только по http(s) на хосты из JOB_CALLBACK_ALLOWED_HOSTS: иначе backend
+    можно заставить отправить запрос во внутреннюю сеть"""
+    allowed = {host.strip().lower() for host in config.JOB_CALLBACK_ALLOWED_HOSTS.split(",") if host.strip()}
+    parts = urlsplit(url)
+    return parts.scheme in ("http", "https") and (parts.hostname or "").lower() in allowed
+
+
+@dataclass
+class Job:
+    id: str
+    user_id: int
+    message: str
+    username: Optional[str] = None
+    priority: str = "normal"
+    callback_url: Optional[str] = None
+    status: str = "queued"
+    response: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+    def public(self) -> Dict[str, Any]:
+        """Состояние задачи для клиента (без текста запроса)"""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "response": self.response,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class JobStore:
+    """Хранилище состояний задач: по нему отвечают опросы, в том числе на других воркерах"""
+
+    async def save(self, job: Job):
+        raise NotImplementedError
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """Задача после завершения или по истечении timeout (long polling)"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryJobStore(JobStore):
+    """Задачи в памяти процесса: опрашивать нужно тот же воркер (BACKEND_WORKERS=1)"""
+
+    backend = "memory"
+
+    def __init__(self, ttl: float, max_jobs: int = 100000):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._finished: Dict[str, asyncio.Event] = {}
+
+    def _expire(self):
+        now = time.time()
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if len(self._jobs) <= self.max_jobs and not (job.finished and job.finished_at + self.ttl < now):
+                break
+            self._jobs.popitem(last=False)
+            self._finished.pop(job.id, None)
+
+    async def save(self, job: Job):
+        if job.id not in self._jobs:
+            self._expire()
+            self._finished[job.id] = asyncio.Event()
+        self._jobs[job.id] = job
+        if job.finished:
+            self._finished[job.id].set()
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        event = self._finished.get(job_id)
+        if event is not None and timeout > 0:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._jobs.get(job_id)
+
+
+class RedisJobStore(JobStore):
+    """Задачи в Redis, общие для всех воркеров и реплик backend"""
+
+    backend = "redis"
+    poll_interval = 0.2
+
+    def __init__(self, redis, ttl: float):
+        self.redis = redis
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job:{job_id}"
+
+    async def save(self, job: Job):
+        # Незавершенная задача живет не дольше TTL на случай падения воркера
+        await self.redis.set(self._key(job.id), json.dumps(asdict(job), ensure_ascii=False), ex=int(self.ttl))
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        raw = await self.redis.get(self._key(job_id))
+        return Job(**json.loads(raw)) if raw else None
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await self.load(job_id)
+            if job is None or job.finished or time.monotonic() >= deadline:
+                return job
+            await asyncio.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+async def create_job_store() -> JobStore:
+    """Хранилище задач по JOB_STORE (redis или memory)"""
+    if config.JOB_STORE.lower() == "redis":
+        try:
+            import redis.asyncio as aioredis
+
+            redis = aioredis.from_url(config.REDIS_URL, socket_connect_timeout=2)
+            await redis.ping()
+            logger.info("Job store: redis")
+            return RedisJobStore(redis, config.JOB_RESULT_TTL)
+        except Exception as e:
+            logger.warning("Redis is unavailable for job store, using in-process store: %s", e)
+
+    logger.info("Job store: memory")
+    return MemoryJobStore(config.JOB_RESULT_TTL)
+
+
+JobHandler = Callable[[Job], Awaitable[str]]
+
+
+class JobManager:
+    """Фоновая обработка запросов чата: очередь с приоритетами и ограниченный пул воркеров.
+
+    Клиент получает id задачи сразу и забирает результат опросом, long polling
+    или через callback_url. Задача выполняется до конца независимо от того,
+    ждет ли ее клиент, поэтому таймаут клиента не выбрасывает готовый ответ.
+    """
+
+    def __init__(self, store: JobStore, handler: JobHandler, workers: int, max_queue: int):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._tasks: List[asyncio.Task] = []
+        self._callbacks: set = set()
+        self._http = None
+        self.accepting = True
+        self.counters = {"submitted": 0, "rejected": 0, "done": 0, "failed": 0, "callbacks_failed": 0}
+        JOB_QUEUE_DEPTH.set_function(self._queue.qsize)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, user_id: int, message: str, username: Optional[str] = None,
+                     priority: str = "normal", callback_url: Optional[str] = None) -> Job:
+        if not self.accepting or self._queue.qsize() >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise JobQueueFullError(f"Job queue is full ({self._queue.qsize()}/{self.max_queue})")
+
+        job = Job(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            message=message,
+            username=username,
+            priority=priority,
+            callback_url=callback_url
+        )
+        await self.store.save(job)
+        self._queue.put_nowait((PRIORITIES[priority], next(self._sequence), job))
+        self.counters["submitted"] += 1
+        return job
+
+    async def get(self, job_id: str, wait: float = 0.0) -> Optional[Job]:
+        if wait > 0:
+            return await self.store.wait(job_id, wait)
+        return await self.store.load(job_id)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        user_id_var.set(job.user_id)
+        job.status = "running"
+        job.started_at = time.time()
+        JOB_QUEUE_SECONDS.observe(job.started_at - job.created_at)
+        await self._save(job)
+        try:
+            job.response = await self.handler(job)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status, job.error = "failed", "Backend is shutting down"
+            raise
+        except Exception as e:
+            logger.error("Job %s for user %s failed: %s", job.id, job.user_id, e)
+            job.status, job.error = "failed", "Internal server error"
+        finally:
+            job.finished_at = time.time()
+            self.counters[job.status] += 1
+            JOBS.inc(status=job.status)
+            await self._save(job)
+            if job.callback_url:
+                self._spawn_callback(job)
+
+    async def _save(self, job: Job):
+        try:
+            await self.store.save(job)
+        except Exception as e:
+            logger.error("Failed to save job %s: %s", job.id, e)
+
+    def _spawn_callback(self, job: Job):
+        task = asyncio.create_task(self._callback(job))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    async def _callback(self, job: Job):
+        """POST результата на callback_url с повторами; тело подписывается JOB_CALLBACK_SECRET"""
+        import httpx
+
+        if not callback_allowed(job.callback_url):
+            logger.warning("Callback for job %s is not allowed: %s", job.id, job.callback_url)
+            return
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=config.JOB_CALLBACK_TIMEOUT)
+        body = json.dumps(job.public(), ensure_ascii=False).encode()
+        headers = {"Content-Type": "application/json"}
+        if config.JOB_CALLBACK_SECRET:
+            digest = hmac.new(config.JOB_CALLBACK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+            headers[SIGNATURE_HEADER] = f"sha256={digest}"
+
+        for attempt in range(config.JOB_CALLBACK_RETRIES + 1):
+            try:
+                response = await self._http.post(job.callback_url, content=body, headers=headers)
+                if response.status_code < 500:
+                    return
+            except Exception as e:
+                logger.warning("Callback for job %s failed: %s", job.id, e)
+            if attempt < config.JOB_CALLBACK_RETRIES:
+                await asyncio.sleep(config.JOB_CALLBACK_RETRY_DELAY * (2 ** attempt))
+        self.counters["callbacks_failed"] += 1
+        logger.error("Giving up on callback for job %s: %s", job.id, job.callback_url)
+
+    async def stop(self, timeout: float):
+        """Остановка: новые задачи не принимаются, очередь дорабатывается до timeout"""
+        self.accepting = False
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Job queue not drained in %ss, %s jobs left", timeout, self._queue.qsize())
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+
+        # Невзятые задачи помечаются неудачными, чтобы опрос не ждал их вечно
+        while not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            job.status, job.error, job.finished_at = "failed", "Backend is shutting down", time.time()
+            await self._save(job)
+
+        if self._callbacks:
+            await asyncio.wait(set(self._callbacks), timeout=config.JOB_CALLBACK_TIMEOUT)
+        if self._http is not None:
+            await self._http.aclose()
+        await self.store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "store": self.store.backend,
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "max_queue": self.max_queue,
+            **self.counters
+        }
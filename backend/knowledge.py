@@ -0,0 +1,559 @@
+"""База знаний для ответов модели: документы режутся на фрагменты, фрагменты -
+в эмбеддинги, поиск - скалярное произведение по матрице, отображенной в память.
+
+Индекс обновляется инкрементально: перекодируются только новые и измененные
+документы, строки удаленных помечаются и вычищаются при уплотнении.
+
+    python -m backend.knowledge build --docs docs --index knowledge_index
+    python -m backend.knowledge query "как настроить webhook"
+"""
+import argparse
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import json
+import math
+import mmap
+import os
+import time
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from shared.config import config
+from shared.metrics import registry
+from .search import tokenize
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_SUFFIXES = (".md", ".txt", ".rst")
+MANIFEST = "manifest.json"
+VECTORS = "vectors.f32"
+CHUNKS = "chunks.jsonl"
+CENTROIDS = "centroids.npy"
+LISTS = "lists.i32"
+# Блокировка каталога индекса: собирает один процесс, остальные ждут и читают результат
+LOCK = "build.lock"
+# Доля удаленных строк, после которой индекс переписывается без них
+COMPACT_RATIO = 0.25
+# Центроиды переобучаются, когда индекс вырос вдвое с прошлого обучения
+RETRAIN_GROWTH = 2.0
+
+KNOWLEDGE_CHUNKS = registry.gauge("knowledge_chunks", "Фрагменты документов в индексе базы знаний")
+KNOWLEDGE_SEARCH_SECONDS = registry.histogram(
+    "knowledge_search_seconds", "Поиск по индексу базы знаний без эмбеддинга запроса",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+)
+
+
+class HashingEmbedder:
+    """Детерминированный локальный эмбеддер: слова и пары слов хешируются в фиксированное пространство.
+
+    Не требует сети и ключей, поэтому подходит для тестов и офлайн-сборки индекса.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text: str) -> Dict[int, float]:
+        words = tokenize(text)
+        features: Dict[int, float] = {}
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            features[index] = features.get(index, 0.0) + (1.0 if digest[4] & 1 else -1.0)
+        return features
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for index, value in self._features(text).items():
+                vectors[row, index] = math.copysign(math.log1p(abs(value)), value)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class ProviderEmbedder:
+    """Эмбеддинги модели провайдера: одна пачка фрагментов - один запрос"""
+
+    def __init__(self, provider, model: str):
+        self.provider = provider
+        self.model = model
+        self.name = f"provider-{model}"
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(await self.provider.embed_many(self.model, texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+def create_embedder(provider=None):
+    """Эмбеддер по KNOWLEDGE_EMBEDDER: hashing или provider"""
+    name = config.KNOWLEDGE_EMBEDDER.lower()
+    if name == "hashing":
+        return HashingEmbedder(config.KNOWLEDGE_EMBEDDING_DIM)
+    if name == "provider":
+        if provider is None:
+            from .providers import create_provider
+            provider = create_provider()
+        return ProviderEmbedder(provider, config.KNOWLEDGE_EMBEDDING_MODEL)
+    raise ValueError(f"Unknown KNOWLEDGE_EMBEDDER: {config.KNOWLEDGE_EMBEDDER}")
+
+
+def chunk_text(text: str, max_chars: int, overlap: int) -> List[str]:
+    """Фрагменты по абзацам не длиннее max_chars; длинный абзац режется с перекрытием"""
+    pieces: List[str] = []
+    for paragraph in (part.strip() for part in text.split("\n\n")):
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        step = max(1, max_chars - overlap)
+        pieces.extend(paragraph[start:start + max_chars] for start in range(0, len(paragraph), step)
+                      if start == 0 or start + overlap < len(paragraph))
+
+    chunks: List[str] = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + 2 + len(piece) <= max_chars:
+            chunks[-1] += "\n\n" + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+@dataclass
+class Chunk:
+    source: str
+    text: str
+    score: float
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, iterations: int = 10) -> np.ndarray:
+    """Сферический k-means по выборке строк: центроиды грубого разбиения индекса"""
+    rng = np.random.default_rng(0)
+    sample_rows = np.sort(rng.choice(len(vectors), min(len(vectors), nlist * 64), replace=False))
+    sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Пустой кластер сохраняет прежний центроид
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    return centroids
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray, batch: int = 16384) -> np.ndarray:
+    """Номер ближайшего центроида для каждой строки"""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch):
+        assignments[start:start + batch] = np.argmax(vectors[start:start + batch] @ centroids.T, axis=1)
+    return assignments
+
+
+class KnowledgeIndex:
+    """Индекс на диске: матрица float32 (vectors.f32), тексты (chunks.jsonl) и manifest.json.
+
+    Матрица и тексты отображаются в память: процесс не держит их копию, а
+    страницы читаются ОС по мере обращения. Небольшой индекс просматривается
+    целиком; начиная с ivf_min_rows строки разбиты по ближайшим центроидам
+    (centroids.npy, lists.i32), и запрос читает только nprobe ближайших списков.
+    """
+
+    def __init__(self, path: str, ivf_min_rows: int = 20000, nprobe: int = 16):
+        self.path = Path(path)
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self.manifest: Dict[str, Any] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._texts: Optional[mmap.mmap] = None
+        self._text_file = None
+        self._offsets: Optional[np.ndarray] = None
+        self._deleted: Optional[np.ndarray] = None
+        self._centroids: Optional[np.ndarray] = None
+        # Строки, упорядоченные по спискам, и границы списков в этом порядке
+        self._list_rows: Optional[np.ndarray] = None
+        self._list_bounds: Optional[np.ndarray] = None
+
+    @property
+    def count(self) -> int:
+        return self.manifest.get("count", 0)
+
+    @property
+    def active(self) -> int:
+        return self.count - sum(end - start for start, end in self.manifest.get("deleted", []))
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        path = self.path / MANIFEST
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def _write_manifest(self, manifest: Dict[str, Any]):
+        tmp = self.path / f"{MANIFEST}.tmp"
+        tmp.write_text(json.dumps(manifest, ensure_ascii=False))
+        os.replace(tmp, self.path / MANIFEST)
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive: bool, wait: bool = True):
+        """flock на файле блокировки; без wait - None, если блокировку держит другой процесс"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / LOCK, "a") as lock_file:
+            operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(lock_file, operation if wait else operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield None
+                return
+            try:
+                yield lock_file
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        """Отображение индекса в память под разделяемой блокировкой: сборка в другом процессе не видна наполовину"""
+        with self._lock(exclusive=False):
+            self._load()
+
+    def _load(self):
+        """Строки после count (прерванная сборка) не читаются"""
+        self.close()
+        self.manifest = self._read_manifest()
+        count, dim = self.count, self.manifest.get("dim", 0)
+        if count:
+            self._vectors = np.memmap(self.path / VECTORS, dtype=np.float32, mode="r", shape=(count, dim))
+            self._text_file = open(self.path / CHUNKS, "rb")
+            self._texts = mmap.mmap(self._text_file.fileno(), 0, access=mmap.ACCESS_READ)
+            offsets = np.zeros(count + 1, dtype=np.int64)
+            position = 0
+            for row in range(count):
+                position = self._texts.find(b"\n", position) + 1
+                offsets[row + 1] = position
+            self._offsets = offsets
+            deleted = self.manifest.get("deleted", [])
+            if deleted:
+                self._deleted = np.zeros(count, dtype=bool)
+                for start, end in deleted:
+                    self._deleted[start:end] = True
+            ivf = self.manifest.get("ivf")
+            # Списки от прерванной сборки (не на все строки) не используются: поиск будет полным
+            if ivf and ivf["assigned"] == count:
+                self._centroids = np.load(self.path / CENTROIDS)
+                assignments = np.fromfile(self.path / LISTS, dtype=np.int32, count=count)
+                self._list_rows = np.argsort(assignments, kind="stable")
+                self._list_bounds = np.searchsorted(
+                    assignments[self._list_rows], np.arange(len(self._centroids) + 1)
+                )
+        KNOWLEDGE_CHUNKS.set(self.active)
+
+    def close(self):
+        self._vectors = None
+        self._offsets = None
+        self._deleted = None
+        self._centroids = None
+        self._list_rows = None
+        self._list_bounds = None
+        if self._texts is not None:
+            self._texts.close()
+            self._texts = None
+        if self._text_file is not None:
+            self._text_file.close()
+            self._text_file = None
+
+    def _chunk(self, row: int) -> Dict[str, Any]:
+        return json.loads(self._texts[self._offsets[row]:self._offsets[row + 1]])
+
+    def search(self, vector: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        """Top-k строк по скалярному произведению с нормированным вектором запроса"""
+        if self._vectors is None or k <= 0:
+            return []
+        started = time.perf_counter()
+        vector = vector.astype(np.float32)
+        if self._centroids is not None:
+            nprobe = min(self.nprobe, len(self._centroids))
+            probe = np.argpartition(-(self._centroids @ vector), nprobe - 1)[:nprobe]
+            rows = np.sort(np.concatenate([
+                self._list_rows[self._list_bounds[i]:self._list_bounds[i + 1]] for i in probe
+            ]))
+            scores = self._vectors[rows] @ vector
+        else:
+            rows = None
+            scores = self._vectors @ vector
+        if self._deleted is not None:
+            scores[self._deleted[rows] if rows is not None else self._deleted] = -np.inf
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        KNOWLEDGE_SEARCH_SECONDS.observe(time.perf_counter() - started)
+        return [
+            (int(rows[i] if rows is not None else i), float(scores[i]))
+            for i in top if np.isfinite(scores[i])
+        ]
+
+    def chunks(self, hits: List[Tuple[int, float]]) -> List[Chunk]:
+        result = []
+        for row, score in hits:
+            item = self._chunk(row)
+            result.append(Chunk(source=item["source"], text=item["text"], score=score))
+        return result
+
+    async def build(self, docs_dir: str, embedder, chunk_chars: int, chunk_overlap: int,
+                    batch_size: int, rebuild: bool = False) -> Dict[str, int]:
+        """Инкрементальная сборка под исключительной блокировкой каталога индекса.
+
+        Если индекс уже собирает другой процесс (например, соседний воркер uvicorn),
+        сборка дожидается его и загружает результат; rebuild после ожидания собирает заново.
+        """
+        with self._lock(exclusive=True, wait=False) as lock_file:
+            if lock_file is not None:
+                return await self._build(docs_dir, embedder, chunk_chars, chunk_overlap, batch_size, rebuild)
+        logger.info("Knowledge index is being built by another process, waiting")
+        with open(self.path / LOCK, "a") as lock_file:
+            # Ожидание в потоке: event loop процесса не блокируется
+            await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+            try:
+                if rebuild:
+                    return await self._build(docs_dir, embedder, chunk_chars, chunk_overlap, batch_size, rebuild)
+                self._load()
+                return {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "chunks": 0}
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    async def _build(self, docs_dir: str, embedder, chunk_chars: int, chunk_overlap: int,
+                     batch_size: int, rebuild: bool) -> Dict[str, int]:
+        """Перекодируются только новые и измененные документы; вызывается под блокировкой"""
+        self.close()
+        manifest = self._read_manifest()
+        if rebuild or manifest.get("embedder") != embedder.name:
+            if manifest:
+                logger.info(f"Rebuilding knowledge index: embedder {manifest.get('embedder')} -> {embedder.name}")
+            manifest = {"embedder": embedder.name, "dim": 0, "count": 0, "chunks_bytes": 0,
+                        "sources": {}, "deleted": []}
+
+        docs = Path(docs_dir)
+        current = {
+            str(path.relative_to(docs)): path
+            for path in sorted(docs.rglob("*")) if path.is_file() and path.suffix in DOCUMENT_SUFFIXES
+        } if docs.is_dir() else {}
+
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "chunks": 0}
+        changed: Dict[str, Tuple[str, List[str]]] = {}
+        for source, path in current.items():
+            text = path.read_text(encoding="utf-8", errors="replace")
+            digest = hashlib.sha256(text.encode()).hexdigest()
+            known = manifest["sources"].get(source)
+            if known and known["sha256"] == digest:
+                stats["unchanged"] += 1
+                continue
+            stats["updated" if known else "added"] += 1
+            changed[source] = (digest, chunk_text(text, chunk_chars, chunk_overlap))
+
+        for source in list(manifest["sources"]):
+            if source not in current or source in changed:
+                start, end = manifest["sources"].pop(source)["rows"]
+                if end > start:
+                    manifest["deleted"].append([start, end])
+                if source not in current:
+                    stats["removed"] += 1
+
+        # Файлы обрезаются до последнего записанного manifest: хвост прерванной сборки отбрасывается
+        with open(self.path / VECTORS, "ab") as vectors_file, open(self.path / CHUNKS, "ab") as chunks_file:
+            vectors_file.truncate(manifest["count"] * manifest["dim"] * 4)
+            chunks_file.truncate(manifest["chunks_bytes"])
+            for source, (digest, chunks) in changed.items():
+                start = manifest["count"]
+                for offset in range(0, len(chunks), batch_size):
+                    batch = chunks[offset:offset + batch_size]
+                    vectors = await embedder.embed(batch)
+                    if manifest["dim"] == 0:
+                        manifest["dim"] = int(vectors.shape[1])
+                    vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                    for text in batch:
+                        line = json.dumps({"source": source, "text": text}, ensure_ascii=False) + "\n"
+                        chunks_file.write(line.encode())
+                    manifest["count"] += len(batch)
+                manifest["sources"][source] = {"sha256": digest, "rows": [start, manifest["count"]]}
+                stats["chunks"] += len(chunks)
+            vectors_file.flush()
+            chunks_file.flush()
+            manifest["chunks_bytes"] = chunks_file.tell()
+        self._write_manifest(manifest)
+
+        deleted = sum(end - start for start, end in manifest["deleted"])
+        if manifest["count"] and deleted / manifest["count"] > COMPACT_RATIO:
+            self._compact(manifest)
+        self._update_lists(manifest)
+        self._load()
+        return stats
+
+    def _update_lists(self, manifest: Dict[str, Any]):
+        """Разбиение строк по центроидам: новые строки дописываются, при росте индекса - переобучение"""
+        count, ivf = manifest["count"], manifest.get("ivf")
+        if count < self.ivf_min_rows:
+            if ivf:
+                manifest["ivf"] = None
+                self._write_manifest(manifest)
+            return
+        vectors = np.memmap(self.path / VECTORS, dtype=np.float32, mode="r", shape=(count, manifest["dim"]))
+        if not ivf or count > ivf["trained"] * RETRAIN_GROWTH:
+            nlist = int(math.sqrt(count))
+            started = time.perf_counter()
+            centroids = train_centroids(vectors, nlist)
+            np.save(self.path / CENTROIDS, centroids)
+            assign_lists(vectors, centroids).tofile(self.path / LISTS)
+            manifest["ivf"] = {"nlist": nlist, "trained": count, "assigned": count}
+            logger.info(f"Knowledge index: {nlist} lists trained in {time.perf_counter() - started:.1f}s")
+        elif ivf["assigned"] < count:
+            centroids = np.load(self.path / CENTROIDS)
+            with open(self.path / LISTS, "ab") as lists_file:
+                lists_file.truncate(ivf["assigned"] * 4)
+                lists_file.write(assign_lists(vectors[ivf["assigned"]:], centroids).tobytes())
+            ivf["assigned"] = count
+        else:
+            return
+        self._write_manifest(manifest)
+
+    def _compact(self, manifest: Dict[str, Any]):
+        """Перезапись индекса без удаленных строк"""
+        dim = manifest["dim"]
+        vectors = np.fromfile(self.path / VECTORS, dtype=np.float32, count=manifest["count"] * dim)
+        vectors = vectors.reshape(manifest["count"], dim)
+        with open(self.path / CHUNKS, "rb") as chunks_file:
+            lines = chunks_file.read(manifest["chunks_bytes"]).splitlines(keepends=True)
+
+        rows: List[int] = []
+        sources = {}
+        for source, item in sorted(manifest["sources"].items(), key=lambda pair: pair[1]["rows"][0]):
+            start, end = item["rows"]
+            sources[source] = {"sha256": item["sha256"], "rows": [len(rows), len(rows) + end - start]}
+            rows.extend(range(start, end))
+
+        vectors[rows].tofile(self.path / f"{VECTORS}.tmp")
+        data = b"".join(lines[row] for row in rows)
+        (self.path / f"{CHUNKS}.tmp").write_bytes(data)
+        ivf = manifest.get("ivf")
+        if ivf:
+            assignments = np.fromfile(self.path / LISTS, dtype=np.int32, count=ivf["assigned"])
+            kept = [row for row in rows if row < ivf["assigned"]]
+            assignments[kept].tofile(self.path / f"{LISTS}.tmp")
+            os.replace(self.path / f"{LISTS}.tmp", self.path / LISTS)
+            ivf["assigned"] = len(kept)
+        os.replace(self.path / f"{VECTORS}.tmp", self.path / VECTORS)
+        os.replace(self.path / f"{CHUNKS}.tmp", self.path / CHUNKS)
+        manifest.update(count=len(rows), chunks_bytes=len(data), sources=sources, deleted=[])
+        self._write_manifest(manifest)
+        logger.info(f"Knowledge index compacted to {len(rows)} chunks")
+
+
+class KnowledgeBase:
+    """Подбор фрагментов документов к вопросу для промпта модели"""
+
+    def __init__(self, index: KnowledgeIndex, embedder, top_k: int, min_score: float, max_chars: int):
+        self.index = index
+        self.embedder = embedder
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_chars = max_chars
+        self.queries = 0
+        self.hits = 0
+
+    async def retrieve(self, query: str) -> List[Chunk]:
+        if self.index.count == 0:
+            return []
+        self.queries += 1
+        vector = (await self.embedder.embed([query]))[0]
+        chunks = self.index.chunks(
+            [(row, score) for row, score in self.index.search(vector, self.top_k) if score >= self.min_score]
+        )
+        selected, size = [], 0
+        for chunk in chunks:
+            if selected and size + len(chunk.text) > self.max_chars:
+                break
+            selected.append(chunk)
+            size += len(chunk.text)
+        if selected:
+            self.hits += 1
+        return selected
+
+    async def context(self, query: str) -> Optional[str]:
+        """Текст для промпта: найденные фрагменты с указанием документа"""
+        chunks = await self.retrieve(query)
+        if not chunks:
+            return None
+        parts = "\n\n".join(f"[{chunk.source}]\n{chunk.text}" for chunk in chunks)
+        return ("Фрагменты внутренней документации, относящиеся к вопросу. "
+                "Опирайся на них, если они отвечают на вопрос:\n\n" + parts)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "embedder": self.embedder.name,
+            "chunks": self.index.active,
+            "documents": len(self.index.manifest.get("sources", {})),
+            "queries": self.queries,
+            "hits": self.hits
+        }
+
+    def close(self):
+        self.index.close()
+
+
+async def create_knowledge_base(provider=None) -> KnowledgeBase:
+    """База знаний из KNOWLEDGE_INDEX_DIR; с KNOWLEDGE_BUILD_ON_START индекс сначала обновляется"""
+    embedder = create_embedder(provider)
+    index = KnowledgeIndex(config.KNOWLEDGE_INDEX_DIR, config.KNOWLEDGE_IVF_MIN_ROWS, config.KNOWLEDGE_NPROBE)
+    if config.KNOWLEDGE_BUILD_ON_START:
+        stats = await index.build(
+            config.KNOWLEDGE_DOCS_DIR, embedder,
+            config.KNOWLEDGE_CHUNK_CHARS, config.KNOWLEDGE_CHUNK_OVERLAP, config.KNOWLEDGE_BATCH_SIZE
+        )
+        logger.info(f"Knowledge index updated: {stats}")
+    else:
+        index.load()
+    logger.info(f"Knowledge base: {index.active} chunks, embedder {embedder.name}")
+    return KnowledgeBase(
+        index, embedder,
+        top_k=config.KNOWLEDGE_TOP_K,
+        min_score=config.KNOWLEDGE_MIN_SCORE,
+        max_chars=config.KNOWLEDGE_MAX_CHARS
+    )
+
+
+async def main(args: argparse.Namespace):
+    embedder = create_embedder()
+    index = KnowledgeIndex(args.index, config.KNOWLEDGE_IVF_MIN_ROWS, config.KNOWLEDGE_NPROBE)
+    if args.command == "build":
+        stats = await index.build(args.docs, embedder, config.KNOWLEDGE_CHUNK_CHARS,
+                                  config.KNOWLEDGE_CHUNK_OVERLAP, config.KNOWLEDGE_BATCH_SIZE,
+                                  rebuild=args.rebuild)
+        print(json.dumps({**stats, "total": index.active}, ensure_ascii=False))
+    else:
+        index.load()
+        vector = (await embedder.embed([args.text]))[0]
+        for chunk in index.chunks(index.search(vector, args.top_k)):
+            print(f"{chunk.score:.3f} [{chunk.source}] {chunk.text[:200]!r}")
+    index.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Индекс базы знаний")
+    parser.add_argument("--index", default=config.KNOWLEDGE_INDEX_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Инкрементальная сборка индекса")
+    build.add_argument("--docs", default=config.KNOWLEDGE_DOCS_DIR)
+    build.add_argument("--rebuild", action="store_true", help="Пересобрать индекс целиком")
+    query = commands.add_parser("query", help="Поиск фрагментов по вопросу")
+    query.add_argument("text")
+    query.add_argument("--top-k", type=int, default=config.KNOWLEDGE_TOP_K)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -1,9 +1,14 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.routing import APIRouter
 
 from backend.api.v1.router import router_v1
+from backend.quotas import QuotaExceededError
+from backend.telemetry import TraceIdMiddleware
+import backend.utils as state
 from backend.utils import lifespan
+from shared.metrics import registry, CONTENT_TYPE
 
 
 app = FastAPI(
@@ -20,25 +25,60 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
+app.add_middleware(TraceIdMiddleware)
 
 app.include_router(router_v1)
 
 
+@app.exception_handler(QuotaExceededError)
+async def quota_exceeded_handler(request: Request, exc: QuotaExceededError):
+    """429 с причиной и временем до повтора: бот показывает его пользователю"""
+    retry_after = max(1, round(exc.retry_after))
+    return JSONResponse(
+        {"detail": "Quota exceeded", "reason": exc.reason, "retry_after": retry_after},
+        status_code=429,
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "ai-backend"}
 
 
+@app.get("/live")
+async def liveness():
+    """Liveness: процесс отвечает, цикл событий не заблокирован"""
+    return {"status": "alive"}
+
+
+@app.get("/ready")
+async def readiness():
+    """Readiness: пул БД выдает соединение, модель не сбоит подряд, процесс не завершается"""
+    if state.db_manager is None or state.ai_agent is None:
+        return JSONResponse({"status": "starting"}, status_code=503)
+
+    database = await state.db_manager.check()
+    llm = state.ai_agent.health()
+    ready = database["ok"] and llm["healthy"] and not state.draining
+    body = {
+        "status": "ready" if ready else ("draining" if state.draining else "not_ready"),
+        "database": database,
+        "llm": llm
+    }
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
+
 
 if __name__ == "__main__":
-    import uvicorn
-
-    uvicorn.run(
-        "backend.main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
+    from backend.server import main
+
+    main()
@@ -0,0 +1,367 @@
+import asyncpg
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import Awaitable, Callable, List, Optional, Union
+
+from shared.config import config
+from .search import SEARCH_TS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock: миграции нескольких процессов выполняются по очереди
+MIGRATION_LOCK_ID = 0x6D696772
+
+PARTITION_PREFIX = "conversations_p"
+
+
+def month_start(value: Union[date, datetime]) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    """Имя месячной партиции conversations, например conversations_p202610"""
+    return f"{PARTITION_PREFIX}{month.year:04d}{month.month:02d}"
+
+
+def parse_partition_month(name: str) -> Optional[date]:
+    """Месяц партиции по ее имени, None для партиций не из этой схемы"""
+    suffix = name[len(PARTITION_PREFIX):]
+    if not name.startswith(PARTITION_PREFIX) or len(suffix) != 6 or not suffix.isdigit():
+        return None
+    return date(int(suffix[:4]), int(suffix[4:]), 1)
+
+
+async def create_partition(conn, month: date) -> bool:
+    """Создание месячной партиции; False, если она уже есть"""
+    name = partition_name(month)
+    if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name):
+        return False
+    await conn.execute(f"""
+        CREATE TABLE {name} PARTITION OF conversations
+        FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')
+    """)
+    logger.info(f"Created partition {name}")
+    return True
+
+
+async def ensure_partitions(conn, first: date, last: date) -> List[str]:
+    """Партиции для месяцев от first до last включительно"""
+    created = []
+    month = month_start(first)
+    while month <= last:
+        if await create_partition(conn, month):
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+# Агрегаты статистики поддерживаются триггерами уровня оператора: одно обновление
+# на INSERT/COPY пачки, а /stats читает готовые значения вместо COUNT по всей таблице.
+# usage_totals и usage_users отражают текущее содержимое conversations,
+# почасовые и дневные ряды - историю активности (очистка разговора их не уменьшает).
+USAGE_ROLLUP_SQL = """
+    CREATE TABLE IF NOT EXISTS usage_totals (
+        id SMALLINT PRIMARY KEY CHECK (id = 1),
+        total_messages BIGINT NOT NULL,
+        unique_users BIGINT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS usage_users (
+        user_id BIGINT PRIMARY KEY,
+        message_count BIGINT NOT NULL,
+        last_message_at TIMESTAMP NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS usage_hourly (
+        hour TIMESTAMP PRIMARY KEY,
+        message_count BIGINT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS usage_daily_users (
+        day DATE NOT NULL,
+        user_id BIGINT NOT NULL,
+        PRIMARY KEY (day, user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS usage_daily (
+        day DATE PRIMARY KEY,
+        active_users BIGINT NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION usage_rollup_insert() RETURNS trigger AS $$
+    DECLARE
+        new_users BIGINT;
+    BEGIN
+        INSERT INTO usage_hourly (hour, message_count)
+        SELECT date_trunc('hour', created_at), COUNT(*) FROM new_rows GROUP BY 1
+        ON CONFLICT (hour) DO UPDATE
+        SET message_count = usage_hourly.message_count + EXCLUDED.message_count;
+
+        WITH first_today AS (
+            INSERT INTO usage_daily_users (day, user_id)
+            SELECT DISTINCT created_at::date, user_id FROM new_rows
+            ON CONFLICT DO NOTHING
+            RETURNING day
+        )
+        INSERT INTO usage_daily (day, active_users)
+        SELECT day, COUNT(*) FROM first_today GROUP BY day
+        ON CONFLICT (day) DO UPDATE
+        SET active_users = usage_daily.active_users + EXCLUDED.active_users;
+
+        WITH upserted AS (
+            INSERT INTO usage_users (user_id, message_count, last_message_at)
+            SELECT user_id, COUNT(*), MAX(created_at) FROM new_rows GROUP BY user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET message_count = usage_users.message_count + EXCLUDED.message_count,
+                last_message_at = GREATEST(usage_users.last_message_at, EXCLUDED.last_message_at)
+            RETURNING (xmax = 0) AS created
+        )
+        SELECT COUNT(*) FILTER (WHERE created) INTO new_users FROM upserted;
+
+        UPDATE usage_totals
+        SET total_messages = total_messages + (SELECT COUNT(*) FROM new_rows),
+            unique_users = unique_users + new_users
+        WHERE id = 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION usage_rollup_delete() RETURNS trigger AS $$
+    BEGIN
+        PERFORM usage_forget_messages(
+            ARRAY(SELECT user_id FROM old_rows GROUP BY user_id ORDER BY user_id),
+            ARRAY(SELECT COUNT(*) FROM old_rows GROUP BY user_id ORDER BY user_id)
+        );
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- Вычитание удаленных сообщений из агрегатов (DELETE и удаление партиций)
+    CREATE OR REPLACE FUNCTION usage_forget_messages(user_ids BIGINT[], counts BIGINT[]) RETURNS void AS $$
+    DECLARE
+        gone_users BIGINT;
+    BEGIN
+        UPDATE usage_users u
+        SET message_count = u.message_count - removed.message_count
+        FROM unnest(user_ids, counts) AS removed(user_id, message_count)
+        WHERE u.user_id = removed.user_id;
+
+        DELETE FROM usage_users
+        WHERE message_count <= 0 AND user_id = ANY(user_ids);
+        GET DIAGNOSTICS gone_users = ROW_COUNT;
+
+        UPDATE usage_totals
+        SET total_messages = total_messages - (SELECT COALESCE(SUM(c), 0) FROM unnest(counts) AS c),
+            unique_users = unique_users - gone_users
+        WHERE id = 1;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+USAGE_TRIGGERS_SQL = """
+    CREATE TRIGGER conversations_usage_insert
+    AFTER INSERT ON conversations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION usage_rollup_insert();
+
+    CREATE TRIGGER conversations_usage_delete
+    AFTER DELETE ON conversations
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION usage_rollup_delete();
+"""
+
+# Однократное заполнение агрегатов по уже накопленной истории
+USAGE_BACKFILL_SQL = """
+    INSERT INTO usage_users (user_id, message_count, last_message_at)
+    SELECT user_id, COUNT(*), MAX(created_at) FROM conversations GROUP BY user_id;
+
+    INSERT INTO usage_hourly (hour, message_count)
+    SELECT date_trunc('hour', created_at), COUNT(*) FROM conversations GROUP BY 1;
+
+    INSERT INTO usage_daily_users (day, user_id)
+    SELECT DISTINCT created_at::date, user_id FROM conversations;
+
+    INSERT INTO usage_daily (day, active_users)
+    SELECT day, COUNT(*) FROM usage_daily_users GROUP BY day;
+
+    INSERT INTO usage_totals (id, total_messages, unique_users)
+    SELECT 1, COALESCE(SUM(message_count), 0), COUNT(*) FROM usage_users;
+"""
+
+
+async def _initial_schema(conn):
+    # Базовая схема; на существующих БД таблицы уже есть и остаются как были
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username VARCHAR(255),
+            user_message TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_id
+        ON conversations(user_id);
+
+        CREATE INDEX IF NOT EXISTS idx_conversations_created_at
+        ON conversations(created_at);
+
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id BIGINT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_until TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+
+async def _usage_rollups(conn):
+    # Блокирует запись на время заполнения агрегатов по истории
+    await conn.execute("LOCK TABLE conversations IN SHARE ROW EXCLUSIVE MODE")
+    await conn.execute(USAGE_ROLLUP_SQL)
+    await conn.execute("""
+        DROP TRIGGER IF EXISTS conversations_usage_insert ON conversations;
+        DROP TRIGGER IF EXISTS conversations_usage_delete ON conversations;
+    """)
+    await conn.execute(USAGE_TRIGGERS_SQL)
+    if await conn.fetchval("SELECT NOT EXISTS (SELECT 1 FROM usage_totals)"):
+        await conn.execute(USAGE_BACKFILL_SQL)
+        logger.info("Usage rollups backfilled from conversations")
+
+
+async def _partition_conversations(conn):
+    """Перевод conversations на месячные партиции по created_at"""
+    await conn.execute("LOCK TABLE conversations IN ACCESS EXCLUSIVE MODE")
+    await conn.execute("""
+        DROP TRIGGER IF EXISTS conversations_usage_insert ON conversations;
+        DROP TRIGGER IF EXISTS conversations_usage_delete ON conversations;
+        ALTER TABLE conversations RENAME TO conversations_legacy;
+        ALTER SEQUENCE conversations_id_seq OWNED BY NONE;
+        ALTER SEQUENCE conversations_id_seq AS BIGINT;
+
+        CREATE TABLE conversations (
+            id BIGINT NOT NULL DEFAULT nextval('conversations_id_seq'),
+            user_id BIGINT NOT NULL,
+            username VARCHAR(255),
+            user_message TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'UTC'),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+
+        -- Страховка для строк вне созданных заранее партиций
+        CREATE TABLE conversations_default PARTITION OF conversations DEFAULT;
+
+        -- История пользователя читается одним проходом по индексу, в порядке ключа пагинации
+        CREATE INDEX idx_conversations_user_created
+        ON conversations (user_id, created_at DESC, id DESC);
+    """)
+
+    bounds = await conn.fetchrow("""
+        SELECT MIN(created_at) AS first, MAX(created_at) AS last FROM conversations_legacy
+    """)
+    current = month_start(datetime.now(timezone.utc))
+    first = month_start(bounds["first"]) if bounds["first"] else current
+    last = max(month_start(bounds["last"]) if bounds["last"] else current, current)
+    await ensure_partitions(conn, first, add_months(last, config.CONVERSATION_PARTITIONS_AHEAD))
+
+    # Агрегаты уже учитывают эти строки, поэтому триггеры создаются после переноса
+    await conn.execute("""
+        INSERT INTO conversations (id, user_id, username, user_message, ai_response, created_at)
+        SELECT id, user_id, username, user_message, ai_response,
+               COALESCE(created_at, NOW() AT TIME ZONE 'UTC')
+        FROM conversations_legacy;
+
+        DROP TABLE conversations_legacy;
+        ALTER SEQUENCE conversations_id_seq OWNED BY conversations.id;
+    """)
+    await conn.execute(USAGE_TRIGGERS_SQL)
+
+
+async def _conversation_search(conn):
+    """Полнотекстовый индекс по сообщениям: вектор считается Postgres при вставке"""
+    # Добавление STORED-колонки переписывает партиции под ACCESS EXCLUSIVE
+    await conn.execute(f"""
+        ALTER TABLE conversations
+        ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            to_tsvector('{SEARCH_TS_CONFIG}', user_message || ' ' || ai_response)
+        ) STORED
+    """)
+    try:
+        # С btree_gin поиск ограничивается пользователем внутри одного GIN-индекса
+        async with conn.transaction():
+            await conn.execute("""
+                CREATE EXTENSION IF NOT EXISTS btree_gin;
+                CREATE INDEX IF NOT EXISTS idx_conversations_search
+                ON conversations USING GIN (user_id, search_vector);
+            """)
+    except asyncpg.PostgresError as e:
+        logger.warning(f"btree_gin is unavailable, indexing search_vector alone: {e}")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conversations_search
+            ON conversations USING GIN (search_vector)
+        """)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[..., Awaitable[None]]
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "initial_schema", _initial_schema),
+    Migration(2, "usage_rollups", _usage_rollups),
+    Migration(3, "partition_conversations", _partition_conversations),
+    Migration(4, "conversation_search", _conversation_search),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def schema_version(conn) -> int:
+    """Последняя примененная версия схемы, 0 - если миграций еще не было"""
+    # Таблица в запросе разрешается при разборе, поэтому ее наличие проверяется отдельно
+    if not await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+
+
+async def migrate(conn) -> List[int]:
+    """Применение недостающих миграций, возвращает их версии"""
+    # Быстрый путь при перезапуске: схема актуальна, ни DDL, ни advisory lock не нужны
+    if await schema_version(conn) >= LATEST_VERSION:
+        return []
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    applied = []
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+        done = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            logger.info(f"Applying migration {migration.version}: {migration.name}")
+            await migration.apply(conn)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                migration.version, migration.name
+            )
+            applied.append(migration.version)
+    return applied
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import logging
+import math
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, AsyncIterator, Tuple, Type
+
+from shared.config import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Completion:
+    text: str
+    usage: Dict[str, int] = field(default_factory=dict)
+
+
+class LLMProvider:
+    """Провайдер языковой модели"""
+
+    name = "base"
+    # Ошибки, после которых запрос можно безопасно повторить
+    retryable_errors: Tuple[Type[BaseException], ...] = (asyncio.TimeoutError,)
+
+    async def complete(self, model: str, messages: List[Dict[str, str]], **params) -> Completion:
+        raise NotImplementedError
+
+    def stream(self, model: str, messages: List[Dict[str, str]],
+               usage: Optional[Dict[str, int]] = None, **params) -> AsyncIterator[str]:
+        """Фрагменты ответа; usage, если передан, заполняется расходом токенов в конце потока"""
+        raise NotImplementedError
+
+    async def embed(self, model: str, text: str) -> List[float]:
+        raise NotImplementedError
+
+    async def embed_many(self, model: str, texts: List[str]) -> List[List[float]]:
+        """Эмбеддинги пачки текстов; провайдеры с пакетным API переопределяют"""
+        return list(await asyncio.gather(*(self.embed(model, text) for text in texts)))
+
+    async def close(self):
+        pass
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI и совместимые с ним endpoints (base_url).
+
+    Пакет openai импортируется, а клиент создается при первом запросе: запуск
+    процесса и импорт в тестах не платят за это и не требуют ключа.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str] = None, timeout: float = 60.0):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+        self._retryable_errors: Optional[Tuple[Type[BaseException], ...]] = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import openai
+
+            if not self.api_key:
+                raise ValueError("OPENAI_API_KEY is required")
+            # Повторы и таймауты выполняет AIAgent, поэтому встроенные повторы клиента отключены
+            self._client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                timeout=self.timeout,
+                max_retries=0
+            )
+        return self._client
+
+    @property
+    def retryable_errors(self) -> Tuple[Type[BaseException], ...]:
+        if self._retryable_errors is None:
+            import openai
+
+            self._retryable_errors = (
+                asyncio.TimeoutError,
+                openai.APIConnectionError,
+                openai.RateLimitError,
+                openai.InternalServerError
+            )
+        return self._retryable_errors
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+    @staticmethod
+    def _usage(usage) -> Dict[str, int]:
+        if usage is None:
+            return {}
+        result = {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens
+        }
+        # Токены промпта, прочитанные из кеша префиксов на стороне OpenAI
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached = details.get("cached_tokens")
+        else:
+            cached = getattr(details, "cached_tokens", None)
+        if cached is not None:
+            result["cached_tokens"] = cached
+        return result
+
+    async def complete(self, model: str, messages: List[Dict[str, str]], **params) -> Completion:
+        response = await self.client.chat.completions.create(model=model, messages=messages, **params)
+        return Completion(
+            text=(response.choices[0].message.content or "").strip(),
+            usage=self._usage(response.usage)
+        )
+
+    async def stream(self, model: str, messages: List[Dict[str, str]],
+                     usage: Optional[Dict[str, int]] = None, **params) -> AsyncIterator[str]:
+        if usage is not None and config.LLM_STREAM_USAGE:
+            # Расход токенов приходит последним фрагментом без choices
+            params["extra_body"] = {**params.get("extra_body", {}), "stream_options": {"include_usage": True}}
+        stream = await self.client.chat.completions.create(
+            model=model, messages=messages, stream=True, **params
+        )
+        async for chunk in stream:
+            if usage is not None and getattr(chunk, "usage", None) is not None:
+                usage.update(self._usage(chunk.usage))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+    async def embed(self, model: str, text: str) -> List[float]:
+        response = await self.client.embeddings.create(model=model, input=text)
+        return response.data[0].embedding
+
+    async def embed_many(self, model: str, texts: List[str]) -> List[List[float]]:
+        response = await self.client.embeddings.create(model=model, input=texts)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class MockProvider(LLMProvider):
+    """Детерминированная локальная модель для нагрузочного тестирования без OpenAI"""
+
+    name = "mock"
+    _vocabulary = (
+        "python", "функция", "класс", "asyncio", "список", "кортеж", "декоратор", "пример",
+        "код", "ошибка", "тест", "модуль", "данные", "запрос", "ответ", "контекст"
+    )
+
+    def __init__(self, latency: float = 0.2, tokens_per_second: float = 50.0,
+                 response_tokens: int = 60, embedding_size: int = 256):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.embedding_size = embedding_size
+
+    def _reply_words(self, messages: List[Dict[str, str]], max_tokens: Optional[int]) -> List[str]:
+        digest = hashlib.sha256(messages[-1]["content"].encode()).digest()
+        count = min(self.response_tokens, max_tokens or self.response_tokens)
+        return [self._vocabulary[digest[i % len(digest)] % len(self._vocabulary)] for i in range(count)]
+
+    def _token_delay(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    async def complete(self, model: str, messages: List[Dict[str, str]], **params) -> Completion:
+        words = self._reply_words(messages, params.get("max_tokens"))
+        await asyncio.sleep(self.latency + len(words) * self._token_delay())
+        prompt_tokens = sum(len(m["content"]) // 4 + 1 for m in messages)
+        return Completion(
+            text=" ".join(words),
+            usage={"prompt_tokens": prompt_tokens, "completion_tokens": len(words)}
+        )
+
+    async def stream(self, model: str, messages: List[Dict[str, str]],
+                     usage: Optional[Dict[str, int]] = None, **params) -> AsyncIterator[str]:
+        words = self._reply_words(messages, params.get("max_tokens"))
+        await asyncio.sleep(self.latency)
+        for index, word in enumerate(words):
+            await asyncio.sleep(self._token_delay())
+            yield word if index == 0 else f" {word}"
+        if usage is not None:
+            usage.update(prompt_tokens=sum(len(m["content"]) // 4 + 1 for m in messages),
+                         completion_tokens=len(words))
+
+    async def embed(self, model: str, text: str) -> List[float]:
+        # Хеширование слов в фиксированное пространство
+        vector = [0.0] * self.embedding_size
+        for word in text.lower().split():
+            digest = hashlib.md5(word.encode()).digest()
+            index = int.from_bytes(digest[:4], "little") % self.embedding_size
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+
+def create_provider() -> LLMProvider:
+    """Провайдер по LLM_PROVIDER: openai или mock"""
+    name = config.LLM_PROVIDER.lower()
+    if name == "mock":
+        logger.info("LLM provider: mock")
+        return MockProvider(
+            latency=config.MOCK_LLM_LATENCY,
+            tokens_per_second=config.MOCK_LLM_TOKENS_PER_SECOND,
+            response_tokens=config.MOCK_LLM_RESPONSE_TOKENS
+        )
+    if name != "openai":
+        raise ValueError(f"Unknown LLM_PROVIDER: {config.LLM_PROVIDER}")
+
+    logger.info(f"LLM provider: openai ({config.OPENAI_BASE_URL or 'api.openai.com'})")
+    return OpenAIProvider(
+        api_key=config.OPENAI_API_KEY,
+        base_url=config.OPENAI_BASE_URL,
+        timeout=config.LLM_TIMEOUT
+    )
@@ -0,0 +1,269 @@
+import time
+import uuid
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from shared.config import config
+from shared.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+QUOTA_REJECTIONS = registry.counter(
+    "quota_rejections_total", "Запросы, отклоненные лимитами пользователя", ["reason"]
+)
+
+# Скользящее окно в Redis: проверка и запись одной атомарной операцией
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call("zremrangebyscore", KEYS[1], "-inf", now - window)
+local count = redis.call("zcard", KEYS[1])
+if count >= limit then
+    local oldest = redis.call("zrange", KEYS[1], 0, 0, "WITHSCORES")
+    return {0, tostring(tonumber(oldest[2]) + window - now)}
+end
+redis.call("zadd", KEYS[1], now, ARGV[4])
+redis.call("pexpire", KEYS[1], math.ceil(window * 1000))
+return {1, "0"}
+"""
+
+
+class QuotaExceededError(Exception):
+    """Пользователь исчерпал лимит запросов или дневной бюджет токенов"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Quota exceeded: {reason}, retry after {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def utc_day(now: Optional[float] = None) -> str:
+    return datetime.fromtimestamp(now if now is not None else time.time(), timezone.utc).strftime("%Y-%m-%d")
+
+
+def seconds_until_next_day(now: Optional[float] = None) -> float:
+    current = datetime.fromtimestamp(now if now is not None else time.time(), timezone.utc)
+    tomorrow = (current + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (tomorrow - current).total_seconds()
+
+
+class QuotaStore:
+    """Счетчики лимитов пользователей"""
+
+    async def hit(self, user_id: int, window: float, limit: int) -> Tuple[bool, float]:
+        """Учет запроса в скользящем окне: (разрешен, через сколько секунд повторить)"""
+        raise NotImplementedError
+
+    async def window_count(self, user_id: int, window: float) -> int:
+        raise NotImplementedError
+
+    async def add_tokens(self, user_id: int, day: str, tokens: int):
+        raise NotImplementedError
+
+    async def tokens(self, user_id: int, day: str) -> int:
+        raise NotImplementedError
+
+    async def reset(self, user_id: int, day: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryQuotaStore(QuotaStore):
+    """Лимиты в памяти процесса: каждый воркер backend считает свои запросы"""
+
+    backend = "memory"
+
+    def __init__(self, max_users: int = 100000):
+        self.max_users = max_users
+        self._hits: "OrderedDict[int, Deque[float]]" = OrderedDict()
+        # Счетчики токенов по дням: {день: {пользователь: токены}}, хранятся только текущие дни
+        self._tokens: Dict[str, Dict[int, int]] = {}
+
+    def _window(self, user_id: int, window: float, now: float) -> Deque[float]:
+        hits = self._hits.get(user_id)
+        if hits is None:
+            hits = self._hits[user_id] = deque()
+            while len(self._hits) > self.max_users:
+                self._hits.popitem(last=False)
+        else:
+            self._hits.move_to_end(user_id)
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        return hits
+
+    async def hit(self, user_id: int, window: float, limit: int) -> Tuple[bool, float]:
+        now = time.time()
+        hits = self._window(user_id, window, now)
+        if len(hits) >= limit:
+            return False, hits[0] + window - now
+        hits.append(now)
+        return True, 0.0
+
+    async def window_count(self, user_id: int, window: float) -> int:
+        return len(self._window(user_id, window, time.time()))
+
+    async def add_tokens(self, user_id: int, day: str, tokens: int):
+        counters = self._tokens.get(day)
+        if counters is None:
+            counters = self._tokens[day] = {}
+            # С началом нового дня счетчики прошлых дней удаляются целиком (дни - строки YYYY-MM-DD)
+            for old in [key for key in self._tokens if key < day]:
+                del self._tokens[old]
+        counters[user_id] = counters.get(user_id, 0) + tokens
+
+    async def tokens(self, user_id: int, day: str) -> int:
+        return self._tokens.get(day, {}).get(user_id, 0)
+
+    async def reset(self, user_id: int, day: str):
+        self._hits.pop(user_id, None)
+        self._tokens.get(day, {}).pop(user_id, None)
+
+
+class RedisQuotaStore(QuotaStore):
+    """Лимиты в Redis, общие для всех воркеров и реплик backend"""
+
+    backend = "redis"
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._sliding_window = redis.register_script(SLIDING_WINDOW_SCRIPT)
+
+    @staticmethod
+    def _hits_key(user_id: int) -> str:
+        return f"quota:hits:{user_id}"
+
+    @staticmethod
+    def _tokens_key(user_id: int, day: str) -> str:
+        return f"quota:tokens:{user_id}:{day}"
+
+    async def hit(self, user_id: int, window: float, limit: int) -> Tuple[bool, float]:
+        now = time.time()
+        allowed, retry_after = await self._sliding_window(
+            keys=[self._hits_key(user_id)],
+            args=[now, window, limit, uuid.uuid4().hex]
+        )
+        return bool(int(allowed)), float(retry_after)
+
+    async def window_count(self, user_id: int, window: float) -> int:
+        return await self.redis.zcount(self._hits_key(user_id), time.time() - window, "+inf")
+
+    async def add_tokens(self, user_id: int, day: str, tokens: int):
+        key = self._tokens_key(user_id, day)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incrby(key, tokens)
+            pipe.expire(key, 2 * 86400)
+            await pipe.execute()
+
+    async def tokens(self, user_id: int, day: str) -> int:
+        return int(await self.redis.get(self._tokens_key(user_id, day)) or 0)
+
+    async def reset(self, user_id: int, day: str):
+        await self.redis.delete(self._hits_key(user_id), self._tokens_key(user_id, day))
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+async def create_quota_store() -> QuotaStore:
+    """Хранилище лимитов по QUOTA_STORE (redis или memory)"""
+    if config.QUOTA_STORE.lower() == "redis":
+        try:
+            import redis.asyncio as aioredis
+
+            redis = aioredis.from_url(config.REDIS_URL, socket_connect_timeout=2)
+            await redis.ping()
+            logger.info("Quota store: redis")
+            return RedisQuotaStore(redis)
+        except Exception as e:
+            logger.warning(f"Redis is unavailable for quota store, using in-process store: {e}")
+
+    logger.info("Quota store: memory")
+    return MemoryQuotaStore()
+
+
+class QuotaManager:
+    """Лимиты пользователя: запросы в скользящем окне и дневной бюджет токенов модели.
+
+    Проверка выполняется до истории, лимитера и БД, поэтому отказ стоит один
+    поход в хранилище лимитов и не занимает ресурсы остальных пользователей.
+    Токены учитываются по usage ответа модели после запроса.
+    """
+
+    def __init__(self, store: QuotaStore, requests: int, window: float, daily_tokens: int):
+        self.store = store
+        self.requests = requests
+        self.window = window
+        self.daily_tokens = daily_tokens
+        self.allowed = 0
+        self.rejected = {"requests": 0, "tokens": 0}
+
+    async def check(self, user_id: int):
+        """Учет запроса; QuotaExceededError, если лимит исчерпан"""
+        try:
+            reason, retry_after = await self._exceeded(user_id)
+        except Exception as e:
+            # Недоступное хранилище лимитов не должно останавливать чат
+            logger.error(f"Quota check failed for user {user_id}, allowing request: {e}")
+            return
+        if reason:
+            self._reject(reason)
+            raise QuotaExceededError(reason, retry_after)
+        self.allowed += 1
+
+    async def _exceeded(self, user_id: int) -> Tuple[Optional[str], float]:
+        if self.daily_tokens > 0 and await self.store.tokens(user_id, utc_day()) >= self.daily_tokens:
+            return "tokens", seconds_until_next_day()
+        if self.requests > 0:
+            allowed, retry_after = await self.store.hit(user_id, self.window, self.requests)
+            if not allowed:
+                return "requests", retry_after
+        return None, 0.0
+
+    def _reject(self, reason: str):
+        self.rejected[reason] += 1
+        QUOTA_REJECTIONS.inc(reason=reason)
+
+    async def record_usage(self, user_id: int, usage: Dict[str, int]):
+        """Расход токенов запроса к модели в дневной бюджет пользователя"""
+        tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        if tokens <= 0:
+            return
+        try:
+            await self.store.add_tokens(user_id, utc_day(), tokens)
+        except Exception as e:
+            logger.error(f"Failed to record token usage for user {user_id}: {e}")
+
+    async def status(self, user_id: int) -> Dict[str, Any]:
+        used = await self.store.tokens(user_id, utc_day())
+        return {
+            "user_id": user_id,
+            "requests": {
+                "used": await self.store.window_count(user_id, self.window),
+                "limit": self.requests,
+                "window_seconds": self.window
+            },
+            "tokens": {
+                "used": used,
+                "limit": self.daily_tokens,
+                "remaining": max(0, self.daily_tokens - used) if self.daily_tokens > 0 else None,
+                "resets_in_seconds": round(seconds_until_next_day())
+            }
+        }
+
+    async def reset(self, user_id: int):
+        await self.store.reset(user_id, utc_day())
+
+    async def close(self):
+        await self.store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "store": self.store.backend,
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected)
+        }
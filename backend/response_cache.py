@@ -0,0 +1,187 @@
+import re
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+Embedder = Callable[[str], Awaitable[List[float]]]
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.,;:]+$")
+
+
+def normalize_message(message: str) -> str:
+    """Нормализация вопроса для точного совпадения"""
+    text = _WHITESPACE.sub(" ", message.strip().lower())
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+@dataclass
+class CacheEntry:
+    scope: str
+    response: str
+    latency: float
+    expires_at: float
+
+
+@dataclass
+class CacheLookup:
+    key: str
+    scope: str
+    response: Optional[str] = None
+    vector: Any = field(default=None, repr=False)
+
+
+class ResponseCache:
+    """Кеш ответов на повторяющиеся вопросы: точное совпадение и (опционально) семантическое"""
+
+    def __init__(
+            self,
+            ttl: float,
+            max_entries: int,
+            embed: Optional[Embedder] = None,
+            similarity_threshold: float = 0.95
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+
+        self.np = None
+        if embed is not None:
+            try:
+                import numpy
+                self.np = numpy
+            except ImportError:
+                logger.warning("numpy is not installed, semantic response cache is disabled")
+        # Матрица нормированных эмбеддингов; освобожденные строки обнуляются и переиспользуются
+        self._matrix = None
+        self._row_keys: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._free_rows: List[int] = []
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+
+    @staticmethod
+    def _scope(model: str, system_prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{system_prompt}".encode()).hexdigest()[:16]
+
+    def _get_entry(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        row = self._rows.pop(key, None)
+        if row is not None:
+            self._matrix[row] = 0
+            self._row_keys[row] = None
+            self._free_rows.append(row)
+
+    def _add_vector(self, key: str, vector):
+        row = self._rows.get(key)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = len(self._row_keys)
+                self._row_keys.append(None)
+                if self._matrix is None:
+                    self._matrix = self.np.zeros((16, len(vector)), dtype=self.np.float32)
+                elif row >= len(self._matrix):
+                    grown = self.np.zeros((len(self._matrix) * 2, self._matrix.shape[1]), dtype=self.np.float32)
+                    grown[:len(self._matrix)] = self._matrix
+                    self._matrix = grown
+            self._rows[key] = row
+            self._row_keys[row] = key
+        self._matrix[row] = vector
+
+    def _hit(self, entry: CacheEntry, semantic: bool) -> str:
+        if semantic:
+            self.semantic_hits += 1
+        else:
+            self.exact_hits += 1
+        self.latency_saved += entry.latency
+        return entry.response
+
+    async def lookup(self, message: str, model: str, system_prompt: str) -> CacheLookup:
+        """Поиск ответа; результат передается в store() при промахе"""
+        scope = self._scope(model, system_prompt)
+        key = hashlib.sha256(f"{scope}\0{normalize_message(message)}".encode()).hexdigest()
+        lookup = CacheLookup(key=key, scope=scope)
+
+        entry = self._get_entry(key)
+        if entry is not None:
+            lookup.response = self._hit(entry, semantic=False)
+            return lookup
+
+        if self.np is not None:
+            try:
+                lookup.vector = self._normalize(await self.embed(message))
+                match = self._nearest(lookup.vector, scope)
+                if match is not None:
+                    lookup.response = self._hit(match, semantic=True)
+                    return lookup
+            except Exception as e:
+                logger.error(f"Semantic cache lookup failed: {e}")
+
+        self.misses += 1
+        return lookup
+
+    async def store(self, lookup: CacheLookup, response: str, latency: float):
+        self._entries[lookup.key] = CacheEntry(
+            scope=lookup.scope,
+            response=response,
+            latency=latency,
+            expires_at=time.monotonic() + self.ttl
+        )
+        self._entries.move_to_end(lookup.key)
+        if lookup.vector is not None:
+            self._add_vector(lookup.key, lookup.vector)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _normalize(self, vector: List[float]):
+        array = self.np.asarray(vector, dtype=self.np.float32)
+        norm = self.np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _nearest(self, vector, scope: str) -> Optional[CacheEntry]:
+        """Полный перебор косинусной близости по локальной матрице"""
+        if self._matrix is None:
+            return None
+
+        scores = self._matrix[:len(self._row_keys)] @ vector
+        candidates = self.np.flatnonzero(scores >= self.similarity_threshold)
+        for index in candidates[self.np.argsort(-scores[candidates])]:
+            key = self._row_keys[index]
+            entry = self._get_entry(key) if key is not None else None
+            if entry is not None and entry.scope == scope:
+                return entry
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.semantic_hits
+        total = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "latency_saved_seconds": round(self.latency_saved, 3)
+        }
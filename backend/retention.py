@@ -0,0 +1,205 @@
+import asyncio
+import gzip
+import importlib.util
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from shared.config import config
+from .database import DatabaseManager, utcnow
+from .migrations import add_months, create_partition, month_start, parse_partition_month, partition_name
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock: обслуживание партиций выполняет один процесс за раз
+MAINTENANCE_LOCK_ID = 0x72657465
+
+ARCHIVE_COLUMNS = ["id", "user_id", "username", "user_message", "ai_response", "created_at"]
+
+
+def _json_default(value: Any) -> str:
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+class JsonlArchiveWriter:
+    """Архив партиции в JSONL со сжатием gzip"""
+
+    extension = ".jsonl.gz"
+
+    def __init__(self, path: str):
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+
+    def write(self, rows: List[Dict[str, Any]]):
+        for row in rows:
+            self._file.write(json.dumps(row, ensure_ascii=False, default=_json_default) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetArchiveWriter:
+    """Архив партиции в Parquet (требует pyarrow), пишется группами строк"""
+
+    extension = ".parquet"
+
+    def __init__(self, path: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([
+            ("id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("username", pa.string()),
+            ("user_message", pa.string()),
+            ("ai_response", pa.string()),
+            ("created_at", pa.timestamp("us"))
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema, compression="zstd")
+
+    def write(self, rows: List[Dict[str, Any]]):
+        self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def _archive_writer_class():
+    if config.ARCHIVE_FORMAT == "parquet":
+        if importlib.util.find_spec("pyarrow") is not None:
+            return ParquetArchiveWriter
+        logger.warning("ARCHIVE_FORMAT is parquet but pyarrow is not installed, falling back to JSONL")
+    return JsonlArchiveWriter
+
+
+class RetentionManager:
+    """Обслуживание партиций conversations: создание заранее, архивация и удаление старых"""
+
+    def __init__(self, db_manager: DatabaseManager):
+        self.db_manager = db_manager
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"runs": 0, "partitions_created": 0, "partitions_dropped": 0, "rows_archived": 0}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Partition maintenance failed: {e}")
+            await asyncio.sleep(config.RETENTION_CHECK_INTERVAL)
+
+    async def run_once(self) -> Dict[str, Any]:
+        """Один проход обслуживания; пропускается, если его уже выполняет другой процесс"""
+        async with self.db_manager._acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MAINTENANCE_LOCK_ID):
+                return {"skipped": True}
+            try:
+                created = await self._create_upcoming(conn)
+                dropped = await self._drop_expired(conn) if config.CONVERSATION_RETENTION_DAYS > 0 else []
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", MAINTENANCE_LOCK_ID)
+
+        self.stats["runs"] += 1
+        return {"created": created, "dropped": dropped}
+
+    async def _create_upcoming(self, conn) -> List[str]:
+        current = month_start(utcnow())
+        created = []
+        month = current
+        while month <= add_months(current, config.CONVERSATION_PARTITIONS_AHEAD):
+            try:
+                async with conn.transaction():
+                    if await create_partition(conn, month):
+                        created.append(partition_name(month))
+            except Exception as e:
+                # Например, строки за этот месяц уже лежат в партиции по умолчанию
+                logger.error(f"Failed to create partition for {month:%Y-%m}: {e}")
+            month = add_months(month, 1)
+        self.stats["partitions_created"] += len(created)
+        return created
+
+    async def _expired_partitions(self, conn) -> List[str]:
+        cutoff = (utcnow() - timedelta(days=config.CONVERSATION_RETENTION_DAYS)).date()
+        rows = await conn.fetch("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'conversations'::regclass
+        """)
+        expired = []
+        for row in rows:
+            month = parse_partition_month(row["relname"])
+            # Партиция удаляется, только когда все ее строки старше срока хранения
+            if month is not None and add_months(month, 1) <= cutoff:
+                expired.append(row["relname"])
+        return sorted(expired)
+
+    async def _drop_expired(self, conn) -> List[str]:
+        dropped = []
+        for name in await self._expired_partitions(conn):
+            if config.ARCHIVE_BEFORE_DROP:
+                rows = await self.export_partition(conn, name)
+                self.stats["rows_archived"] += rows
+
+            async with conn.transaction():
+                # DROP TABLE не вызывает триггеры DELETE, поэтому агрегаты уменьшаем явно
+                await conn.execute(f"""
+                    SELECT usage_forget_messages(
+                        ARRAY(SELECT user_id FROM {name} GROUP BY user_id ORDER BY user_id),
+                        ARRAY(SELECT COUNT(*) FROM {name} GROUP BY user_id ORDER BY user_id)
+                    )
+                """)
+                await conn.execute(f"DROP TABLE {name}")
+            dropped.append(name)
+            self.stats["partitions_dropped"] += 1
+            logger.info(f"Dropped expired partition {name}")
+        return dropped
+
+    async def export_partition(self, conn, name: str) -> int:
+        """Потоковая выгрузка партиции в архив: строки читаются курсором, файл пишется в потоке"""
+        os.makedirs(config.ARCHIVE_DIR, exist_ok=True)
+        writer_class = _archive_writer_class()
+        path = os.path.join(config.ARCHIVE_DIR, name + writer_class.extension)
+        tmp_path = path + ".tmp"
+
+        writer = await asyncio.to_thread(writer_class, tmp_path)
+        exported = 0
+        try:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                batch = []
+                async for record in conn.cursor(
+                        f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM {name} ORDER BY id",
+                        prefetch=config.ARCHIVE_BATCH_SIZE
+                ):
+                    batch.append(dict(record))
+                    if len(batch) >= config.ARCHIVE_BATCH_SIZE:
+                        await asyncio.to_thread(writer.write, batch)
+                        exported += len(batch)
+                        batch = []
+                if batch:
+                    await asyncio.to_thread(writer.write, batch)
+                    exported += len(batch)
+        except BaseException:
+            await asyncio.to_thread(writer.close)
+            os.remove(tmp_path)
+            raise
+
+        await asyncio.to_thread(writer.close)
+        os.replace(tmp_path, path)
+        logger.info(f"Archived {exported} rows of {name} to {path}")
+        return exported
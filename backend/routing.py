@@ -0,0 +1,205 @@
+import time
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from shared.config import config
+from shared.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+FENCE = "```"
+
+LLM_ROUTES = registry.counter(
+    "llm_routes_total", "Выбор уровня модели роутером", ["tier", "reason"]
+)
+LLM_TIER_REQUESTS = registry.counter(
+    "llm_tier_requests_total", "Запросы к модели по уровням", ["tier", "status"]
+)
+LLM_TIER_SECONDS = registry.histogram(
+    "llm_tier_seconds", "Длительность запроса к модели по уровням",
+    ["tier"], buckets=(0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+)
+LLM_TIER_TOKENS = registry.counter(
+    "llm_tier_tokens_total", "Токены по уровням модели", ["tier", "type"]
+)
+LLM_TIER_COST = registry.counter(
+    "llm_tier_cost_usd_total", "Оценка стоимости запросов по ценам уровня, USD", ["tier"]
+)
+LLM_TIER_HEALTHY = registry.gauge(
+    "llm_tier_healthy", "Уровень модели укладывается в SLO (1) или разгружается (0)", ["tier"]
+)
+
+
+@dataclass(frozen=True)
+class ModelTier:
+    name: str
+    model: str
+    max_tokens: int
+    timeout: float
+    slo_p95: float  # сек
+    prompt_price: float = 0.0  # USD за 1000 токенов
+    completion_price: float = 0.0
+
+    def cost(self, usage: Dict[str, int]) -> float:
+        return (usage.get("prompt_tokens", 0) * self.prompt_price
+                + usage.get("completion_tokens", 0) * self.completion_price) / 1000
+
+
+class TierWindow:
+    """Наблюдения уровня за скользящее окно: p95 длительности и доля ошибок"""
+
+    def __init__(self, window: float, max_samples: int = 1000):
+        self.window = window
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=max_samples)
+
+    def add(self, seconds: float, ok: bool):
+        self._samples.append((time.monotonic(), seconds, ok))
+
+    def _expire(self):
+        horizon = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < horizon:
+            self._samples.popleft()
+
+    def summary(self) -> Dict[str, Any]:
+        self._expire()
+        latencies = sorted(seconds for _, seconds, ok in self._samples if ok)
+        errors = sum(1 for _, _, ok in self._samples if not ok)
+        count = len(self._samples)
+        return {
+            "samples": count,
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+            "error_rate": errors / count if count else 0.0
+        }
+
+
+def default_tiers() -> List[ModelTier]:
+    """Уровни из настроек: быстрый (ROUTER_FAST_MODEL, если задан) и основной (OPENAI_MODEL)"""
+    tiers = []
+    if config.ROUTER_FAST_MODEL:
+        tiers.append(ModelTier(
+            name="fast",
+            model=config.ROUTER_FAST_MODEL,
+            max_tokens=config.ROUTER_FAST_MAX_TOKENS,
+            timeout=config.ROUTER_FAST_TIMEOUT,
+            slo_p95=config.ROUTER_FAST_SLO_P95,
+            prompt_price=config.ROUTER_FAST_PROMPT_PRICE,
+            completion_price=config.ROUTER_FAST_COMPLETION_PRICE
+        ))
+    tiers.append(ModelTier(
+        name="standard",
+        model=config.OPENAI_MODEL,
+        max_tokens=config.LLM_MAX_TOKENS,
+        timeout=config.LLM_TIMEOUT,
+        slo_p95=config.LLM_SLO_P95,
+        prompt_price=config.LLM_PROMPT_PRICE,
+        completion_price=config.LLM_COMPLETION_PRICE
+    ))
+    return tiers
+
+
+class ModelRouter:
+    """Выбор уровня модели по дешевым локальным признакам запроса.
+
+    Короткий вопрос без кода и без длинной истории идет на быстрый уровень,
+    остальное - на основной. Если уровень за окно наблюдений выходит за SLO
+    (p95 длительности или доля ошибок), запросы уходят на соседний уровень,
+    пока старые наблюдения не выйдут из окна.
+    """
+
+    def __init__(self, tiers: List[ModelTier], simple_max_chars: int, simple_max_history: int,
+                 window: float, min_samples: int, max_error_rate: float):
+        self.tiers = {tier.name: tier for tier in tiers}
+        self.order = [tier.name for tier in tiers]
+        self.default = self.tiers["standard"] if "standard" in self.tiers else tiers[-1]
+        self.simple_max_chars = simple_max_chars
+        self.simple_max_history = simple_max_history
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self._windows = {name: TierWindow(window) for name in self.tiers}
+        self.routes: Dict[str, int] = {}
+        self.cost = {name: 0.0 for name in self.tiers}
+        for name in self.tiers:
+            LLM_TIER_HEALTHY.set_function(lambda name=name: float(self.healthy(name)), tier=name)
+
+    def classify(self, message: str, history_size: int) -> str:
+        """Уровень по признакам запроса, без учета SLO"""
+        if "fast" not in self.tiers:
+            return self.default.name
+        simple = (
+            len(message) <= self.simple_max_chars
+            and FENCE not in message
+            and history_size <= self.simple_max_history
+        )
+        return "fast" if simple else self.default.name
+
+    def healthy(self, name: str) -> bool:
+        summary = self._windows[name].summary()
+        if summary["samples"] < self.min_samples:
+            return True
+        if summary["error_rate"] > self.max_error_rate:
+            return False
+        return summary["p95"] is None or summary["p95"] <= self.tiers[name].slo_p95
+
+    def choose(self, message: str, history_size: int) -> Tuple[ModelTier, str]:
+        """Уровень и причина выбора без учета в статистике маршрутов"""
+        name = self.classify(message, history_size)
+        reason = "simple" if name == "fast" else "complex"
+        if len(self.tiers) > 1 and not self.healthy(name):
+            # Ближайший уровень в SLO; если таких нет, остается выбранный
+            index = self.order.index(name)
+            candidates = sorted(
+                (other for other in self.order if other != name),
+                key=lambda other: abs(self.order.index(other) - index)
+            )
+            fallback = next((other for other in candidates if self.healthy(other)), None)
+            if fallback is not None:
+                name, reason = fallback, "fallback"
+        return self.tiers[name], reason
+
+    def record(self, tier: ModelTier, reason: str):
+        """Учет маршрута запроса, который действительно ушел в модель"""
+        self.routes[f"{tier.name}:{reason}"] = self.routes.get(f"{tier.name}:{reason}", 0) + 1
+        LLM_ROUTES.inc(tier=tier.name, reason=reason)
+
+    def observe(self, tier: ModelTier, seconds: float, ok: bool, usage: Optional[Dict[str, int]] = None):
+        """Результат запроса к уровню: длительность, ошибка и стоимость по usage"""
+        self._windows[tier.name].add(seconds, ok)
+        LLM_TIER_REQUESTS.inc(tier=tier.name, status="ok" if ok else "error")
+        if ok:
+            LLM_TIER_SECONDS.observe(seconds, tier=tier.name)
+        if usage:
+            for token_type in ("prompt_tokens", "completion_tokens"):
+                if token_type in usage:
+                    LLM_TIER_TOKENS.inc(usage[token_type], tier=tier.name, type=token_type.split("_")[0])
+            cost = tier.cost(usage)
+            self.cost[tier.name] += cost
+            LLM_TIER_COST.inc(cost, tier=tier.name)
+
+    def stats(self) -> Dict[str, Any]:
+        tiers = {}
+        for name, tier in self.tiers.items():
+            summary = self._windows[name].summary()
+            tiers[name] = {
+                "model": tier.model,
+                "max_tokens": tier.max_tokens,
+                "slo_p95": tier.slo_p95,
+                "p95": round(summary["p95"], 3) if summary["p95"] is not None else None,
+                "error_rate": round(summary["error_rate"], 3),
+                "samples": summary["samples"],
+                "healthy": self.healthy(name),
+                "cost_usd": round(self.cost[name], 6)
+            }
+        return {"tiers": tiers, "routes": dict(self.routes)}
+
+
+def create_model_router() -> ModelRouter:
+    return ModelRouter(
+        default_tiers(),
+        simple_max_chars=config.ROUTER_SIMPLE_MAX_CHARS,
+        simple_max_history=config.ROUTER_SIMPLE_MAX_HISTORY,
+        window=config.ROUTER_SLO_WINDOW,
+        min_samples=config.ROUTER_SLO_MIN_SAMPLES,
+        max_error_rate=config.ROUTER_SLO_ERROR_RATE
+    )
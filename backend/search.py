@@ -0,0 +1,132 @@
+import base64
+import binascii
+import json
+import math
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Конфигурация полнотекстового поиска Postgres: russian стеммирует и русские,
+# и латинские (english_stem) слова
+SEARCH_TS_CONFIG = "russian"
+# Границы совпадений в сниппетах: ответы бота отправляются обычным текстом
+HIGHLIGHT_START = "«"
+HIGHLIGHT_STOP = "»"
+HEADLINE_OPTIONS = (
+    f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, "
+    "MaxWords=30, MinWords=10, MaxFragments=2, FragmentDelimiter=\" … \""
+)
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+SearchKey = Tuple[float, datetime, int]
+
+
+def encode_search_cursor(rank: float, created_at: datetime, row_id: int) -> str:
+    """Непрозрачный курсор по ключу сортировки (rank, created_at, id)"""
+    raw = json.dumps([rank, created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> SearchKey:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        rank, created_at, row_id = json.loads(raw)
+        return float(rank), datetime.fromisoformat(created_at), int(row_id)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def tokenize(text: str) -> List[str]:
+    return [word for word in WORD_RE.findall(text.lower()) if len(word) > 1]
+
+
+def make_snippet(text: str, terms: Set[str], width: int = 200) -> str:
+    """Фрагмент текста вокруг первого совпадения с выделением найденных слов"""
+    words = list(WORD_RE.finditer(text))
+    first = next((match for match in words if match.group().lower() in terms), None)
+    start = max(0, first.start() - width // 3) if first else 0
+    end = min(len(text), start + width)
+    fragment = text[start:end]
+
+    highlighted = WORD_RE.sub(
+        lambda m: f"{HIGHLIGHT_START}{m.group()}{HIGHLIGHT_STOP}" if m.group().lower() in terms else m.group(),
+        fragment
+    )
+    highlighted = " ".join(highlighted.split())
+    return ("… " if start > 0 else "") + highlighted + (" …" if end < len(text) else "")
+
+
+class InvertedIndex:
+    """Инвертированный индекс в памяти: поиск по истории без Postgres (тесты, нагрузочные прогоны).
+
+    Запрос - все слова (AND), ранжирование по BM25 среди сообщений пользователя.
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self._docs: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        self._postings: Dict[int, Dict[str, Dict[int, int]]] = {}
+        self._lengths: Dict[int, Dict[int, int]] = {}
+
+    def add(self, user_id: int, row: Dict[str, Any]):
+        """row: id, created_at (datetime), user_message, ai_response"""
+        tokens = tokenize(f"{row['user_message']} {row['ai_response']}")
+        self._docs.setdefault(user_id, {})[row["id"]] = row
+        self._lengths.setdefault(user_id, {})[row["id"]] = len(tokens)
+        postings = self._postings.setdefault(user_id, {})
+        for token in tokens:
+            counts = postings.setdefault(token, {})
+            counts[row["id"]] = counts.get(row["id"], 0) + 1
+
+    def remove_user(self, user_id: int):
+        self._docs.pop(user_id, None)
+        self._postings.pop(user_id, None)
+        self._lengths.pop(user_id, None)
+
+    def search(self, user_id: int, query: str, limit: int,
+               cursor: Optional[str] = None) -> Dict[str, Any]:
+        after = decode_search_cursor(cursor) if cursor else None
+        terms = list(dict.fromkeys(tokenize(query)))
+        postings = self._postings.get(user_id, {})
+        docs = self._docs.get(user_id, {})
+        lengths = self._lengths.get(user_id, {})
+        if not terms or not docs:
+            return {"results": [], "next_cursor": None}
+
+        matched = set(docs)
+        for term in terms:
+            matched &= set(postings.get(term, ()))
+        average = sum(lengths.values()) / len(lengths)
+
+        scored = []
+        for doc_id in matched:
+            score = 0.0
+            for term in terms:
+                frequency = postings[term][doc_id]
+                idf = math.log(1 + (len(docs) - len(postings[term]) + 0.5) / (len(postings[term]) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths[doc_id] / average)
+                score += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            row = docs[doc_id]
+            scored.append((round(score, 6), row["created_at"], doc_id))
+        scored.sort(reverse=True)
+
+        if after:
+            scored = [key for key in scored if key < after]
+        page, has_more = scored[:limit], len(scored) > limit
+        term_set = set(terms)
+        return {
+            "results": [
+                {
+                    "id": doc_id,
+                    "created_at": created_at.isoformat(),
+                    "rank": rank,
+                    "user_message": docs[doc_id]["user_message"],
+                    "snippet": make_snippet(f"{docs[doc_id]['user_message']}\n{docs[doc_id]['ai_response']}", term_set)
+                }
+                for rank, created_at, doc_id in page
+            ],
+            "next_cursor": encode_search_cursor(*page[-1]) if has_more else None
+        }
@@ -0,0 +1,107 @@
+"""Запуск backend в production: несколько воркеров uvicorn, uvloop/httptools, мягкая остановка.
+
+    python -m backend.server
+"""
+import asyncio
+import importlib.util
+import os
+from typing import List
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+from shared.config import config, logger
+from shared.utils import setup_logging
+
+
+def resolve_workers() -> int:
+    """Число воркеров: BACKEND_WORKERS или, при 0, по числу ядер"""
+    return config.BACKEND_WORKERS if config.BACKEND_WORKERS > 0 else (os.cpu_count() or 1)
+
+
+def shared_state_problems() -> List[str]:
+    """Настройки, с которыми воркеры не видят состояние друг друга"""
+    problems = []
+    if config.USER_LOCK_STORE.lower() != "redis":
+        problems.append("USER_LOCK_STORE=redis (per-user ordering and request dedup)")
+    if config.JOB_STORE.lower() != "redis":
+        problems.append("JOB_STORE=redis (job polling on any worker)")
+    if config.HISTORY_CACHE_BACKEND.lower() == "memory":
+        problems.append("HISTORY_CACHE_BACKEND=redis or none (shared history cache)")
+    if config.WRITE_BEHIND:
+        problems.append("WRITE_BEHIND=false (unwritten turns are visible to their worker only)")
+    return problems
+
+
+def worker_log_file(path: str, workers: int) -> str:
+    """LOG_FILE воркеров: несколько процессов не должны ротировать один файл, у каждого свой"""
+    if workers > 1 and path and "{pid}" not in path:
+        root, ext = os.path.splitext(path)
+        return f"{root}.{{pid}}{ext}"
+    return path
+
+
+class DrainingServer(uvicorn.Server):
+    """Сервер uvicorn, который по сигналу остановки сначала снимает готовность.
+
+    /ready отвечает 503 ("draining") еще до закрытия сокетов, а с
+    SHUTDOWN_DRAIN_DELAY остановка откладывается, чтобы балансировщик успел
+    убрать воркер. Повторный сигнал останавливает сервер сразу.
+    """
+
+    def handle_exit(self, sig, frame):
+        import backend.utils as state
+
+        if state.draining or self.should_exit:
+            super().handle_exit(sig, frame)
+            return
+        state.draining = True
+        logger.info(f"Draining backend worker before shutdown ({config.SHUTDOWN_DRAIN_DELAY}s)")
+        if config.SHUTDOWN_DRAIN_DELAY > 0:
+            asyncio.get_event_loop().call_later(config.SHUTDOWN_DRAIN_DELAY, super().handle_exit, sig, frame)
+        else:
+            super().handle_exit(sig, frame)
+
+
+def main():
+    workers = resolve_workers()
+    problems = shared_state_problems() if workers > 1 else []
+    if problems:
+        setup_logging(config.LOG_LEVEL)
+        logger.error(f"{workers} workers need shared state, set: {'; '.join(problems)}")
+        raise SystemExit(1)
+    # Воркеры читают итоговое число процессов для деления бюджета соединений с БД
+    os.environ["BACKEND_WORKERS"] = str(workers)
+    log_file = worker_log_file(config.LOG_FILE, workers)
+    if log_file != config.LOG_FILE:
+        config.LOG_FILE = os.environ["LOG_FILE"] = log_file
+    setup_logging(config.LOG_LEVEL)
+
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    logger.info(f"Starting backend: {workers} workers, loop={loop}, http={http}")
+
+    server_config = uvicorn.Config(
+        "backend.main:app",
+        host=config.BACKEND_HOST,
+        port=config.BACKEND_PORT,
+        workers=workers,
+        loop=loop,
+        http=http,
+        # Незавершенные запросы (в том числе потоковые ответы модели) дорабатывают до выхода
+        timeout_graceful_shutdown=config.SHUTDOWN_GRACE_PERIOD,
+        proxy_headers=True,
+        log_level=config.LOG_LEVEL.lower(),
+        # Свои обработчики uvicorn не ставит: его логи идут через очередь shared.log
+        log_config=None
+    )
+    # uvicorn.run без своего сервера: DrainingServer снимает готовность по SIGTERM
+    server = DrainingServer(server_config)
+    if workers > 1:
+        Multiprocess(server_config, target=server.run, sockets=[server_config.bind_socket()]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from shared.config import config
+from shared.metrics import registry
+from shared.utils import trace_id_var
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "x-request-id"
+
+CHAT_REQUESTS = registry.counter(
+    "chat_requests_total", "Запросы к endpoints чата", ["endpoint", "status"]
+)
+CHAT_STAGE_SECONDS = registry.histogram(
+    "chat_stage_seconds",
+    "Длительность этапов обработки сообщения (history_fetch, prompt_build, llm, db_save)",
+    ["stage"]
+)
+LLM_TIME_TO_FIRST_TOKEN = registry.histogram(
+    "llm_time_to_first_token_seconds", "Время до первого фрагмента ответа модели"
+)
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "Токены по данным usage ответа модели", ["type"]
+)
+DB_POOL_ACQUIRE_SECONDS = registry.histogram(
+    "db_pool_acquire_seconds", "Ожидание соединения из пула asyncpg",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+DB_POOL_CONNECTIONS = registry.gauge(
+    "db_pool_connections", "Соединения пула asyncpg", ["state"]
+)
+DB_WRITE_QUEUE_DEPTH = registry.gauge(
+    "db_write_queue_depth", "Сообщения в очереди фоновой записи"
+)
+DB_WRITE_DROPPED = registry.counter(
+    "db_write_dropped_total", "Сообщения, не записанные в БД после всех повторов"
+)
+LLM_REQUESTS = registry.gauge(
+    "llm_requests", "Запросы к модели в лимитере", ["state"]
+)
+
+# Длительности этапов текущего запроса, для лога медленных запросов
+request_stages: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_stages", default=None
+)
+
+
+def record_stage(stage: str, seconds: float):
+    CHAT_STAGE_SECONDS.observe(seconds, stage=stage)
+    stages = request_stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Замер этапа обработки сообщения"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+class TraceIdMiddleware:
+    """ASGI middleware: идентификатор запроса из X-Request-ID и лог медленных запросов"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        trace_id = headers.get(TRACE_HEADER.encode(), b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        trace_token = trace_id_var.set(trace_id)
+        stages_token = request_stages.set({})
+        started = time.perf_counter()
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + [
+                    (TRACE_HEADER.encode(), trace_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed >= config.SLOW_REQUEST_THRESHOLD:
+                stages = {name: round(seconds * 1000, 1) for name, seconds in request_stages.get().items()}
+                logger.warning(
+                    f"Slow request {trace_id} {scope.get('method')} {scope.get('path')}: "
+                    f"{elapsed * 1000:.0f} ms, stages (ms): {stages}"
+                )
+            request_stages.reset(stages_token)
+            trace_id_var.reset(trace_token)
@@ -1,30 +1,87 @@
-from fastapi import FastAPI
+import hmac
+
+from fastapi import FastAPI, Header, HTTPException
 from typing import Optional
 from contextlib import asynccontextmanager
 
 from .ai_agent import AIAgent
+from .chat import drain_stream_turns, run_chat_turn
+from .concurrency import UserSerializer, create_user_serializer
 from .database import DatabaseManager
-from shared.config import logger
+from .jobs import JobManager, create_job_store
+from .quotas import QuotaManager, create_quota_store
+from .retention import RetentionManager
+from shared.config import config, logger
+from shared.utils import setup_logging
 
 ai_agent: Optional[AIAgent] = None
 db_manager: Optional[DatabaseManager] = None
+user_serializer: Optional[UserSerializer] = None
+retention_manager: Optional[RetentionManager] = None
+job_manager: Optional[JobManager] = None
+quota_manager: Optional[QuotaManager] = None
+# Процесс завершается: /ready отвечает 503, новые запросы не должны приходить
+draining = False
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
-    global ai_agent, db_manager
+    global ai_agent, db_manager, user_serializer, retention_manager, job_manager, quota_manager, draining
 
     # Инициализация при запуске
+    setup_logging(config.LOG_LEVEL)
     logger.info("Initializing AI Agent and Database...")
-    ai_agent = AIAgent()
+    user_serializer = await create_user_serializer()
     db_manager = DatabaseManager()
     await db_manager.initialize()
+    ai_agent = AIAgent(summary_store=db_manager)
+    if config.KNOWLEDGE_BASE:
+        try:
+            from .knowledge import create_knowledge_base
+            ai_agent.knowledge = await create_knowledge_base(ai_agent.provider)
+        except ImportError:
+            logger.warning("numpy is not installed, knowledge base is disabled")
+    quota_manager = QuotaManager(
+        store=await create_quota_store(),
+        requests=config.RATE_LIMIT_REQUESTS,
+        window=config.RATE_LIMIT_WINDOW,
+        daily_tokens=config.DAILY_TOKEN_BUDGET
+    )
+    ai_agent.on_usage = quota_manager.record_usage
+    retention_manager = RetentionManager(db_manager)
+    retention_manager.start()
+    job_manager = JobManager(
+        store=await create_job_store(),
+        handler=lambda job: run_chat_turn(
+            ai_agent, db_manager, user_serializer, job.user_id, job.message, job.username
+        ),
+        workers=config.JOB_WORKERS,
+        max_queue=config.JOB_QUEUE_MAX
+    )
+    job_manager.start()
 
     yield
 
-    # Очистка при завершении
+    # Очистка при завершении: uvicorn уже дождался незавершенных запросов
     logger.info("Shutting down...")
+    draining = True
+    if job_manager:
+        # Принятые задачи дорабатываются, их ответы сохраняются в историю
+        await job_manager.stop(timeout=config.SHUTDOWN_GRACE_PERIOD)
+    # Потоковые ответы отключившихся клиентов дописываются в историю
+    await drain_stream_turns(config.SHUTDOWN_GRACE_PERIOD)
+    if retention_manager:
+        await retention_manager.stop()
+    if ai_agent:
+        # Фоновые обновления сводок пишут в БД, поэтому ждем их до закрытия пула
+        await ai_agent.aclose(timeout=config.SHUTDOWN_GRACE_PERIOD)
+    if quota_manager:
+        await quota_manager.close()
+    if user_serializer:
+        await user_serializer.close()
     if db_manager:
+        # Сначала дописываем буферизованные сообщения, затем закрываем пул
+        await db_manager.drain_writes()
         await db_manager.close()
 
 
@@ -37,4 +94,28 @@ async def get_db_manager():
 async def get_ai_agent():
     if ai_agent is None:
         raise RuntimeError("AIAgent not initialized")
-    return ai_agent
\ No newline at end of file
+    return ai_agent
+
+
+async def get_user_serializer():
+    if user_serializer is None:
+        raise RuntimeError("UserSerializer not initialized")
+    return user_serializer
+
+
+async def get_job_manager():
+    if job_manager is None:
+        raise RuntimeError("JobManager not initialized")
+    return job_manager
+
+
+async def get_quota_manager():
+    if quota_manager is None:
+        raise RuntimeError("QuotaManager not initialized")
+    return quota_manager
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Доступ к служебным endpoints по ADMIN_TOKEN; без настроенного токена они закрыты"""
+    if not config.ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, config.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
@@ -0,0 +1,317 @@
+"""Нагрузочный тест цепочки /api/v1/chat.
+
+Backend запускается в том же процессе (ASGI без сети) с mock-моделью и
+хранилищем в памяти либо с локальным Postgres (--database-url). Режим bot
+прогоняет синтетические обновления Telegram через dp из bot/handlers.py.
+
+    python -m benchmarks.chat_pipeline --requests 500 --concurrency 32
+    python -m benchmarks.chat_pipeline --mode bot --requests 200 --output bench.json
+    python -m benchmarks.chat_pipeline --mode webhook --requests 200 --duplicate-rate 0.1
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List
+
+import httpx
+
+from shared.config import config
+from shared.utils import percentile, setup_logging
+
+
+class StageTimer:
+    """Замер длительности этапов обработки запроса через обертки методов"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def wrap(self, obj: Any, attr: str, stage: str):
+        original = getattr(obj, attr)
+
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                self.samples[stage].append(time.perf_counter() - started)
+
+        setattr(obj, attr, timed)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Сводка задержек в миллисекундах"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "max": round(max(values) * 1000, 2)
+    }
+
+
+async def run_load(total: int, concurrency: int, send: Callable[[int], Awaitable[None]]) -> Dict[str, Any]:
+    """Выполнение total запросов с заданным числом одновременных воркеров"""
+    counter = itertools.count()
+    latencies: List[float] = []
+    errors: Dict[str, int] = defaultdict(int)
+
+    async def worker():
+        while True:
+            index = next(counter)
+            if index >= total:
+                return
+            started = time.perf_counter()
+            try:
+                await send(index)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    duration = time.perf_counter() - started
+    return {
+        "requests": total,
+        "errors": dict(errors),
+        "duration_s": round(duration, 3),
+        "rps": round(len(latencies) / duration, 2) if duration else 0.0,
+        "latency_ms": summarize(latencies)
+    }
+
+
+async def setup_backend(args: argparse.Namespace, timer: StageTimer):
+    """Инициализация backend в процессе, как это делает lifespan"""
+    import backend.utils as backend_utils
+    from backend.ai_agent import AIAgent
+    from backend.chat import run_chat_turn
+    from backend.concurrency import UserSerializer
+    from backend.database import DatabaseManager
+    from backend.jobs import JobManager, MemoryJobStore
+    from backend.quotas import MemoryQuotaStore, QuotaManager
+    from backend.main import app
+    from benchmarks.fakes import InMemoryDatabaseManager
+
+    if args.database_url:
+        config.DATABASE_URL = args.database_url
+        db_manager = DatabaseManager()
+    else:
+        db_manager = InMemoryDatabaseManager(latency=args.db_latency)
+    await db_manager.initialize()
+    ai_agent = AIAgent(summary_store=db_manager)
+
+    timer.wrap(db_manager, "get_conversation_history", "history_fetch")
+    timer.wrap(ai_agent, "process_message", "llm")
+    timer.wrap(db_manager, "save_message", "save")
+
+    backend_utils.db_manager = db_manager
+    backend_utils.ai_agent = ai_agent
+    backend_utils.user_serializer = UserSerializer()
+    backend_utils.job_manager = JobManager(
+        store=MemoryJobStore(config.JOB_RESULT_TTL),
+        handler=lambda job: run_chat_turn(
+            ai_agent, db_manager, backend_utils.user_serializer, job.user_id, job.message, job.username
+        ),
+        workers=config.JOB_WORKERS,
+        max_queue=config.JOB_QUEUE_MAX
+    )
+    backend_utils.job_manager.start()
+    # Синтетическая нагрузка не должна упираться в лимиты пользователя
+    backend_utils.quota_manager = QuotaManager(MemoryQuotaStore(), requests=0, window=60.0, daily_tokens=0)
+    ai_agent.on_usage = backend_utils.quota_manager.record_usage
+    return app, db_manager
+
+
+def message_text(index: int) -> str:
+    return f"Вопрос {index}: как работает asyncio и чем корутина отличается от потока?"
+
+
+async def bench_backend(args: argparse.Namespace, app, timer: StageTimer) -> Dict[str, Any]:
+    transport = httpx.ASGITransport(app=app) if not args.url else None
+    async with httpx.AsyncClient(
+            transport=transport,
+            base_url=args.url or "http://backend",
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=args.concurrency)
+    ) as client:
+        async def send(index: int):
+            response = await client.post("/api/v1/chat", json={
+                "user_id": 1 + index % args.users,
+                "message": message_text(index),
+                "username": "bench"
+            })
+            response.raise_for_status()
+
+        return await run_load(args.requests, args.concurrency, send)
+
+
+async def bench_bot(args: argparse.Namespace, app, timer: StageTimer) -> Dict[str, Any]:
+    from bot.client import backend_client
+    from aiogram import Bot
+    from bot.handlers import dp
+    from benchmarks.fakes import FAKE_TELEGRAM_TOKEN, FakeTelegramSession, make_update
+
+    # Свой Bot с фейковой сессией: TELEGRAM_TOKEN для замера не нужен
+    session = FakeTelegramSession(latency=args.telegram_latency)
+    bot = Bot(token=FAKE_TELEGRAM_TOKEN, session=session)
+    await backend_client.start(transport=httpx.ASGITransport(app=app) if not args.url else None)
+    if args.url:
+        backend_client.client.base_url = args.url
+
+    update_ids = itertools.count(1)
+    try:
+        # /start переводит пользователей в состояние ожидания сообщения
+        for user_id in range(1, args.users + 1):
+            await dp.feed_raw_update(bot, make_update(next(update_ids), user_id, "/start"))
+
+        async def send(index: int):
+            update = make_update(next(update_ids), 1 + index % args.users, message_text(index))
+            await dp.feed_raw_update(bot, update)
+
+        result = await run_load(args.requests, args.concurrency, send)
+        result["telegram_calls"] = session.calls
+        result["backend_client"] = backend_client.metrics()
+        return result
+    finally:
+        await backend_client.close()
+
+
+async def bench_webhook(args: argparse.Namespace, app, timer: StageTimer) -> Dict[str, Any]:
+    """Обновления через webhook-сервер бота, очередь по чатам и пул воркеров"""
+    import aiohttp
+    from aiohttp.test_utils import TestServer
+    from bot.client import backend_client
+    from aiogram import Bot
+    from bot.handlers import dp
+    from bot.storage import MemoryUpdateDeduplicator, MemoryUpdateQueue
+    from bot.webhook import STATS_KEY, UpdateWorkerPool, create_webhook_app
+    from benchmarks.fakes import FAKE_TELEGRAM_TOKEN, FakeTelegramSession, FakeUpdateSource, make_update
+
+    session = FakeTelegramSession(latency=args.telegram_latency)
+    bot = Bot(token=FAKE_TELEGRAM_TOKEN, session=session)
+    await backend_client.start(transport=httpx.ASGITransport(app=app) if not args.url else None)
+    if args.url:
+        backend_client.client.base_url = args.url
+
+    queue = MemoryUpdateQueue()
+    pool = UpdateWorkerPool(bot, dp, queue, args.concurrency)
+    webhook_app = create_webhook_app(MemoryUpdateDeduplicator(config.UPDATE_DEDUP_TTL), queue)
+    server = TestServer(webhook_app)
+
+    # Запрос считается выполненным, когда воркер обработал его обновление
+    done: Dict[int, asyncio.Future] = {}
+    feed = pool._feed
+
+    async def tracked_feed(group):
+        try:
+            await feed(group)
+        finally:
+            for update in group:
+                future = done.pop(update["update_id"], None)
+                if future and not future.done():
+                    future.set_result(None)
+
+    pool._feed = tracked_feed
+    update_ids = itertools.count(1)
+    await server.start_server()
+    pool.start()
+    try:
+        async with aiohttp.ClientSession() as client:
+            source = FakeUpdateSource(client, str(server.make_url(config.WEBHOOK_PATH)),
+                                      secret=config.WEBHOOK_SECRET, duplicate_rate=args.duplicate_rate)
+
+            async def deliver_and_wait(update: Dict[str, Any]):
+                future = done[update["update_id"]] = asyncio.get_running_loop().create_future()
+                await source.deliver(update)
+                await future
+
+            for user_id in range(1, args.users + 1):
+                await deliver_and_wait(make_update(next(update_ids), user_id, "/start"))
+
+            async def send(index: int):
+                await deliver_and_wait(make_update(next(update_ids), 1 + index % args.users, message_text(index)))
+
+            result = await run_load(args.requests, args.concurrency, send)
+            result["telegram_calls"] = session.calls
+            result["webhook"] = {**webhook_app[STATS_KEY], "delivered": source.delivered}
+            result["worker_pool"] = pool.stats
+            return result
+    finally:
+        await pool.stop()
+        await server.close()
+        await backend_client.close()
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    config.LLM_PROVIDER = "mock"
+    config.MOCK_LLM_LATENCY = args.llm_latency
+    config.MOCK_LLM_TOKENS_PER_SECOND = args.llm_tokens_per_second
+    config.RESPONSE_CACHE = not args.no_response_cache
+    config.BOT_DEBOUNCE_WINDOW = args.debounce
+
+    timer = StageTimer()
+    app, db_manager = await setup_backend(args, timer)
+    try:
+        if args.mode == "bot":
+            result = await bench_bot(args, app, timer)
+        elif args.mode == "webhook":
+            result = await bench_webhook(args, app, timer)
+        else:
+            result = await bench_backend(args, app, timer)
+    finally:
+        await db_manager.close()
+
+    return {
+        "mode": args.mode,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "users": args.users,
+            "llm_latency": args.llm_latency,
+            "llm_tokens_per_second": args.llm_tokens_per_second,
+            "database": "postgres" if args.database_url else "memory",
+            "db_latency": args.db_latency,
+            "target": args.url or "in-process"
+        },
+        **result,
+        # Этапы замеряются только при запуске backend в том же процессе
+        "stages_ms": {stage: summarize(values) for stage, values in timer.samples.items()}
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /api/v1/chat")
+    parser.add_argument("--mode", choices=["backend", "bot", "webhook"], default="backend")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="задержка mock-модели до первого токена, сек")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--db-latency", type=float, default=0.002, help="round trip хранилища в памяти, сек")
+    parser.add_argument("--database-url", help="локальный Postgres вместо хранилища в памяти")
+    parser.add_argument("--url", help="адрес запущенного backend вместо запуска в процессе")
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--debounce", type=float, default=0.0, help="BOT_DEBOUNCE_WINDOW для режимов bot и webhook")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="доля повторных доставок в режиме webhook")
+    parser.add_argument("--no-response-cache", action="store_true")
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    setup_logging(arguments.log_level)
+    results = asyncio.run(main(arguments))
+    report = json.dumps(results, ensure_ascii=False, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as f:
+            f.write(report)
+    print(report)
@@ -0,0 +1,168 @@
+import asyncio
+import itertools
+import random
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message
+
+from backend.database import DatabaseManager, utcnow
+from backend.search import InvertedIndex
+
+
+class InMemoryDatabaseManager(DatabaseManager):
+    """Замена DatabaseManager в памяти с имитацией задержки round trip к БД"""
+
+    def __init__(self, latency: float = 0.002):
+        super().__init__()
+        self.latency = latency
+        self.rows: Dict[int, List[Dict[str, Any]]] = {}
+        self.summaries: Dict[int, Dict[str, Any]] = {}
+        self.search_index = InvertedIndex()
+        self._ids = itertools.count(1)
+
+    async def _round_trip(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    async def initialize(self):
+        pass
+
+    async def save_message(self, user_id: int, user_message: str, ai_response: str,
+                           username: Optional[str] = None):
+        await self._round_trip()
+        created_at = utcnow()
+        self.rows.setdefault(user_id, []).append({
+            "user_message": user_message,
+            "ai_response": ai_response,
+            "created_at": created_at.isoformat()
+        })
+        self.search_index.add(user_id, {
+            "id": next(self._ids),
+            "created_at": created_at,
+            "user_message": user_message,
+            "ai_response": ai_response
+        })
+
+    async def get_conversation_history(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+        await self._round_trip()
+        return self.rows.get(user_id, [])[-limit:] if limit > 0 else []
+
+    async def get_summary(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self.summaries.get(user_id)
+
+    async def get_turns_between(self, user_id: int, after: Optional[datetime], before: datetime,
+                                limit: int) -> List[Dict[str, Any]]:
+        await self._round_trip()
+        return [
+            item for item in self.rows.get(user_id, [])
+            if (after is None or datetime.fromisoformat(item["created_at"]) > after)
+            and datetime.fromisoformat(item["created_at"]) < before
+        ][:limit]
+
+    async def save_summary(self, user_id: int, summary: str, summarized_until: datetime):
+        await self._round_trip()
+        self.summaries[user_id] = {"summary": summary, "summarized_until": summarized_until}
+
+    async def clear_conversation(self, user_id: int):
+        await self._round_trip()
+        self.rows.pop(user_id, None)
+        self.summaries.pop(user_id, None)
+        self.search_index.remove_user(user_id)
+
+    async def search_conversations(self, user_id: int, query: str, limit: int = 20,
+                                   cursor: Optional[str] = None) -> Dict[str, Any]:
+        await self._round_trip()
+        return self.search_index.search(user_id, query, limit, cursor)
+
+    async def get_usage_stats(self) -> Dict[str, Any]:
+        return {
+            "total_messages": sum(len(rows) for rows in self.rows.values()),
+            "unique_users": len(self.rows)
+        }
+
+    async def get_usage_series(self, hours: int = 24, days: int = 30) -> Dict[str, Any]:
+        return {"messages_per_hour": [], "active_users_per_day": []}
+
+    async def close(self):
+        pass
+
+
+# Токен нужного формата: с FakeTelegramSession запросы в Telegram не уходят
+FAKE_TELEGRAM_TOKEN = "123456:TEST"
+
+
+class FakeTelegramSession(BaseSession):
+    """Сессия aiogram без сети: отвечает на методы Bot API локально"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.sent: List[str] = []
+        self._message_ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None and hasattr(method, "text"):
+            self.sent.append(method.text)
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"),
+                text=method.text
+            ).as_(bot)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+        yield b""
+
+
+def make_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """Синтетическое обновление Telegram с текстовым сообщением"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(datetime.now().timestamp()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"},
+            "text": text
+        }
+    }
+
+
+class FakeUpdateSource:
+    """Локальный источник обновлений для webhook-режима: POST на webhook, как делает Telegram.
+
+    Часть обновлений доставляется повторно (duplicate_rate), чтобы проверить дедупликацию.
+    """
+
+    def __init__(self, session, url: str, secret: Optional[str] = None,
+                 duplicate_rate: float = 0.0, seed: int = 0):
+        self.session = session
+        self.url = url
+        self.secret = secret
+        self.duplicate_rate = duplicate_rate
+        self._random = random.Random(seed)
+        self.delivered = 0
+
+    async def deliver(self, update: Dict[str, Any]):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        attempts = 2 if self._random.random() < self.duplicate_rate else 1
+        for _ in range(attempts):
+            async with self.session.post(self.url, json=update, headers=headers) as response:
+                response.raise_for_status()
+            self.delivered += 1
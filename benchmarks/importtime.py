@@ -0,0 +1,91 @@
+"""Время импорта модулей процесса по данным python -X importtime.
+
+Каждый модуль импортируется в отдельном интерпретаторе без секретов в окружении,
+поэтому отчет заодно проверяет, что импорт не требует токенов и сети.
+
+    python -m benchmarks.importtime
+    python -m benchmarks.importtime backend.main --top 30 --output importtime.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Any, Dict, List
+
+DEFAULT_MODULES = ["backend.main", "bot.handlers", "bot.main"]
+SECRETS = ("TELEGRAM_TOKEN", "OPENAI_API_KEY")
+
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """Строки «import time: self | cumulative | name» в список записей, время в мс"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        entries.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip())) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000
+        })
+    return entries
+
+
+def profile(module: str) -> Dict[str, Any]:
+    env = {key: value for key, value in os.environ.items() if key not in SECRETS}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.getcwd(), env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env
+    )
+    entries = parse_importtime(result.stderr)
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed"
+    return {"module": module, "ok": result.returncode == 0, "error": error, "entries": entries}
+
+
+def summarize(report: Dict[str, Any], top: int) -> Dict[str, Any]:
+    entries = report["entries"]
+    total = next((e["cumulative_ms"] for e in entries if e["module"] == report["module"]), 0.0)
+    # Собственное время, сгруппированное по пакету верхнего уровня
+    packages: Dict[str, float] = defaultdict(float)
+    for entry in entries:
+        packages[entry["module"].split(".")[0]] += entry["self_ms"]
+    slowest = sorted(entries, key=lambda e: e["cumulative_ms"], reverse=True)
+    return {
+        "module": report["module"],
+        "ok": report["ok"],
+        "error": report["error"],
+        "total_ms": round(total, 1),
+        "packages_ms": {
+            name: round(ms, 1)
+            for name, ms in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+        },
+        "slowest": [
+            {"module": e["module"], "cumulative_ms": round(e["cumulative_ms"], 1), "self_ms": round(e["self_ms"], 1)}
+            for e in slowest[:top]
+        ]
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Отчет о времени импорта модулей")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    results = [summarize(profile(module), arguments.top) for module in arguments.modules]
+    report = json.dumps(results, ensure_ascii=False, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as f:
+            f.write(report)
+    print(report)
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
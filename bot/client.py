@@ -0,0 +1,199 @@
+import importlib.util
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+import httpx
+
+from shared.config import config, logger
+from shared.utils import retry_async, percentile, trace_id_var
+
+
+# Ошибки, при которых запрос гарантированно не дошел до backend и его можно повторить
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class BackendClient:
+    """Долгоживущий HTTP-клиент бота к backend с пулом соединений и метриками"""
+
+    def __init__(self, base_url: str = None, latency_window: int = 1000):
+        self.base_url = base_url or config.BACKEND_URL
+        self.client: Optional[httpx.AsyncClient] = None
+        self.latency_window = latency_window
+
+        self.requests_total = 0
+        self.connections_opened = 0
+        self.in_flight = 0
+        self.errors_total = 0
+        self.latencies: Dict[str, Deque[float]] = {}
+
+    async def start(self, transport: Optional[httpx.AsyncBaseTransport] = None):
+        """Создание пула соединений (transport - для запуска без сети, например ASGI)"""
+        if self.client is not None:
+            return
+
+        http2 = config.BACKEND_HTTP2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("BACKEND_HTTP2 is enabled but h2 is not installed, falling back to HTTP/1.1")
+            http2 = False
+
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=config.BACKEND_MAX_CONNECTIONS,
+                max_keepalive_connections=config.BACKEND_MAX_KEEPALIVE,
+                keepalive_expiry=config.BACKEND_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(config.BACKEND_CHAT_TIMEOUT, connect=config.BACKEND_CONNECT_TIMEOUT),
+            transport=transport
+        )
+        logger.info(f"Backend client started: {self.base_url} (http2={http2})")
+
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info(f"Backend client closed: {self.metrics()}")
+
+    def _timeout(self, seconds: float) -> httpx.Timeout:
+        return httpx.Timeout(seconds, connect=config.BACKEND_CONNECT_TIMEOUT)
+
+    def _retry(self):
+        return retry_async(
+            max_retries=config.BACKEND_RETRIES,
+            delay=config.BACKEND_RETRY_DELAY,
+            exceptions=RETRYABLE_ERRORS
+        )
+
+    async def _trace(self, event_name: str, info: Dict[str, Any]):
+        """Трассировка httpcore: считаем новые TCP-соединения"""
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+
+    def _record(self, endpoint: str, started: float):
+        window = self.latencies.setdefault(endpoint, deque(maxlen=self.latency_window))
+        window.append(time.perf_counter() - started)
+
+    async def _send(self, endpoint: str, request: httpx.Request, stream: bool = False) -> httpx.Response:
+        if self.client is None:
+            raise RuntimeError("BackendClient not started")
+
+        request.extensions["trace"] = self._trace
+        # Идентификатор обработки сообщения, по нему backend связывает свои этапы с ответом бота
+        trace_id = trace_id_var.get()
+        if trace_id != "-":
+            request.headers["X-Request-ID"] = trace_id
+        self.requests_total += 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            response = await self.client.send(request, stream=stream)
+        except Exception:
+            self.errors_total += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self._record(endpoint, started)
+        return response
+
+    async def chat(self, payload: Dict[str, Any]) -> httpx.Response:
+        """POST /api/v1/chat"""
+        @self._retry()
+        async def send():
+            request = self.client.build_request(
+                "POST", "/api/v1/chat", json=payload,
+                timeout=self._timeout(config.BACKEND_CHAT_TIMEOUT)
+            )
+            return await self._send("chat", request)
+
+        return await send()
+
+    async def submit_job(self, payload: Dict[str, Any]) -> httpx.Response:
+        """POST /api/v1/jobs: задача ставится в очередь, ответ приходит сразу"""
+        @self._retry()
+        async def send():
+            request = self.client.build_request(
+                "POST", "/api/v1/jobs", json=payload,
+                timeout=self._timeout(config.BACKEND_CHAT_TIMEOUT)
+            )
+            return await self._send("jobs_submit", request)
+
+        return await send()
+
+    async def get_job(self, job_id: str, wait: float) -> httpx.Response:
+        """GET /api/v1/jobs/{job_id}?wait=: ожидание результата задачи (long polling)"""
+        @self._retry()
+        async def send():
+            request = self.client.build_request(
+                "GET", f"/api/v1/jobs/{job_id}", params={"wait": wait},
+                timeout=self._timeout(wait + config.BACKEND_CHAT_TIMEOUT)
+            )
+            return await self._send("jobs_poll", request)
+
+        return await send()
+
+    @asynccontextmanager
+    async def chat_stream(self, payload: Dict[str, Any]) -> AsyncIterator[httpx.Response]:
+        """POST /api/v1/chat/stream, ответ читается потоком"""
+        @self._retry()
+        async def send():
+            request = self.client.build_request(
+                "POST", "/api/v1/chat/stream", json=payload,
+                timeout=self._timeout(config.BACKEND_CHAT_TIMEOUT)
+            )
+            return await self._send("chat_stream", request, stream=True)
+
+        response = await send()
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def clear_conversation(self, user_id: int) -> httpx.Response:
+        """DELETE /api/v1/conversations/{user_id}"""
+        @self._retry()
+        async def send():
+            request = self.client.build_request(
+                "DELETE", f"/api/v1/conversations/{user_id}",
+                timeout=self._timeout(config.BACKEND_CLEAR_TIMEOUT)
+            )
+            return await self._send("clear", request)
+
+        return await send()
+
+    async def search(self, user_id: int, query: str, limit: int) -> httpx.Response:
+        """GET /api/v1/conversations/{user_id}/search"""
+        @self._retry()
+        async def send():
+            request = self.client.build_request(
+                "GET", f"/api/v1/conversations/{user_id}/search", params={"q": query, "limit": limit},
+                timeout=self._timeout(config.BACKEND_CLEAR_TIMEOUT)
+            )
+            return await self._send("search", request)
+
+        return await send()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Метрики пула: переиспользование соединений и задержки bot→backend"""
+        reused = max(0, self.requests_total - self.connections_opened)
+        return {
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "in_flight": self.in_flight,
+            "connections_opened": self.connections_opened,
+            "connection_reuse_ratio": round(reused / self.requests_total, 3) if self.requests_total else 0.0,
+            "latency": {
+                endpoint: {
+                    "count": len(values),
+                    "p50_ms": round(percentile(values, 50) * 1000, 1),
+                    "p99_ms": round(percentile(values, 99) * 1000, 1)
+                }
+                for endpoint, values in self.latencies.items()
+            }
+        }
+
+
+backend_client = BackendClient()
@@ -0,0 +1,235 @@
+import asyncio
+import time
+from typing import Dict, Iterable, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendChatAction, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from shared.config import config, logger
+from shared.metrics import registry
+
+FENCE = "```"
+
+TELEGRAM_SEND_QUEUE = registry.gauge(
+    "telegram_send_queue_depth", "Запросы к Bot API, ожидающие лимита отправки"
+)
+TELEGRAM_SEND_SECONDS = registry.histogram(
+    "telegram_send_seconds", "Время запроса к Bot API с ожиданием лимита", ["method"]
+)
+TELEGRAM_RETRY_AFTER = registry.counter(
+    "telegram_retry_after_total", "Ответы RetryAfter от Telegram", ["method"]
+)
+
+
+class TokenBucket:
+    """Ведро токенов в форме GCRA: резервирование сразу дает время ожидания,
+    ожидающие обслуживаются в порядке вызова"""
+
+    def __init__(self, rate: float, burst: float):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(burst, 1.0) - 1) * self.interval
+        self.next_free = 0.0
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """Занять токен; возвращает, сколько секунд ждать до отправки"""
+        now = time.monotonic()
+        arrival = max(self.next_free, now)
+        self.next_free = arrival + self.interval
+        return max(0.0, arrival - self.tolerance - now)
+
+    def block(self, seconds: float):
+        """Пауза после RetryAfter: после нее отправки идут с обычным интервалом, без запаса"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.next_free = max(self.next_free, self.blocked_until + self.tolerance)
+
+    def blocked(self) -> bool:
+        return self.blocked_until > time.monotonic()
+
+    def idle(self) -> bool:
+        return self.next_free <= time.monotonic()
+
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """Планировщик исходящих запросов к Bot API по лимитам Telegram.
+
+    Общее ведро ограничивает скорость бота целиком, ведро чата - скорость в
+    одном чате (в группах лимит ниже). При RetryAfter чат ставится на паузу,
+    а запрос повторяется после нее.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(config.TELEGRAM_GLOBAL_RATE, config.TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.waiting = 0
+        self.stats = {"requests": 0, "delayed": 0, "retry_after": 0, "dropped": 0}
+        TELEGRAM_SEND_QUEUE.set_function(lambda: self.waiting)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                # Полные ведра ничего не помнят, их можно удалить
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.idle()}
+            # Отрицательный chat_id - группы и каналы
+            if chat_id < 0:
+                bucket = TokenBucket(config.TELEGRAM_GROUP_RATE, config.TELEGRAM_GROUP_BURST)
+            else:
+                bucket = TokenBucket(config.TELEGRAM_CHAT_RATE, config.TELEGRAM_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _wait_turn(self, chat_bucket: Optional[TokenBucket]):
+        delay = chat_bucket.reserve() if chat_bucket else 0.0
+        if delay > 0:
+            await asyncio.sleep(delay)
+        delay = self.global_bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int) or isinstance(method, SendChatAction):
+            # Служебные запросы и «печатает...» не расходуют лимит сообщений
+            return await make_request(bot, method)
+
+        name = type(method).__name__
+        chat_bucket = self._chat_bucket(chat_id)
+        started = time.perf_counter()
+        self.stats["requests"] += 1
+        attempts = 0
+        while True:
+            self.waiting += 1
+            try:
+                wait_started = time.monotonic()
+                await self._wait_turn(chat_bucket)
+                if time.monotonic() - wait_started > 0.001:
+                    self.stats["delayed"] += 1
+            finally:
+                self.waiting -= 1
+            if chat_bucket.blocked():
+                # Очередь дошла во время паузы после RetryAfter: встаем в очередь заново
+                continue
+
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempts += 1
+                self.stats["retry_after"] += 1
+                TELEGRAM_RETRY_AFTER.inc(method=name)
+                chat_bucket.block(e.retry_after)
+                if attempts > config.TELEGRAM_MAX_RETRIES:
+                    self.stats["dropped"] += 1
+                    raise
+                logger.warning(f"Telegram RetryAfter {e.retry_after}s for chat {chat_id}, requeueing {name}")
+                continue
+
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, method=name)
+            return response
+
+
+def _pack(units: Iterable[str], separator: str, limit: int) -> List[str]:
+    """Жадная упаковка частей в куски не длиннее limit (части уже не длиннее limit)"""
+    chunks: List[str] = []
+    current: Optional[str] = None
+    for unit in units:
+        if current is not None and len(current) + len(separator) + len(unit) <= limit:
+            current += separator + unit
+        else:
+            if current is not None:
+                chunks.append(current)
+            current = unit
+    if current is not None:
+        chunks.append(current)
+    return chunks
+
+
+def _split_prose(text: str, limit: int) -> List[str]:
+    """Текст без кода: по строкам, затем по словам, в крайнем случае - по символам"""
+    units: List[str] = []
+    for line in text.split("\n"):
+        if len(line) <= limit:
+            units.append(line)
+            continue
+        words: List[str] = []
+        for word in line.split(" "):
+            words.extend(word[i:i + limit] for i in range(0, len(word), limit))
+        units.extend(_pack(words, " ", limit))
+    return _pack(units, "\n", limit)
+
+
+def _split_fence(block: str, limit: int) -> List[str]:
+    """Блок кода длиннее лимита: каждый кусок закрывается и открывается заново с тем же языком"""
+    lines = block.split("\n")
+    header = lines[0]
+    body = lines[1:-1] if len(lines) > 1 and lines[-1].strip() == FENCE else lines[1:]
+    inner_limit = limit - len(header) - len(FENCE) - 2
+    if inner_limit < 1:
+        # Заголовок с языком не оставляет места для кода: блок режется как обычный текст
+        return _split_prose(block, limit)
+    pieces = _split_prose("\n".join(body), inner_limit)
+    return [f"{header}\n{piece}\n{FENCE}" for piece in pieces]
+
+
+def _blocks(text: str) -> List[str]:
+    """Абзацы текста и блоки кода ``` целиком"""
+    blocks: List[str] = []
+    paragraph: List[str] = []
+    fence: Optional[List[str]] = None
+    for line in text.split("\n"):
+        if fence is not None:
+            fence.append(line)
+            if line.strip() == FENCE:
+                blocks.append("\n".join(fence))
+                fence = None
+        elif line.lstrip().startswith(FENCE):
+            if paragraph:
+                blocks.append("\n".join(paragraph))
+                paragraph = []
+            fence = [line.strip()]
+        elif not line.strip():
+            if paragraph:
+                blocks.append("\n".join(paragraph))
+                paragraph = []
+        else:
+            paragraph.append(line)
+    if fence is not None:
+        blocks.append("\n".join(fence))
+    if paragraph:
+        blocks.append("\n".join(paragraph))
+    return blocks
+
+
+def split_message(text: str, limit: int) -> List[str]:
+    """Разбиение ответа на сообщения по абзацам, не разрывая блоки кода"""
+    pieces: List[str] = []
+    for block in _blocks(text):
+        if len(block) <= limit:
+            pieces.append(block)
+        elif block.startswith(FENCE):
+            pieces.extend(_split_fence(block, limit))
+        else:
+            pieces.extend(_split_prose(block, limit))
+    return _pack(pieces, "\n\n", limit)
+
+
+def should_send_as_file(text: str) -> bool:
+    """Очень длинный ответ с кодом удобнее получить файлом, чем серией сообщений"""
+    return 0 < config.BOT_FILE_THRESHOLD < len(text) and FENCE in text
+
+
+def file_preview(text: str, limit: int) -> str:
+    """Подпись к файлу: текст ответа до первого блока кода"""
+    intro = text.split(FENCE, 1)[0].strip()
+    if len(intro) > limit:
+        intro = intro[:limit - 1].rsplit(" ", 1)[0] + "…"
+    return intro or "Ответ во вложении."
@@ -1,16 +1,46 @@
+import json
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
 import httpx
 
-from aiogram.types import Message
+from aiogram.types import BufferedInputFile, Message
 from aiogram import Bot, Dispatcher
-from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import CommandObject, CommandStart, Command
 from aiogram.fsm.context import FSMContext
+from bot.client import backend_client
+from bot.delivery import FloodControlMiddleware, file_preview, should_send_as_file, split_message
+from bot.middlewares import UserDebounceMiddleware
 from bot.states import ConversationState
+from bot.storage import create_fsm_storage
 from shared.config import config, logger
+from shared.utils import trace_id_var, user_id_var
+
+
+
+flood_control = FloodControlMiddleware()
+_bot: Optional[Bot] = None
+
+
+def get_bot() -> Bot:
+    """Экземпляр Bot создается при первом обращении: импорт обработчиков не требует токена"""
+    global _bot
+    if _bot is None:
+        if not config.TELEGRAM_TOKEN:
+            raise ValueError("TELEGRAM_TOKEN is required")
+        _bot = Bot(token=config.TELEGRAM_TOKEN)
+        # Все запросы к Bot API проходят через планировщик с лимитами Telegram
+        _bot.session.middleware(flood_control)
+    return _bot
 
 
+dp = Dispatcher(storage=create_fsm_storage())
+dp.message.middleware(UserDebounceMiddleware(config.BOT_DEBOUNCE_WINDOW, config.BOT_DEBOUNCE_MAX_WAIT))
 
-bot = Bot(token=config.TELEGRAM_TOKEN)
-dp = Dispatcher()
+# Telegram ограничивает сообщение 4096 символами, оставляем запас
+MESSAGE_LIMIT = 4000
 
 
 @dp.message(CommandStart())
@@ -20,7 +50,8 @@ async def start_handler(message: Message, state: FSMContext):
         "Доступные команды:\n"
         "/start - Начать работу\n"
         "/help - Помощь\n"
-        "/clear - Очистить контекст разговора\n\n"
+        "/clear - Очистить контекст разговора\n"
+        "/search <запрос> - Найти в истории разговора\n\n"
         "Просто напишите ваш вопрос, и я постараюсь помочь!"
     )
     await state.set_state(ConversationState.waiting_for_message)
@@ -36,7 +67,8 @@ async def help_handler(message: Message, state: FSMContext):
         "• Отладкой кода\n"
         "• Рекомендациями по архитектуре\n"
         "• Ответами на технические вопросы\n\n"
-        "Просто отправьте сообщение с вашим вопросом."
+        "Просто отправьте сообщение с вашим вопросом.\n"
+        "Найти прошлый ответ: /search <запрос>"
     )
     await state.set_state(ConversationState.waiting_for_message)
 
@@ -46,15 +78,11 @@ async def clear_handler(message: Message, state: FSMContext):
     """Очистка контекста разговора"""
     user_id = message.from_user.id
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.delete(
-                f"{config.BACKEND_URL}/api/v1/conversations/{user_id}",
-                timeout=10.0
-            )
-            if response.status_code == 200:
-                await message.answer("🗑 Контекст разговора очищен.")
-            else:
-                await message.answer("⚠️ Не удалось очистить контекст.")
+        response = await backend_client.clear_conversation(user_id)
+        if response.status_code == 200:
+            await message.answer("🗑 Контекст разговора очищен.")
+        else:
+            await message.answer("⚠️ Не удалось очистить контекст.")
     except Exception as e:
         logger.error(f"Error clearing context: {e}")
         await message.answer("❌ Ошибка при очистке контекста.")
@@ -62,44 +90,220 @@ async def clear_handler(message: Message, state: FSMContext):
         await state.set_state(ConversationState.waiting_for_message)
 
 
+def _search_text(query: str, results: List[Dict]) -> str:
+    lines = [f"🔎 Найдено по запросу «{query}»:"]
+    for item in results:
+        day = item["created_at"][:10]
+        lines.append(f"\n📅 {day}\n{item['snippet']}")
+    return "\n".join(lines)
+
+
+@dp.message(Command("search"))
+async def search_handler(message: Message, state: FSMContext, command: CommandObject):
+    """Поиск по истории разговора"""
+    query = (command.args or "").strip()
+    try:
+        if not query:
+            await message.answer("Укажите, что искать: /search <запрос>")
+            return
+        response = await backend_client.search(
+            message.from_user.id, query[:config.SEARCH_QUERY_MAX_LENGTH], config.BOT_SEARCH_RESULTS
+        )
+        if response.status_code != 200:
+            await message.answer("⚠️ Не удалось выполнить поиск.")
+            return
+        results = response.json()["results"]
+        if not results:
+            await message.answer("Ничего не найдено.")
+            return
+        await _deliver(message, _search_text(query, results))
+    except Exception as e:
+        logger.error(f"Error searching conversation: {e}")
+        await message.answer("❌ Ошибка при поиске.")
+    finally:
+        await state.set_state(ConversationState.waiting_for_message)
+
+
+async def _iter_sse(response: httpx.Response) -> AsyncIterator[Tuple[str, Dict]]:
+    """Разбор потока Server-Sent Events от backend"""
+    event = "message"
+    async for line in response.aiter_lines():
+        if not line:
+            event = "message"
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            yield event, json.loads(line[len("data:"):].strip())
+
+
+async def _edit_text(sent: Message, text: str) -> None:
+    """Правка сообщения без ошибки, если текст не изменился"""
+    try:
+        await sent.edit_text(text)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+
+
+def _quota_text(data: Dict) -> str:
+    """Понятное пользователю сообщение об ответе 429 backend"""
+    retry_after = int(data.get("retry_after") or 60)
+    if data.get("reason") == "tokens":
+        hours = max(1, round(retry_after / 3600))
+        return f"📊 Дневной лимит запросов к AI исчерпан. Он обновится примерно через {hours} ч."
+    if retry_after >= 120:
+        return f"⏳ Слишком много сообщений подряд. Попробуйте через {round(retry_after / 60)} мин."
+    return f"⏳ Слишком много сообщений подряд. Попробуйте через {retry_after} сек."
+
+
+async def _answer_quota(message: Message, response: httpx.Response) -> None:
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    await message.answer(_quota_text(data))
+
+
+async def _stream_answer(message: Message, payload: Dict) -> None:
+    """Потоковый ответ: одно сообщение редактируется по мере поступления текста"""
+    text = ""
+    shown = ""
+    sent: Optional[Message] = None
+    last_edit = 0.0
+
+    async with backend_client.chat_stream(payload) as response:
+        if response.status_code == 429:
+            await response.aread()
+            await _answer_quota(message, response)
+            return
+        if response.status_code != 200:
+            await message.answer("❌ Ошибка при обработке запроса.")
+            return
+
+        async for event, data in _iter_sse(response):
+            if event == "error":
+                await message.answer("❌ Ошибка при обработке запроса.")
+                return
+            if event == "done":
+                text = data.get("response", text)
+                break
+
+            text += data.get("delta", "")
+            preview = text[:MESSAGE_LIMIT]
+            if not preview.strip():
+                continue
+
+            # Первый фрагмент показываем сразу, дальше правим не чаще STREAM_EDIT_INTERVAL
+            now = time.monotonic()
+            if sent is None:
+                sent = await message.answer(preview)
+                shown, last_edit = preview, now
+            elif preview != shown and now - last_edit >= config.STREAM_EDIT_INTERVAL:
+                await _edit_text(sent, preview)
+                shown, last_edit = preview, now
+
+    await _deliver(message, text, sent, shown)
+
+
+async def _job_answer(message: Message, payload: Dict) -> None:
+    """Ответ через фоновую задачу backend: долгий ответ модели не теряется из-за таймаута запроса"""
+    response = await backend_client.submit_job(payload)
+    if response.status_code == 429:
+        await _answer_quota(message, response)
+        return
+    if response.status_code == 503:
+        await message.answer("⏳ Сервис перегружен. Попробуйте через минуту.")
+        return
+    if response.status_code != 202:
+        await message.answer("❌ Ошибка при обработке запроса.")
+        return
+
+    job_id = response.json()["job_id"]
+    deadline = time.monotonic() + config.BOT_JOB_MAX_WAIT
+    while time.monotonic() < deadline:
+        wait = min(config.BOT_JOB_POLL_WAIT, max(0.0, deadline - time.monotonic()))
+        response = await backend_client.get_job(job_id, wait)
+        if response.status_code != 200:
+            await message.answer("❌ Ошибка при обработке запроса.")
+            return
+        job = response.json()
+        if job["status"] == "done":
+            await _deliver(message, job["response"] or "Не удалось получить ответ.")
+            return
+        if job["status"] == "failed":
+            await message.answer("❌ Ошибка при обработке запроса.")
+            return
+        # Пока задача выполняется, продлеваем «печатает...»
+        await message.bot.send_chat_action(message.chat.id, "typing")
+
+    await message.answer("⏱ Ответ готовится дольше обычного. Он сохранится в истории разговора.")
+
+
+async def _deliver(message: Message, text: str, sent: Optional[Message] = None, shown: str = "") -> None:
+    """Отправка готового ответа: по абзацам без разрыва блоков кода или файлом.
+
+    sent - уже показанное сообщение (потоковый режим), в него попадает первая часть.
+    """
+    if should_send_as_file(text):
+        chunks = [file_preview(text, MESSAGE_LIMIT)]
+    else:
+        chunks = split_message(text, MESSAGE_LIMIT) or ["Не удалось получить ответ."]
+
+    if sent is None:
+        await message.answer(chunks[0])
+    elif chunks[0] != shown:
+        await _edit_text(sent, chunks[0])
+    for chunk in chunks[1:]:
+        await message.answer(chunk)
+
+    if should_send_as_file(text):
+        await message.answer_document(BufferedInputFile(text.encode("utf-8"), filename="answer.md"))
+
+
 @dp.message(ConversationState.waiting_for_message)
-async def message_handler(message: Message, state: FSMContext):
+async def message_handler(message: Message, state: FSMContext, merged_text: Optional[str] = None):
     """Обработчик текстовых сообщений"""
     user_id = message.from_user.id
-    user_message = message.text
+    # Серия быстрых сообщений приходит от middleware одним текстом
+    user_message = merged_text or message.text
+    payload = {
+        "user_id": user_id,
+        "message": user_message,
+        "username": message.from_user.username or "Unknown"
+    }
+
+    trace_id = uuid.uuid4().hex[:16]
+    trace_id_var.set(trace_id)
+    user_id_var.set(user_id)
+    started = time.monotonic()
 
     # Отправляем "печатает..."
-    await bot.send_chat_action(message.chat.id, "typing")
+    await message.bot.send_chat_action(message.chat.id, "typing")
 
     try:
         # Отправляем запрос в backend
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{config.BACKEND_URL}/api/v1/chat",
-                json={
-                    "user_id": user_id,
-                    "message": user_message,
-                    "username": message.from_user.username or "Unknown"
-                },
-                timeout=30.0
-            )
-
-            if response.status_code == 200:
-                data = response.json()
-                ai_response = data.get("response", "Не удалось получить ответ.")
-
-                # Разбиваем длинные сообщения
-                if len(ai_response) > 4000:
-                    chunks = [ai_response[i:i + 4000] for i in range(0, len(ai_response), 4000)]
-                    for chunk in chunks:
-                        await message.answer(chunk)
-                else:
-                    await message.answer(ai_response)
-            else:
-                await message.answer("❌ Ошибка при обработке запроса.")
+        if config.BOT_STREAMING:
+            await _stream_answer(message, payload)
+            return
+        if config.BOT_USE_JOBS:
+            await _job_answer(message, payload)
+            return
+
+        response = await backend_client.chat(payload)
+        if response.status_code == 200:
+            data = response.json()
+            await _deliver(message, data.get("response", "Не удалось получить ответ."))
+        elif response.status_code == 429:
+            await _answer_quota(message, response)
+        else:
+            await message.answer("❌ Ошибка при обработке запроса.")
 
     except httpx.TimeoutException:
         await message.answer("⏱ Превышено время ожидания. Попробуйте еще раз.")
     except Exception as e:
-        logger.error(f"Error processing message: {e}")
+        logger.error(f"Error processing message {trace_id}: {e}")
         await message.answer("❌ Произошла ошибка. Попробуйте позже.")
+    finally:
+        elapsed = time.monotonic() - started
+        if elapsed >= config.SLOW_REQUEST_THRESHOLD:
+            logger.warning(f"Slow reply {trace_id} for user {user_id}: {elapsed * 1000:.0f} ms")
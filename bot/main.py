@@ -1,8 +1,12 @@
 import asyncio
+import signal
 
 from aiogram.types import BotCommand
-from shared.config import logger
-from bot.handlers import dp, bot
+from shared.config import config, logger
+from shared.utils import setup_logging
+from bot.client import backend_client
+from bot.handlers import dp, get_bot, flood_control
+from bot.storage import create_update_storage
 
 
 async def set_bot_commands():
@@ -10,16 +14,62 @@ async def set_bot_commands():
     commands = [
         BotCommand(command="start", description="Начать работу с ботом"),
         BotCommand(command="clear", description="Очистить контекст разговора"),
+        BotCommand(command="search", description="Найти в истории разговора"),
         BotCommand(command="help", description="Получить помощь"),
     ]
-    await bot.set_my_commands(commands)
+    await get_bot().set_my_commands(commands)
+
+
+async def log_backend_metrics():
+    """Периодический вывод метрик пула соединений к backend и очереди отправки в Telegram"""
+    while True:
+        await asyncio.sleep(config.BACKEND_METRICS_LOG_INTERVAL)
+        logger.info(f"Backend client metrics: {backend_client.metrics()}")
+        logger.info(f"Telegram send metrics: {flood_control.stats}, waiting {flood_control.waiting}")
+
+
+async def run_webhook_mode():
+    """Webhook-режим до SIGTERM/SIGINT"""
+    from bot.webhook import run_webhook
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    bot = get_bot()
+    deduplicator, queue = create_update_storage()
+    try:
+        await run_webhook(bot, dp, deduplicator, queue, stop_event)
+    finally:
+        await deduplicator.close()
+        await queue.close()
+        await dp.storage.close()
+        await bot.session.close()
 
 
 async def main():
+    setup_logging(config.LOG_LEVEL)
     logger.info("Starting Telegram bot...")
+    bot = get_bot()
+
+    await backend_client.start()
+    metrics_task = None
+    if config.BACKEND_METRICS_LOG_INTERVAL > 0:
+        metrics_task = asyncio.create_task(log_backend_metrics())
 
-    await set_bot_commands()
-    await dp.start_polling(bot)
+    try:
+        await set_bot_commands()
+        if config.BOT_MODE == "webhook":
+            await run_webhook_mode()
+        else:
+            # Для разработки: один процесс с long polling
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if metrics_task:
+            metrics_task.cancel()
+        await backend_client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+
+class UserDebounceMiddleware(BaseMiddleware):
+    """Объединение серии быстрых сообщений пользователя в один запрос.
+
+    Сообщения, пришедшие с паузой меньше window секунд, склеиваются в один
+    текст (передается обработчику как merged_text), а обработка сообщений
+    одного пользователя идет строго по очереди.
+    """
+
+    def __init__(self, window: float, max_wait: float):
+        self.window = window
+        self.max_wait = max_wait
+        self._buffers: Dict[int, List[Message]] = {}
+        self._last_arrival: Dict[int, float] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._refs: Dict[int, int] = {}
+
+        self.merged = 0
+
+    async def __call__(
+            self,
+            handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+            event: Message,
+            data: Dict[str, Any]
+    ) -> Any:
+        # Команды обрабатываются сразу, серии из очереди webhook-режима уже склеены
+        if not event.text or event.text.startswith("/") or event.from_user is None or "merged_text" in data:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        buffer = self._buffers.get(user_id)
+        if buffer is not None:
+            # Серия уже собирается, сообщение будет обработано вместе с ней
+            buffer.append(event)
+            self._last_arrival[user_id] = time.monotonic()
+            self.merged += 1
+            return None
+
+        buffer = self._buffers[user_id] = [event]
+        started = self._last_arrival[user_id] = time.monotonic()
+        while True:
+            now = time.monotonic()
+            remaining = min(self._last_arrival[user_id] + self.window, started + self.max_wait) - now
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        del self._buffers[user_id]
+        del self._last_arrival[user_id]
+
+        data["merged_text"] = "\n\n".join(message.text for message in buffer)
+
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._refs[user_id] = self._refs.get(user_id, 0) + 1
+        try:
+            async with lock:
+                return await handler(buffer[-1], data)
+        finally:
+            self._refs[user_id] -= 1
+            if not self._refs[user_id]:
+                del self._refs[user_id]
+                del self._locks[user_id]
@@ -0,0 +1,263 @@
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from shared.config import config, logger
+
+KEY_PREFIX = "bot"
+
+# Снятие блокировки чата, только если она все еще наша
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+REFRESH_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Удаление обработанных обновлений; чат без обновлений убирается из списка чатов
+ACK_SCRIPT = """
+redis.call("ltrim", KEYS[1], ARGV[1], -1)
+if redis.call("llen", KEYS[1]) == 0 then
+    redis.call("srem", KEYS[2], ARGV[2])
+end
+return 0
+"""
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Хранилище состояний FSM: в памяти процесса или общее в Redis для нескольких реплик"""
+    if config.BOT_STORAGE == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        return RedisStorage.from_url(config.REDIS_URL)
+    return MemoryStorage()
+
+
+class UpdateDeduplicator:
+    """Отбрасывание повторных доставок обновления с тем же update_id"""
+
+    async def first_seen(self, update_id: int) -> bool:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryUpdateDeduplicator(UpdateDeduplicator):
+    def __init__(self, ttl: float, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: "OrderedDict[int, float]" = OrderedDict()
+
+    async def first_seen(self, update_id: int) -> bool:
+        now = time.monotonic()
+        while self._seen and (next(iter(self._seen.values())) < now or len(self._seen) >= self.max_size):
+            self._seen.popitem(last=False)
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = now + self.ttl
+        return True
+
+
+class RedisUpdateDeduplicator(UpdateDeduplicator):
+    def __init__(self, client, ttl: float):
+        self.client = client
+        self.ttl = ttl
+
+    async def first_seen(self, update_id: int) -> bool:
+        return bool(await self.client.set(f"{KEY_PREFIX}:update:{update_id}", 1, nx=True, ex=int(self.ttl)))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class UpdateQueue:
+    """Очередь обновлений по чатам.
+
+    Обновления чата обрабатывает только владелец блокировки чата, поэтому порядок
+    внутри чата сохраняется, а разные чаты обрабатываются параллельно. После
+    снятия блокировки владелец перепроверяет очередь чата (pending/requeue), так
+    что обновления, пришедшие во время обработки, не теряются.
+
+    Владелец читает обновления из начала очереди чата (peek) и удаляет их только
+    после обработки (ack). Если воркер упал, блокировка истекает по TTL, и
+    recover возвращает чат с необработанными обновлениями в очередь готовых.
+    """
+
+    async def put(self, chat_id: int, update: Dict[str, Any]):
+        raise NotImplementedError
+
+    async def next_chat(self, timeout: float) -> Optional[int]:
+        raise NotImplementedError
+
+    async def try_lock(self, chat_id: int) -> Optional[str]:
+        raise NotImplementedError
+
+    async def refresh(self, chat_id: int, token: str):
+        pass
+
+    async def unlock(self, chat_id: int, token: str):
+        raise NotImplementedError
+
+    async def peek(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        """Первые limit обновлений чата без удаления из очереди"""
+        raise NotImplementedError
+
+    async def ack(self, chat_id: int, count: int):
+        """Удаление первых count обновлений чата после обработки"""
+        raise NotImplementedError
+
+    async def pending(self, chat_id: int) -> bool:
+        raise NotImplementedError
+
+    async def requeue(self, chat_id: int):
+        raise NotImplementedError
+
+    async def recover(self) -> int:
+        """Чаты с необработанными обновлениями и без владельца - снова в очередь готовых"""
+        return 0
+
+    async def close(self):
+        pass
+
+
+class MemoryUpdateQueue(UpdateQueue):
+    """Очередь в памяти: несколько воркеров одного процесса"""
+
+    def __init__(self):
+        self._chats: Dict[int, Deque[Dict[str, Any]]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._locked: Set[int] = set()
+
+    async def put(self, chat_id: int, update: Dict[str, Any]):
+        self._chats.setdefault(chat_id, deque()).append(update)
+        self._ready.put_nowait(chat_id)
+
+    async def next_chat(self, timeout: float) -> Optional[int]:
+        try:
+            return await asyncio.wait_for(self._ready.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def try_lock(self, chat_id: int) -> Optional[str]:
+        if chat_id in self._locked:
+            return None
+        self._locked.add(chat_id)
+        return "local"
+
+    async def unlock(self, chat_id: int, token: str):
+        self._locked.discard(chat_id)
+
+    async def peek(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        return list(itertools.islice(self._chats.get(chat_id, ()), limit))
+
+    async def ack(self, chat_id: int, count: int):
+        queue = self._chats.get(chat_id)
+        if not queue:
+            return
+        for _ in range(min(count, len(queue))):
+            queue.popleft()
+        if not queue:
+            del self._chats[chat_id]
+
+    async def pending(self, chat_id: int) -> bool:
+        return bool(self._chats.get(chat_id))
+
+    async def requeue(self, chat_id: int):
+        self._ready.put_nowait(chat_id)
+
+
+class RedisUpdateQueue(UpdateQueue):
+    """Общая очередь в Redis: воркеры всех реплик бота"""
+
+    def __init__(self, client, lock_ttl: float):
+        self.client = client
+        self.lock_ttl_ms = int(lock_ttl * 1000)
+        self._ready_key = f"{KEY_PREFIX}:ready"
+        self._chats_key = f"{KEY_PREFIX}:chats"
+        self._unlock = client.register_script(UNLOCK_SCRIPT)
+        self._refresh = client.register_script(REFRESH_SCRIPT)
+        self._ack = client.register_script(ACK_SCRIPT)
+
+    def _chat_key(self, chat_id: int) -> str:
+        return f"{KEY_PREFIX}:chat:{chat_id}"
+
+    def _lock_key(self, chat_id: int) -> str:
+        return f"{KEY_PREFIX}:chat:{chat_id}:lock"
+
+    async def put(self, chat_id: int, update: Dict[str, Any]):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.rpush(self._chat_key(chat_id), json.dumps(update, ensure_ascii=False))
+            pipe.sadd(self._chats_key, chat_id)
+            pipe.rpush(self._ready_key, chat_id)
+            await pipe.execute()
+
+    async def next_chat(self, timeout: float) -> Optional[int]:
+        result = await self.client.blpop([self._ready_key], timeout=max(1, int(timeout)))
+        return int(result[1]) if result else None
+
+    async def try_lock(self, chat_id: int) -> Optional[str]:
+        token = uuid.uuid4().hex
+        if await self.client.set(self._lock_key(chat_id), token, nx=True, px=self.lock_ttl_ms):
+            return token
+        return None
+
+    async def refresh(self, chat_id: int, token: str):
+        await self._refresh(keys=[self._lock_key(chat_id)], args=[token, self.lock_ttl_ms])
+
+    async def unlock(self, chat_id: int, token: str):
+        await self._unlock(keys=[self._lock_key(chat_id)], args=[token])
+
+    async def peek(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        raw = await self.client.lrange(self._chat_key(chat_id), 0, limit - 1)
+        return [json.loads(item) for item in raw]
+
+    async def ack(self, chat_id: int, count: int):
+        await self._ack(keys=[self._chat_key(chat_id), self._chats_key], args=[count, chat_id])
+
+    async def pending(self, chat_id: int) -> bool:
+        return await self.client.llen(self._chat_key(chat_id)) > 0
+
+    async def requeue(self, chat_id: int):
+        await self.client.rpush(self._ready_key, chat_id)
+
+    async def recover(self) -> int:
+        recovered = 0
+        for chat_id in await self.client.smembers(self._chats_key):
+            chat_id = int(chat_id)
+            if not await self.client.exists(self._lock_key(chat_id)):
+                await self.requeue(chat_id)
+                recovered += 1
+        return recovered
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_update_storage():
+    """Дедупликация и очередь обновлений для webhook-режима"""
+    if config.BOT_STORAGE == "redis":
+        import redis.asyncio as redis
+
+        # Отдельные клиенты: BLPOP занимает соединение на время ожидания
+        logger.info(f"Bot update storage: redis ({config.REDIS_URL})")
+        return (
+            RedisUpdateDeduplicator(redis.from_url(config.REDIS_URL), config.UPDATE_DEDUP_TTL),
+            RedisUpdateQueue(redis.from_url(config.REDIS_URL), config.UPDATE_LOCK_TTL)
+        )
+    logger.info("Bot update storage: memory")
+    return MemoryUpdateDeduplicator(config.UPDATE_DEDUP_TTL), MemoryUpdateQueue()
@@ -0,0 +1,240 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from bot.storage import UpdateDeduplicator, UpdateQueue
+from shared.config import config, logger
+from shared.metrics import registry, CONTENT_TYPE
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Сколько обновлений чата забирать из очереди за раз
+BATCH_LIMIT = 50
+
+# Счетчики webhook-сервера в приложении aiohttp
+STATS_KEY = web.AppKey("stats", Dict[str, int])
+
+
+def update_chat_id(update: Dict[str, Any]) -> int:
+    """Чат обновления: ключ упорядочивания (для обновлений без чата - пользователь)"""
+    for key, payload in update.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+    return 0
+
+
+def _is_plain_message(update: Dict[str, Any]) -> bool:
+    text = (update.get("message") or {}).get("text")
+    return bool(text) and not text.startswith("/")
+
+
+def _sender_id(update: Dict[str, Any]) -> Optional[int]:
+    return ((update.get("message") or {}).get("from") or {}).get("id")
+
+
+def ordered_groups(batch: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Разбиение пачки обновлений чата на последовательные группы.
+
+    Подряд идущие обычные сообщения образуют одну группу и уходят в backend одним
+    запросом; команды и прочие обновления обрабатываются по одному, после всего,
+    что пришло раньше них.
+    """
+    groups: List[List[Dict[str, Any]]] = []
+    for update in batch:
+        previous = groups[-1][-1] if groups else None
+        if (previous and _is_plain_message(update) and _is_plain_message(previous)
+                and _sender_id(update) == _sender_id(previous)):
+            groups[-1].append(update)
+        else:
+            groups.append([update])
+    return groups
+
+
+class UpdateWorkerPool:
+    """Воркеры, обрабатывающие очередь обновлений с сохранением порядка внутри чата"""
+
+    def __init__(self, bot: Bot, dp: Dispatcher, queue: UpdateQueue, workers: int):
+        self.bot = bot
+        self.dp = dp
+        self.queue = queue
+        self.workers = workers
+        self._tasks: List[asyncio.Task] = []
+        self._recovery: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats = {"processed": 0, "failed": 0, "merged": 0, "busy_chats_skipped": 0, "recovered": 0}
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._recovery = asyncio.create_task(self._recover())
+
+    async def stop(self, timeout: float = 30.0):
+        """Остановка: воркеры дообрабатывают взятые чаты, по таймауту - отмена"""
+        self._stopping = True
+        if self._recovery is not None:
+            self._recovery.cancel()
+        if self._tasks:
+            done, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _feed(self, group: List[Dict[str, Any]]):
+        update = group[-1]
+        kwargs = {}
+        if _is_plain_message(update):
+            # Серия сообщений склеивается здесь, UserDebounceMiddleware ее пропускает
+            kwargs["merged_text"] = "\n\n".join(item["message"]["text"] for item in group)
+            self.stats["merged"] += len(group) - 1
+        try:
+            await self.dp.feed_raw_update(self.bot, update, **kwargs)
+            self.stats["processed"] += len(group)
+        except Exception as e:
+            self.stats["failed"] += len(group)
+            logger.error(f"Failed to process update {update.get('update_id')}: {e}")
+
+    async def _collect_burst(self, chat_id: int, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Ожидание продолжения серии сообщений, как в UserDebounceMiddleware"""
+        deadline = time.monotonic() + config.BOT_DEBOUNCE_MAX_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(config.BOT_DEBOUNCE_WINDOW, deadline - time.monotonic()))
+            current = await self.queue.peek(chat_id, len(batch) + BATCH_LIMIT)
+            more = current[len(batch):]
+            batch = current
+            if not more or not _is_plain_message(more[-1]):
+                break
+        return batch
+
+    async def _keep_locked(self, chat_id: int, token: str):
+        """Продление блокировки чата, пока обрабатывается его обновление (ответ может ждать задачу минутами)"""
+        while True:
+            await asyncio.sleep(config.UPDATE_LOCK_TTL / 3)
+            try:
+                await self.queue.refresh(chat_id, token)
+            except Exception as e:
+                logger.warning(f"Failed to refresh lock of chat {chat_id}: {e}")
+
+    async def _drain(self, chat_id: int, token: str):
+        heartbeat = asyncio.create_task(self._keep_locked(chat_id, token))
+        try:
+            while True:
+                batch = await self.queue.peek(chat_id, BATCH_LIMIT)
+                if not batch:
+                    return
+                if config.BOT_DEBOUNCE_WINDOW > 0 and _is_plain_message(batch[-1]):
+                    batch = await self._collect_burst(chat_id, batch)
+                for group in ordered_groups(batch):
+                    await self._feed(group)
+                    # Обновления удаляются из очереди только после обработки: при падении их заберет другой воркер
+                    await self.queue.ack(chat_id, len(group))
+        finally:
+            heartbeat.cancel()
+
+    async def _recover(self):
+        """Возврат в очередь чатов, чей воркер упал, не дообработав обновления"""
+        while True:
+            await asyncio.sleep(config.UPDATE_LOCK_TTL)
+            try:
+                recovered = await self.queue.recover()
+            except Exception as e:
+                logger.error(f"Update queue recovery failed: {e}")
+                continue
+            if recovered:
+                self.stats["recovered"] += recovered
+                logger.info(f"Requeued {recovered} chats with unprocessed updates")
+
+    async def _worker(self):
+        while not self._stopping:
+            try:
+                chat_id = await self.queue.next_chat(timeout=1.0)
+                if chat_id is None:
+                    continue
+                token = await self.queue.try_lock(chat_id)
+                if token is None:
+                    # Чат уже обрабатывает другой воркер, он заберет и это обновление
+                    self.stats["busy_chats_skipped"] += 1
+                    continue
+                try:
+                    await self._drain(chat_id, token)
+                finally:
+                    await self.queue.unlock(chat_id, token)
+                # Обновления могли прийти между последней выборкой и снятием блокировки
+                if await self.queue.pending(chat_id):
+                    await self.queue.requeue(chat_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Update worker error: {e}")
+                await asyncio.sleep(1.0)
+
+
+def create_webhook_app(deduplicator: UpdateDeduplicator, queue: UpdateQueue) -> web.Application:
+    """aiohttp-приложение, принимающее обновления Telegram и ставящее их в очередь"""
+    stats = {"received": 0, "duplicates": 0}
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if config.WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != config.WEBHOOK_SECRET:
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+            return web.Response(status=400, text="Update without update_id")
+        stats["received"] += 1
+        if not await deduplicator.first_seen(update["update_id"]):
+            stats["duplicates"] += 1
+            return web.Response()
+
+        await queue.put(update_chat_id(update), update)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "healthy", "service": "telegram-bot", **stats})
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app[STATS_KEY] = stats
+    app.router.add_post(config.WEBHOOK_PATH, handle_update)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, deduplicator: UpdateDeduplicator, queue: UpdateQueue,
+                      stop_event: Optional[asyncio.Event] = None):
+    """Webhook-сервер и пул воркеров до остановки процесса"""
+    pool = UpdateWorkerPool(bot, dp, queue, config.BOT_WORKERS)
+    runner = web.AppRunner(create_webhook_app(deduplicator, queue))
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+
+    pool.start()
+    await site.start()
+    if config.WEBHOOK_URL:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS
+        )
+    logger.info(f"Webhook server listening on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+
+    try:
+        await (stop_event or asyncio.Event()).wait()
+    finally:
+        await runner.cleanup()
+        await pool.stop()
+        logger.info(f"Webhook worker pool stopped: {pool.stats}")
@@ -1,25 +1,219 @@
 import os
+from typing import Optional
 from pydantic_settings import BaseSettings
 import logging
 
 
 class Config(BaseSettings):
     # Telegram Bot
-    TELEGRAM_TOKEN: str = os.environ.get("TELEGRAM_TOKEN")
+    # Секреты проверяются при первом использовании, импорт конфигурации без них не падает
+    TELEGRAM_TOKEN: Optional[str] = None
 
     # OpenAI
-    OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY")
+    OPENAI_API_KEY: Optional[str] = None
     OPENAI_MODEL: str = "gpt-3.5-turbo"
+    OPENAI_BASE_URL: Optional[str] = None  # OpenAI-совместимый endpoint
+
+    # Провайдер модели: openai или mock (локальная заглушка для нагрузочных тестов)
+    LLM_PROVIDER: str = "openai"
+    MOCK_LLM_LATENCY: float = 0.2  # задержка до первого токена, сек
+    MOCK_LLM_TOKENS_PER_SECOND: float = 50.0
+    MOCK_LLM_RESPONSE_TOKENS: int = 60
+
+    # Ограничение одновременных запросов к модели, таймауты и повторы
+    LLM_MAX_CONCURRENCY: int = 32
+    LLM_MAX_CONCURRENCY_PER_USER: int = 2
+    LLM_QUEUE_TIMEOUT: float = 30.0
+    LLM_TIMEOUT: float = 60.0
+    LLM_RETRIES: int = 2
+    LLM_RETRY_DELAY: float = 0.5
+    LLM_HEDGE_DELAY: float = 0.0  # дублировать запрос, если нет ответа за N сек (0 - выключено)
+    LLM_MAX_TOKENS: int = 2000
+
+    # Уровни моделей: простые вопросы идут на быстрый уровень (если ROUTER_FAST_MODEL задан)
+    ROUTER_FAST_MODEL: Optional[str] = None
+    ROUTER_FAST_MAX_TOKENS: int = 800
+    ROUTER_FAST_TIMEOUT: float = 20.0
+    ROUTER_SIMPLE_MAX_CHARS: int = 400  # вопрос длиннее - на основной уровень
+    ROUTER_SIMPLE_MAX_HISTORY: int = 6  # ходов истории, больше - на основной уровень
+    # SLO уровней: p95 длительности запроса, сек, и доля ошибок за окно наблюдений
+    ROUTER_FAST_SLO_P95: float = 8.0
+    LLM_SLO_P95: float = 30.0
+    ROUTER_SLO_ERROR_RATE: float = 0.2
+    ROUTER_SLO_WINDOW: float = 300.0  # сек
+    ROUTER_SLO_MIN_SAMPLES: int = 20
+    # Цены за 1000 токенов, USD: для метрики стоимости
+    ROUTER_FAST_PROMPT_PRICE: float = 0.0
+    ROUTER_FAST_COMPLETION_PRICE: float = 0.0
+    LLM_PROMPT_PRICE: float = 0.0
+    LLM_COMPLETION_PRICE: float = 0.0
+
+    # Контекст запроса к модели
+    CONTEXT_TOKEN_BUDGET: int = 3000  # системный промпт + сводка + история + сообщение
+    CONTEXT_HISTORY_TURNS: int = 20  # последних ходов истории, которые читаются для промпта
+    CONTEXT_SUMMARIZATION: bool = True  # сворачивать вышедшие из окна ходы в сводку
+    SUMMARY_MAX_TOKENS: int = 300
+    CONTEXT_TRIM_TARGET: float = 0.75  # доля бюджета после сдвига окна истории (1.0 - сдвиг по одному ходу)
+    CONTEXT_SEGMENT_CACHE_USERS: int = 10000  # пользователей с закодированной историей в памяти
+    LLM_STREAM_USAGE: bool = True  # запрашивать usage в потоковых ответах (stream_options)
+
+    # Кеш ответов на повторяющиеся вопросы
+    RESPONSE_CACHE: bool = True
+    RESPONSE_CACHE_TTL: float = 86400.0
+    RESPONSE_CACHE_MAX_ENTRIES: int = 5000
+    RESPONSE_CACHE_MAX_HISTORY: int = 0  # кешировать только при истории не длиннее N ходов
+    RESPONSE_CACHE_SEMANTIC: bool = False  # поиск похожих вопросов по эмбеддингам (нужен numpy)
+    RESPONSE_CACHE_SIMILARITY: float = 0.95
+    RESPONSE_CACHE_EMBEDDING_MODEL: str = "text-embedding-3-small"
+
+    # База знаний: фрагменты внутренней документации в промпте (нужен numpy)
+    KNOWLEDGE_BASE: bool = False
+    KNOWLEDGE_DOCS_DIR: str = "docs"
+    KNOWLEDGE_INDEX_DIR: str = "knowledge_index"
+    KNOWLEDGE_BUILD_ON_START: bool = True  # обновить индекс при запуске (только измененные документы)
+    KNOWLEDGE_EMBEDDER: str = "hashing"  # hashing (локальный) или provider
+    KNOWLEDGE_EMBEDDING_MODEL: str = "text-embedding-3-small"
+    KNOWLEDGE_EMBEDDING_DIM: int = 256  # размерность hashing-эмбеддера
+    KNOWLEDGE_CHUNK_CHARS: int = 1000
+    KNOWLEDGE_CHUNK_OVERLAP: int = 150
+    KNOWLEDGE_BATCH_SIZE: int = 64  # фрагментов в одном запросе эмбеддингов
+    KNOWLEDGE_IVF_MIN_ROWS: int = 20000  # с этого размера поиск только по ближайшим спискам (IVF)
+    KNOWLEDGE_NPROBE: int = 16  # просматриваемых списков на запрос
+    KNOWLEDGE_TOP_K: int = 3
+    KNOWLEDGE_MIN_SCORE: float = 0.2  # косинусная близость, ниже - фрагмент не добавляется
+    KNOWLEDGE_MAX_CHARS: int = 2400  # суммарный размер фрагментов в промпте
 
     # Backend
     BACKEND_URL: str = "http://backend:8000"
+
+    # Лимиты пользователя в backend (0 - без ограничения)
+    RATE_LIMIT_REQUESTS: int = 20  # запросов к модели в скользящем окне
+    RATE_LIMIT_WINDOW: float = 60.0  # сек
+    DAILY_TOKEN_BUDGET: int = 200000  # токенов модели в сутки (UTC) по данным usage
+    QUOTA_STORE: str = "memory"  # memory (свой счетчик у каждого воркера) или redis
+    ADMIN_TOKEN: Optional[str] = None  # заголовок X-Admin-Token для /api/v1/admin, без него закрыты
+
+    # Фоновые задачи чата (/api/v1/jobs)
+    JOB_WORKERS: int = 8  # задач одновременно на воркер backend
+    JOB_QUEUE_MAX: int = 1000  # при заполнении новые задачи отклоняются с 503
+    JOB_STORE: str = "memory"  # memory или redis (нужен при BACKEND_WORKERS > 1)
+    JOB_RESULT_TTL: float = 3600.0  # сек хранения результата
+    JOB_LONG_POLL_MAX: float = 30.0  # максимальное ожидание в GET /jobs/{id}?wait=, сек
+    # Хосты, на которые backend отправляет callback задач, через запятую; пусто - callback выключены
+    JOB_CALLBACK_ALLOWED_HOSTS: str = ""
+    JOB_CALLBACK_SECRET: Optional[str] = None  # подпись тела callback (HMAC-SHA256)
+    JOB_CALLBACK_TIMEOUT: float = 10.0
+    JOB_CALLBACK_RETRIES: int = 3
+    JOB_CALLBACK_RETRY_DELAY: float = 1.0
+
+    # Потоковая выдача ответов в боте
+    BOT_STREAMING: bool = True
+    STREAM_EDIT_INTERVAL: float = 1.0  # минимальный интервал между правками сообщения, сек
+    BOT_USE_JOBS: bool = True  # без стриминга: задача в backend и long polling вместо долгого /chat
+    BOT_JOB_POLL_WAIT: float = 5.0  # ожидание в одном запросе опроса, сек (между опросами обновляется «печатает...»)
+    BOT_JOB_MAX_WAIT: float = 600.0  # сколько бот ждет ответа на задачу, сек
+
+    # Лимиты отправки в Telegram, сообщений в секунду
+    TELEGRAM_GLOBAL_RATE: float = 30.0
+    TELEGRAM_CHAT_RATE: float = 1.0
+    TELEGRAM_CHAT_BURST: float = 3.0
+    TELEGRAM_GROUP_RATE: float = 20 / 60
+    TELEGRAM_GROUP_BURST: float = 3.0
+    TELEGRAM_MAX_RETRIES: int = 3  # повторов после RetryAfter
+    BOT_FILE_THRESHOLD: int = 12000  # ответ с кодом длиннее - отправляется файлом, 0 - никогда
+
+    # Объединение серии быстрых сообщений пользователя в один запрос
+    BOT_DEBOUNCE_WINDOW: float = 0.5  # пауза, после которой серия считается завершенной, сек
+    BOT_DEBOUNCE_MAX_WAIT: float = 2.0
+
+    # Режим получения обновлений: polling (разработка) или webhook (несколько реплик)
+    BOT_MODE: str = "polling"
+    BOT_STORAGE: str = "memory"  # memory или redis: состояния FSM, дедупликация и очередь обновлений
+    BOT_WORKERS: int = 16  # воркеров обработки обновлений на процесс
+    WEBHOOK_URL: Optional[str] = None  # внешний адрес бота, при указании webhook регистрируется при старте
+    WEBHOOK_PATH: str = "/telegram/webhook"
+    WEBHOOK_SECRET: Optional[str] = None
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    UPDATE_DEDUP_TTL: float = 3600.0  # сек
+    UPDATE_LOCK_TTL: float = 60.0  # блокировка чата воркером, продлевается, пока чат обрабатывается
+
+    # HTTP-клиент бота к backend
+    BACKEND_MAX_CONNECTIONS: int = 100
+    BACKEND_MAX_KEEPALIVE: int = 20
+    BACKEND_KEEPALIVE_EXPIRY: float = 30.0
+    BACKEND_HTTP2: bool = False  # требует пакет h2
+    BACKEND_CONNECT_TIMEOUT: float = 5.0
+    BACKEND_CHAT_TIMEOUT: float = 30.0
+    BACKEND_CLEAR_TIMEOUT: float = 10.0
+    BACKEND_RETRIES: int = 3
+    BACKEND_RETRY_DELAY: float = 0.2
+    BACKEND_METRICS_LOG_INTERVAL: float = 60.0  # 0 - не логировать метрики пула
+
+    # Production-запуск backend (python -m backend.server)
+    BACKEND_HOST: str = "0.0.0.0"
+    BACKEND_PORT: int = 8000
+    BACKEND_WORKERS: int = 1  # 0 - по числу ядер
+    # Порядок запросов пользователя и объединение дубликатов: memory или redis (нужен при BACKEND_WORKERS > 1)
+    USER_LOCK_STORE: str = "memory"
+    USER_LOCK_TTL: float = 30.0  # сек, блокировка продлевается, пока запрос выполняется
+    DB_POOL_TOTAL_CONNECTIONS: int = 10  # бюджет соединений с Postgres на все воркеры
+    DB_POOL_MIN_SIZE: int = 1
+    SHUTDOWN_GRACE_PERIOD: float = 30.0  # сек на завершение запросов и фоновых задач
+    SHUTDOWN_DRAIN_DELAY: float = 0.0  # сек между SIGTERM (/ready - 503) и закрытием сокетов
+    LLM_UNHEALTHY_AFTER_FAILURES: int = 5  # подряд идущих ошибок модели до снятия готовности, 0 - не учитывать
+
     DATABASE_URL: str = f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/chatbot_db"
 
     # Redis (для кеширования)
     REDIS_URL: str = f"redis://{os.getenv('REDIS_HOST')}:{os.getenv('REDIS_PORT', '6379')}"
 
+    # Фоновая пакетная запись сообщений в БД (write-behind)
+    WRITE_BEHIND: bool = True
+    WRITE_QUEUE_SIZE: int = 1000
+    WRITE_BATCH_SIZE: int = 100
+    WRITE_FLUSH_INTERVAL: float = 0.05  # сек
+    WRITE_RETRIES: int = 5  # повторы пачки при ошибке БД, затем пачка отбрасывается
+    WRITE_RETRY_DELAY: float = 0.5  # сек, удваивается с каждым повтором
+
+    # Кеш истории разговоров: redis, memory или none
+    HISTORY_CACHE_BACKEND: str = "redis"
+    HISTORY_CACHE_SIZE: int = 20  # сообщений на пользователя
+    HISTORY_CACHE_TTL: float = 3600.0
+    HISTORY_CACHE_MAX_USERS: int = 10000  # только для memory
+
+    # Партиции conversations по месяцам и срок хранения истории
+    CONVERSATION_PARTITIONS_AHEAD: int = 2  # месяцев создается заранее
+    CONVERSATION_RETENTION_DAYS: int = 0  # 0 - хранить бессрочно
+    RETENTION_CHECK_INTERVAL: float = 3600.0  # сек
+    ARCHIVE_BEFORE_DROP: bool = True
+    ARCHIVE_DIR: str = "archive"
+    ARCHIVE_FORMAT: str = "jsonl"  # jsonl (gzip) или parquet (требует pyarrow)
+    ARCHIVE_BATCH_SIZE: int = 1000
+
+    # Постраничная выдача и экспорт истории
+    HISTORY_PAGE_MAX: int = 200
+    EXPORT_PREFETCH: int = 500  # строк за одно чтение серверного курсора
+
+    # Полнотекстовый поиск по истории
+    SEARCH_PAGE_MAX: int = 50
+    SEARCH_QUERY_MAX_LENGTH: int = 256
+    BOT_SEARCH_RESULTS: int = 5
+
+    # Кеш агрегатов статистики /stats, сек
+    USAGE_STATS_CACHE_TTL: float = 10.0
+
     # Логирование
     LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "json"  # json (строка JSON на запись) или text
+    LOG_FILE: Optional[str] = None  # файл с ротацией по размеру, кроме stderr; {pid} заменяется на pid процесса
+    LOG_FILE_MAX_BYTES: int = 50 * 1024 * 1024
+    LOG_FILE_BACKUPS: int = 5
+    LOG_QUEUE_SIZE: int = 10000  # записей в очереди фонового потока, сверх - отбрасываются
+    LOG_SAMPLE_RATE: float = 1.0  # доля запросов, чьи INFO-записи шумных логгеров попадают в лог
+    LOG_SAMPLED_LOGGERS: str = "backend.api.v1.router,backend.ai_agent,aiogram.event,httpx,uvicorn.access"
+    SLOW_REQUEST_THRESHOLD: float = 5.0  # сек, запросы дольше логируются с разбивкой по этапам
 
 
     class Config:
@@ -39,5 +233,5 @@ class Config(BaseSettings):
 
 # Создаем глобальный экземпляр конфигурации
 config = Config()
-logging.basicConfig(level=logging.INFO)
+# Обработчики логов настраивает точка входа процесса (shared.utils.setup_logging)
 logger = logging.getLogger(__name__)
\ No newline at end of file
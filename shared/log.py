@@ -0,0 +1,151 @@
+"""Неблокирующее логирование: запись в поток и файл выполняет фоновый поток.
+
+Обработчик в вызывающем коде только кладет запись в ограниченную очередь:
+форматирование сообщения, JSON и запись на диск происходят в потоке
+QueueListener, поэтому медленный диск не останавливает event loop. При
+переполненной очереди запись отбрасывается и учитывается в счетчике.
+"""
+import json
+import queue
+import random
+import zlib
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from shared.metrics import registry
+from shared.utils import trace_id_var, user_id_var
+
+LOG_RECORDS_DROPPED = registry.counter(
+    "log_records_dropped_total", "Записи лога, отброшенные из-за переполненной очереди", ["level"]
+)
+LOG_RECORDS_SAMPLED_OUT = registry.counter(
+    "log_records_sampled_out_total", "Записи лога, пропущенные сэмплированием", ["logger"]
+)
+LOG_QUEUE_DEPTH = registry.gauge("log_queue_depth", "Записи лога в очереди фонового потока")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+
+# Атрибуты LogRecord; остальные поля записи - это extra=... вызывающего кода
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "request_id", "user_id"
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON: время, уровень, логгер, сообщение, request_id, user_id и extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if getattr(record, "request_id", "-") != "-":
+            entry["request_id"] = record.request_id
+        if getattr(record, "user_id", None) is not None:
+            entry["user_id"] = record.user_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю rate записей INFO и ниже от шумных логгеров; WARNING и выше - всегда.
+
+    Решение принимается по request_id, поэтому запрос попадает в лог целиком или не попадает.
+    """
+
+    def __init__(self, rate: float, loggers: Iterable[str]):
+        super().__init__()
+        self.threshold = int(max(0.0, min(1.0, rate)) * 10000)
+        self.loggers = tuple(loggers)
+
+    def _sampled(self, name: str) -> bool:
+        return any(name == prefix or name.startswith(prefix + ".") for prefix in self.loggers)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.threshold >= 10000 or record.levelno > logging.INFO or not self._sampled(record.name):
+            return True
+        request_id = trace_id_var.get()
+        bucket = zlib.crc32(request_id.encode()) % 10000 if request_id != "-" else random.randrange(10000)
+        if bucket < self.threshold:
+            return True
+        LOG_RECORDS_SAMPLED_OUT.inc(logger=record.name)
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке и без ожидания места в очереди"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Контекст запроса читается здесь: в потоке записи contextvars уже другие.
+        # Сообщение форматируется в потоке записи (аргументы не должны меняться после вызова)
+        record.request_id = trace_id_var.get()
+        record.user_id = user_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc(level=record.levelname)
+
+
+class BlockingSentinelListener(logging.handlers.QueueListener):
+    """При остановке ждет места под маркер конца: полная очередь не должна мешать выходу"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Очередь, обработчик корневого логгера и фоновый поток записи"""
+
+    def __init__(self, level: str, log_format: str = "json", log_file: Optional[str] = None,
+                 max_bytes: int = 50 * 1024 * 1024, backups: int = 5, queue_size: int = 10000,
+                 sample_rate: float = 1.0, sampled_loggers: Iterable[str] = ()):
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        formatter = JsonFormatter() if log_format.lower() == "json" else logging.Formatter(TEXT_FORMAT)
+        handlers: List[logging.Handler] = [logging.StreamHandler()]
+        if log_file:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            ))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.handler.addFilter(SamplingFilter(sample_rate, sampled_loggers))
+        self.listener = BlockingSentinelListener(self.queue, *handlers)
+        self.running = False
+        self.level = getattr(logging, level.upper(), logging.INFO)
+        LOG_QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    def install(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+        self.running = True
+
+    def stop(self):
+        """Дописать очередь и остановить поток записи"""
+        if not self.running:
+            return
+        self.running = False
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
@@ -1,22 +1,63 @@
+import atexit
 import logging
+import os
 import asyncio
+import contextvars
 from functools import wraps
-from typing import Callable, Any
+from typing import Callable, Any, Optional, Sequence, Tuple, Type
 import time
 
+# Идентификатор запроса, передается от бота в backend заголовком X-Request-ID
+trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+# Пользователь текущего запроса, попадает в записи лога
+user_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("user_id", default=None)
 
-def setup_logging(level: str = "INFO"):
-    logging.basicConfig(
-        level=getattr(logging, level.upper()),
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler('app.log')
-        ]
+_log_pipeline = None
+
+
+def process_log_file(path: Optional[str]) -> Optional[str]:
+    """Файл лога процесса: {pid} в пути заменяется на pid, чтобы процессы не ротировали один файл"""
+    return path.replace("{pid}", str(os.getpid())) if path else path
+
+
+def setup_logging(level: Optional[str] = None, log_file: Optional[str] = None):
+    """Настройка логирования процесса по LOG_*; повторный вызов ничего не меняет.
+
+    Записи уходят в ограниченную очередь, в поток и файл их пишет фоновый поток (shared.log).
+    """
+    global _log_pipeline
+    if _log_pipeline is not None:
+        return
+    from shared.config import config
+    from shared.log import LogPipeline
+
+    _log_pipeline = LogPipeline(
+        level=level or config.LOG_LEVEL,
+        log_format=config.LOG_FORMAT,
+        log_file=process_log_file(log_file or config.LOG_FILE),
+        max_bytes=config.LOG_FILE_MAX_BYTES,
+        backups=config.LOG_FILE_BACKUPS,
+        queue_size=config.LOG_QUEUE_SIZE,
+        sample_rate=config.LOG_SAMPLE_RATE,
+        sampled_loggers=[name.strip() for name in config.LOG_SAMPLED_LOGGERS.split(",") if name.strip()]
     )
+    _log_pipeline.install()
+    # Очередь дописывается и при обычном завершении процесса
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Дописать записи из очереди и остановить фоновый поток"""
+    global _log_pipeline
+    if _log_pipeline is not None:
+        _log_pipeline.stop()
 
 
-def retry_async(max_retries: int = 3, delay: float = 1.0):
+def retry_async(
+        max_retries: int = 3,
+        delay: float = 1.0,
+        exceptions: Tuple[Type[BaseException], ...] = (Exception,)
+):
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         async def wrapper(*args, **kwargs) -> Any:
@@ -25,7 +66,7 @@ def retry_async(max_retries: int = 3, delay: float = 1.0):
             for attempt in range(max_retries):
                 try:
                     return await func(*args, **kwargs)
-                except Exception as e:
+                except exceptions as e:
                     last_exception = e
                     if attempt < max_retries - 1:
                         await asyncio.sleep(delay * (2 ** attempt))
@@ -49,4 +90,13 @@ def measure_time(func: Callable) -> Callable:
 
         return result
 
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Перцентиль q (0..100) по выборке значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
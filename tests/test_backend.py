@@ -0,0 +1,1316 @@
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import random
+import signal
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import fakeredis.aioredis
+import httpx
+import numpy as np
+import pytest
+import uvicorn
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from backend.ai_agent import AIAgent
+from backend.cache import MemoryHistoryCache, RedisHistoryCache, create_history_cache
+from backend.concurrency import ConcurrencyLimiter, SharedUserLocks, UserSerializer, hedged
+from backend.context import ContextBuilder
+from backend.database import DatabaseManager, utcnow
+from backend.jobs import SIGNATURE_HEADER, JobManager, MemoryJobStore
+from backend.knowledge import HashingEmbedder, KnowledgeIndex
+from backend import migrations
+from backend.migrations import Migration, add_months, migrate, parse_partition_month, partition_name
+from backend.providers import Completion, MockProvider, OpenAIProvider
+from backend import quotas
+from backend.quotas import MemoryQuotaStore, QuotaExceededError, QuotaManager
+from backend.retention import RetentionManager
+from backend.response_cache import ResponseCache
+from backend import routing
+from backend.routing import ModelRouter, ModelTier
+from backend.search import InvertedIndex, decode_search_cursor, encode_search_cursor
+from backend import server as backend_server
+from backend.server import DrainingServer
+import backend.utils as state
+from shared.config import config
+from shared.metrics import Registry
+from shared.utils import process_log_file
+
+
+def turn(i: int):
+    return {"user_message": f"q{i}", "ai_response": f"a{i}", "created_at": f"2024-01-01T00:00:{i:02d}"}
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetch(self, query, user_id, limit):
+        self.pool.fetches += 1
+        await self.pool.fetch_gate.wait()
+        rows = [row for row in self.pool.rows if row["user_id"] == user_id]
+        return list(reversed(rows))[:limit]
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.pool.copies += 1
+        if self.pool.copy_failures:
+            self.pool.copy_failures -= 1
+            raise ConnectionError("connection reset")
+        self.pool.rows.extend(dict(zip(columns, record)) for record in records)
+
+    async def execute(self, query, user_id):
+        if "DELETE FROM conversations" in query:
+            self.pool.rows = [row for row in self.pool.rows if row["user_id"] != user_id]
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class FakePool:
+    """Пул asyncpg в памяти: только запросы истории, COPY и очистка"""
+
+    def __init__(self):
+        self.rows = []
+        self.fetches = 0
+        self.copies = 0
+        self.copy_failures = 0
+        self.fetch_gate = asyncio.Event()
+        self.fetch_gate.set()
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield FakeConnection(self)
+
+
+class BrokenPipeline:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    async def execute(self):
+        raise RedisConnectionError("connection refused")
+
+
+class BrokenRedis:
+    """Redis, который отвечает ошибкой на любую команду"""
+
+    def __getattr__(self, name):
+        async def fail(*args, **kwargs):
+            raise RedisConnectionError("connection refused")
+        return fail
+
+    def pipeline(self, transaction=True):
+        return BrokenPipeline()
+
+    def register_script(self, script):
+        return self.evalsha
+
+
+def make_db(cache) -> DatabaseManager:
+    db = DatabaseManager(history_cache=cache)
+    db.pool = FakePool()
+    return db
+
+
+def make_write_behind_db(monkeypatch, retry_delay: float = 0.01) -> DatabaseManager:
+    """БД в режиме write-behind с быстрыми повторами записи"""
+    monkeypatch.setattr(config, "WRITE_FLUSH_INTERVAL", 0.01)
+    monkeypatch.setattr(config, "WRITE_RETRIES", 2)
+    monkeypatch.setattr(config, "WRITE_RETRY_DELAY", retry_delay)
+    db = make_db(None)
+    db._write_queue = asyncio.Queue()
+    db._writer_task = asyncio.create_task(db._writer())
+    return db
+
+
+async def fill(cache, user_id, items):
+    await cache.set(user_id, items, await cache.version(user_id))
+
+
+@pytest.fixture(params=["memory", "redis"])
+def cache(request):
+    if request.param == "memory":
+        return MemoryHistoryCache(size=5, ttl=60, max_users=100)
+    return RedisHistoryCache(fakeredis.aioredis.FakeRedis(), size=5, ttl=60)
+
+
+@pytest.mark.asyncio
+async def test_cache_miss_then_hit(cache):
+    assert await cache.get(1, 5) is None
+    await fill(cache, 1, [turn(i) for i in range(8)])
+    assert await cache.get(1, 3) == [turn(5), turn(6), turn(7)]
+    # В кеше остаются только последние size сообщений
+    assert await cache.get(1, 10) == [turn(i) for i in range(3, 8)]
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+@pytest.mark.asyncio
+async def test_cache_append_only_for_cached_user(cache):
+    await cache.append(1, turn(0))
+    assert await cache.get(1, 5) is None
+
+    await fill(cache, 1, [turn(0)])
+    await cache.append(1, turn(1))
+    assert await cache.get(1, 5) == [turn(0), turn(1)]
+
+
+@pytest.mark.asyncio
+async def test_cache_append_after_invalidate_is_ignored(cache):
+    await fill(cache, 1, [turn(0), turn(1)])
+    await cache.invalidate(1)
+    await cache.append(1, turn(2))
+    # Неполный список из одного нового сообщения не создается
+    assert await cache.get(1, 5) is None
+
+
+@pytest.mark.asyncio
+async def test_cache_set_skipped_after_concurrent_append(cache):
+    version = await cache.version(1)
+    # Другой воркер сохранил сообщение, пока это чтение ждало БД
+    await cache.append(1, turn(1))
+    await cache.set(1, [turn(0)], version)
+    assert await cache.get(1, 5) is None
+
+    await fill(cache, 1, [turn(0), turn(1)])
+    assert await cache.get(1, 5) == [turn(0), turn(1)]
+
+
+@pytest.mark.asyncio
+async def test_redis_cache_version_shared_between_workers():
+    redis = fakeredis.aioredis.FakeRedis()
+    first = RedisHistoryCache(redis, size=5, ttl=60)
+    second = RedisHistoryCache(redis, size=5, ttl=60)
+    version = await first.version(1)
+    await second.invalidate(1)
+    await first.set(1, [turn(0)], version)
+    assert await second.get(1, 5) is None
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_evicts_least_recent_user():
+    cache = MemoryHistoryCache(size=5, ttl=60, max_users=2)
+    await fill(cache, 1, [turn(1)])
+    await fill(cache, 2, [turn(2)])
+    await cache.get(1, 5)
+    await fill(cache, 3, [turn(3)])
+    assert await cache.get(2, 5) is None
+    assert await cache.get(1, 5) == [turn(1)]
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_expires_entries():
+    cache = MemoryHistoryCache(size=5, ttl=0.01, max_users=10)
+    await fill(cache, 1, [turn(0)])
+    await asyncio.sleep(0.02)
+    assert await cache.get(1, 5) is None
+
+
+@pytest.mark.asyncio
+async def test_redis_errors_are_misses():
+    cache = RedisHistoryCache(BrokenRedis(), size=5, ttl=60)
+    assert await cache.get(1, 5) is None
+    await fill(cache, 1, [turn(0)])
+    await cache.append(1, turn(1))
+    await cache.invalidate(1)
+    assert cache.misses == 1
+    assert cache.errors >= 4
+
+
+@pytest.mark.asyncio
+async def test_create_history_cache_falls_back_to_memory(monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_CACHE_BACKEND", "redis")
+    monkeypatch.setattr(config, "REDIS_URL", "redis://127.0.0.1:1/0")
+    cache = await create_history_cache()
+    assert isinstance(cache, MemoryHistoryCache)
+
+
+@pytest.mark.asyncio
+async def test_history_served_from_cache_after_first_read(cache):
+    db = make_db(cache)
+    await db.save_message(1, "q0", "a0")
+    first = await db.get_conversation_history(1, 5)
+    second = await db.get_conversation_history(1, 5)
+    assert [item["user_message"] for item in second] == ["q0"]
+    assert second == first
+    assert db.pool.fetches == 1
+
+
+@pytest.mark.asyncio
+async def test_history_read_from_database_on_redis_errors():
+    db = make_db(RedisHistoryCache(BrokenRedis(), size=5, ttl=60))
+    await db.save_message(1, "q0", "a0")
+    history = await db.get_conversation_history(1, 5)
+    assert [item["user_message"] for item in history] == ["q0"]
+
+
+@pytest.mark.asyncio
+async def test_save_after_clear_conversation(cache):
+    db = make_db(cache)
+    await db.save_message(1, "old", "a")
+    await db.get_conversation_history(1, 5)
+    await db.clear_conversation(1)
+    await db.save_message(1, "new", "a")
+
+    # append после очистки не восстанавливает кеш: история читается из БД
+    assert await cache.get(1, 5) is None
+    history = await db.get_conversation_history(1, 5)
+    assert [item["user_message"] for item in history] == ["new"]
+
+
+@pytest.mark.asyncio
+async def test_stale_read_is_not_cached(cache):
+    db = make_db(cache)
+    await db.save_message(1, "q0", "a0")
+    db.pool.fetch_gate.clear()
+    read = asyncio.create_task(db.get_conversation_history(1, 5))
+    while not db.pool.fetches:
+        await asyncio.sleep(0)
+
+    # Сообщение сохранено, пока чтение ждало БД: снимок чтения устарел
+    await db.save_message(1, "q1", "a1")
+    db.pool.fetch_gate.set()
+    await read
+
+    assert await cache.get(1, 5) is None
+    history = await db.get_conversation_history(1, 5)
+    assert [item["user_message"] for item in history] == ["q0", "q1"]
+
+
+@pytest.mark.asyncio
+async def test_write_behind_retries_flaky_copy(monkeypatch):
+    db = make_write_behind_db(monkeypatch)
+    db.pool.copy_failures = 1
+    await db.save_message(1, "q0", "a0")
+    await db.drain_writes()
+
+    assert [row["user_message"] for row in db.pool.rows] == ["q0"]
+    assert db.pool.copies == 2
+    assert db.write_stats["failed"] == 1
+    assert db.write_stats["written"] == 1
+    assert db.write_stats["dropped"] == 0
+
+
+@pytest.mark.asyncio
+async def test_write_behind_drops_batch_after_retries(monkeypatch):
+    db = make_write_behind_db(monkeypatch)
+    db.pool.copy_failures = 100
+    await db.save_message(1, "q0", "a0")
+    # Пока запись повторяется, ход виден в истории
+    assert [item["user_message"] for item in await db.get_conversation_history(1, 5)] == ["q0"]
+    await db.drain_writes()
+
+    assert db.pool.rows == []
+    assert db.pool.copies == config.WRITE_RETRIES + 1
+    assert db.write_stats["dropped"] == 1
+    assert await db.get_conversation_history(1, 5) == []
+
+
+@pytest.mark.asyncio
+async def test_clear_conversation_does_not_wait_for_write_retries(monkeypatch):
+    db = make_write_behind_db(monkeypatch, retry_delay=5.0)
+    db.pool.copy_failures = 1
+    await db.save_message(1, "q0", "a0")
+    while not db.write_stats["failed"]:
+        await asyncio.sleep(0.01)
+
+    # Писатель ждет повтора, но блокировку записи не держит
+    await asyncio.wait_for(db.clear_conversation(1), 0.5)
+    assert db._pending == {}
+    db._writer_task.cancel()
+    await asyncio.gather(db._writer_task, return_exceptions=True)
+
+
+class FakeRollupPool:
+    """Таблицы агрегатов usage_* вместо Postgres: считает чтения итогов"""
+
+    def __init__(self, totals, hourly, daily):
+        self.totals = totals
+        self.hourly = hourly
+        self.daily = daily
+        self.loads = 0
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield self
+
+    async def fetchrow(self, query):
+        self.loads += 1
+        await asyncio.sleep(0.01)
+        return self.totals
+
+    async def fetchval(self, query, since):
+        return sum(count for hour, count in self.hourly.items() if hour >= since)
+
+    async def fetch(self, query, since):
+        self.loads += 1
+        if "usage_hourly" in query:
+            return [{"hour": hour, "message_count": count} for hour, count in sorted(self.hourly.items()) if hour > since]
+        return [{"day": day, "active_users": users} for day, users in sorted(self.daily.items()) if day > since]
+
+
+def rollup_db(monkeypatch, ttl: float = 60.0) -> DatabaseManager:
+    monkeypatch.setattr(config, "USAGE_STATS_CACHE_TTL", ttl)
+    hour = utcnow().replace(minute=0, second=0, microsecond=0)
+    db = DatabaseManager()
+    db.pool = FakeRollupPool(
+        totals={"total_messages": 7, "unique_users": 2},
+        hourly={hour: 3, hour - timedelta(hours=2): 2, hour - timedelta(hours=30): 2},
+        daily={hour.date(): 2, hour.date() - timedelta(days=2): 1}
+    )
+    return db
+
+
+@pytest.mark.asyncio
+async def test_usage_stats_read_from_rollups_once_per_ttl(monkeypatch):
+    db = rollup_db(monkeypatch, ttl=0.05)
+    results = await asyncio.gather(*[db.get_usage_stats() for _ in range(5)])
+    assert results == [{"total_messages": 7, "unique_users": 2, "messages_last_24h": 5}] * 5
+    # Одновременные промахи кеша выполняют один запрос
+    assert db.pool.loads == 1
+
+    await asyncio.sleep(0.06)
+    await db.get_usage_stats()
+    assert db.pool.loads == 2
+
+
+@pytest.mark.asyncio
+async def test_usage_series_fills_empty_buckets(monkeypatch):
+    db = rollup_db(monkeypatch)
+    series = await db.get_usage_series(hours=4, days=3)
+
+    assert [point["messages"] for point in series["messages_per_hour"]] == [0, 2, 0, 3]
+    assert [point["users"] for point in series["active_users_per_day"]] == [1, 0, 2]
+    hours = [datetime.fromisoformat(point["hour"]) for point in series["messages_per_hour"]]
+    assert all(later - earlier == timedelta(hours=1) for earlier, later in zip(hours, hours[1:]))
+
+
+class FakeSummaryStore:
+    def __init__(self, summary=None, turns=()):
+        self.summary = summary
+        self.turns = list(turns)
+        self.saved = []
+
+    async def get_summary(self, user_id):
+        return self.summary
+
+    async def get_turns_between(self, user_id, after, before, limit):
+        return [
+            item for item in self.turns
+            if (after is None or datetime.fromisoformat(item["created_at"]) > after)
+            and datetime.fromisoformat(item["created_at"]) < before
+        ][:limit]
+
+    async def save_summary(self, user_id, summary, summarized_until):
+        self.saved.append((summary, summarized_until))
+        self.summary = {"summary": summary, "summarized_until": summarized_until}
+
+
+def summary_recorder():
+    summarized = []
+
+    async def summarize(user_id, previous, turns):
+        summarized.extend(item["user_message"] for item in turns)
+        return previous + "+"
+
+    return summarized, summarize
+
+
+def prompt_questions(messages):
+    return [message["content"] for message in messages if message["role"] == "user"][:-1]
+
+
+@pytest.mark.asyncio
+async def test_summary_takes_turns_after_summarized_until():
+    store = FakeSummaryStore({"summary": "s", "summarized_until": datetime(2024, 1, 1, 0, 0, 10)})
+    summarized = []
+
+    async def summarize(user_id, previous, turns):
+        summarized.extend(item["user_message"] for item in turns)
+        return previous + "+"
+
+    context = ContextBuilder(count_tokens=len, budget=120, summary_store=store, summarize=summarize)
+    # Время с микросекундами и без них: порядок определяется значением, а не строкой
+    times = ["2024-01-01T00:00:09.500000", "2024-01-01T00:00:10", "2024-01-01T00:00:10.250000",
+             "2024-01-01T00:00:11", "2024-01-01T00:00:12"]
+    history = [{"user_message": f"q{i}", "ai_response": "a" * 20, "created_at": at} for i, at in enumerate(times)]
+    await context.build("system", "question", 1, history)
+    await context.drain(1.0)
+
+    assert summarized == ["q2", "q3"]
+    assert store.saved == [("s+", datetime(2024, 1, 1, 0, 0, 11))]
+
+
+@pytest.mark.asyncio
+async def test_every_turn_is_in_prompt_or_summary_beyond_history_window():
+    turns = [turn(i) for i in range(45)]
+    store = FakeSummaryStore(turns=turns)
+    summarized, summarize = summary_recorder()
+    # Короткие ходы: все 20 прочитанных помещаются в бюджет и сами из окна не вытесняются
+    context = ContextBuilder(count_tokens=len, budget=10000, summary_store=store, summarize=summarize,
+                             trim_target=0.75, history_turns=20)
+
+    for n in range(1, len(turns) + 1):
+        built = await context.build("system", "question", 1, turns[max(0, n - 20):n])
+        await context.drain(1.0)
+
+    in_prompt = prompt_questions(built.messages)
+    assert len(summarized) == len(set(summarized))
+    assert summarized + in_prompt == [item["user_message"] for item in turns]
+
+
+@pytest.mark.asyncio
+async def test_turns_older_than_history_window_are_summarized():
+    # Давняя история без сводки: ходы до выборки дочитываются из хранилища
+    turns = [turn(i) for i in range(30)]
+    store = FakeSummaryStore(turns=turns)
+    summarized, summarize = summary_recorder()
+    context = ContextBuilder(count_tokens=len, budget=10000, summary_store=store, summarize=summarize,
+                             trim_target=0.75, history_turns=20)
+    built = await context.build("system", "question", 1, turns[10:])
+    await context.drain(1.0)
+
+    in_prompt = prompt_questions(built.messages)
+    assert summarized + in_prompt == [item["user_message"] for item in turns]
+    assert store.summary["summarized_until"] == datetime.fromisoformat(turns[14]["created_at"])
+
+
+def counting_tokens():
+    """len как счетчик токенов с журналом закодированных строк"""
+    counted = []
+
+    def count(text):
+        counted.append(text)
+        return len(text)
+
+    return counted, count
+
+
+@pytest.mark.asyncio
+async def test_prompt_prefix_and_turns_encoded_once():
+    counted, count = counting_tokens()
+    context = ContextBuilder(count_tokens=count, budget=10000)
+    history = [turn(i) for i in range(3)]
+    await context.build("system", "question", 1, history)
+    await context.build("system", "next question", 1, history + [turn(3)])
+
+    assert counted.count("system") == 1
+    assert context.prefix("system") is context.prefix("system")
+    # Второй запрос кодирует только новый ход и вопрос
+    assert (context.encoded_turns, context.reused_turns) == (4, 3)
+    assert sum(text in ("q0", "a0") for text in counted) == 2
+
+
+@pytest.mark.asyncio
+async def test_prompt_prefix_stays_stable_while_window_is_pinned():
+    # Ход занимает 18 токенов со служебными, в бюджет помещаются 10 ходов, после сдвига остается половина
+    context = ContextBuilder(count_tokens=len, budget=190, trim_target=0.5)
+    history = [{"user_message": f"q{i:02d}", "ai_response": "a" * 7, "created_at": f"2024-01-01T00:00:{i:02d}"}
+               for i in range(20)]
+    prompts = []
+    for n in range(1, len(history) + 1):
+        built = await context.build("s", "?", 1, history[:n])
+        assert built.prompt_tokens <= 190
+        prompts.append(built.messages)
+
+    # Промпт продолжает предыдущий, пока история помещается; переполнение сдвигает окно сразу на блок
+    shifts = [n for n, (earlier, later) in enumerate(zip(prompts, prompts[1:]), start=2)
+              if later[:len(earlier) - 1] != earlier[:-1]]
+    assert shifts == [11, 17]
+    assert prompt_questions(prompts[10]) == [f"q{i:02d}" for i in range(6, 11)]
+
+
+def test_openai_usage_reports_cached_prompt_tokens():
+    usage = SimpleNamespace(prompt_tokens=1200, completion_tokens=50,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+    assert OpenAIProvider._usage(usage) == {"prompt_tokens": 1200, "completion_tokens": 50, "cached_tokens": 1024}
+    usage.prompt_tokens_details = None
+    assert "cached_tokens" not in OpenAIProvider._usage(usage)
+
+
+def write_docs(path, docs):
+    path.mkdir(parents=True, exist_ok=True)
+    for name, text in docs.items():
+        (path / name).write_text(text, encoding="utf-8")
+
+
+def topic(i: int) -> str:
+    return f"документ {i} описывает тему{i} и настройку параметр{i} сервиса"
+
+
+async def build(index, docs_dir):
+    return await index.build(str(docs_dir), HashingEmbedder(128), chunk_chars=500, chunk_overlap=50, batch_size=4)
+
+
+async def top_sources(index, query: str, k: int = 1):
+    vector = (await HashingEmbedder(128).embed([query]))[0]
+    return [chunk.source for chunk in index.chunks(index.search(vector, k))]
+
+
+@pytest.mark.asyncio
+async def test_knowledge_incremental_rebuild(tmp_path):
+    docs_dir = tmp_path / "docs"
+    write_docs(docs_dir, {f"doc{i}.md": topic(i) for i in range(8)})
+    index = KnowledgeIndex(str(tmp_path / "index"))
+    assert await build(index, docs_dir) == {"added": 8, "updated": 0, "removed": 0, "unchanged": 0, "chunks": 8}
+    rows = {source: tuple(item["rows"]) for source, item in index.manifest["sources"].items()}
+
+    (docs_dir / "doc1.md").write_text(topic(100), encoding="utf-8")
+    (docs_dir / "doc2.md").unlink()
+    stats = await build(index, docs_dir)
+
+    assert stats == {"added": 0, "updated": 1, "removed": 1, "unchanged": 6, "chunks": 1}
+    # Строки старой версии и удаленного документа помечены, новая версия дописана в конец
+    assert sorted(map(tuple, index.manifest["deleted"])) == sorted([rows["doc1.md"], rows["doc2.md"]])
+    assert index.manifest["sources"]["doc1.md"]["rows"] == [8, 9]
+    assert (index.count, index.active) == (9, 7)
+    assert await top_sources(index, topic(100)) == ["doc1.md"]
+    assert "doc2.md" not in await top_sources(index, topic(2), k=7)
+    # Неизмененные документы не перекодируются
+    assert await build(index, docs_dir) == {"added": 0, "updated": 0, "removed": 0, "unchanged": 7, "chunks": 0}
+    index.close()
+
+
+@pytest.mark.asyncio
+async def test_knowledge_compaction(tmp_path):
+    docs_dir = tmp_path / "docs"
+    write_docs(docs_dir, {f"doc{i}.md": topic(i) for i in range(8)})
+    index = KnowledgeIndex(str(tmp_path / "index"))
+    await build(index, docs_dir)
+
+    for i in range(5):
+        (docs_dir / f"doc{i}.md").unlink()
+    await build(index, docs_dir)
+
+    # Больше четверти строк удалено: индекс переписан без них
+    assert index.manifest["deleted"] == []
+    assert index.count == index.active == 3
+    assert sorted(item["rows"] for item in index.manifest["sources"].values()) == [[0, 1], [1, 2], [2, 3]]
+    assert (tmp_path / "index" / "vectors.f32").stat().st_size == 3 * 128 * 4
+    for i in range(5, 8):
+        assert await top_sources(index, topic(i)) == [f"doc{i}.md"]
+    index.close()
+
+
+@pytest.mark.asyncio
+async def test_knowledge_ivf_matches_brute_force(tmp_path):
+    rng = random.Random(0)
+    words = [f"слово{i}" for i in range(300)]
+    docs_dir = tmp_path / "docs"
+    write_docs(docs_dir, {f"doc{i}.md": " ".join(rng.sample(words, 12)) for i in range(400)})
+    index = KnowledgeIndex(str(tmp_path / "index"), ivf_min_rows=100, nprobe=4)
+    await build(index, docs_dir)
+    nlist = index.manifest["ivf"]["nlist"]
+    assert nlist == 20
+
+    vectors = np.fromfile(tmp_path / "index" / "vectors.f32", dtype=np.float32).reshape(index.count, 128)
+    queries = await HashingEmbedder(128).embed([" ".join(rng.sample(words, 6)) for _ in range(30)])
+    index.nprobe = nlist
+    for query in queries:
+        # Просмотр всех списков дает тот же top-k, что и полный перебор (с точностью до равных оценок)
+        scores = [score for _, score in index.search(query, 5)]
+        assert scores == pytest.approx(sorted(vectors @ query, reverse=True)[:5])
+
+    # Строка лежит в списке ближайшего к ней центроида: запрос ее же вектором находит ее и при nprobe=1
+    index.nprobe = 1
+    for row in range(0, index.count, 37):
+        assert index.search(vectors[row], 1)[0][0] == row
+    index.close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(state, "draining", False)
+    return DrainingServer(uvicorn.Config("backend.main:app"))
+
+
+def test_sigterm_marks_draining_before_exit(server, monkeypatch):
+    monkeypatch.setattr(config, "SHUTDOWN_DRAIN_DELAY", 0.0)
+    server.handle_exit(signal.SIGTERM, None)
+    assert state.draining and server.should_exit
+
+
+@pytest.mark.asyncio
+async def test_sigterm_waits_drain_delay(server, monkeypatch):
+    monkeypatch.setattr(config, "SHUTDOWN_DRAIN_DELAY", 0.05)
+    server.handle_exit(signal.SIGTERM, None)
+    # /ready уже отвечает 503, а сокеты еще открыты
+    assert state.draining and not server.should_exit
+    await asyncio.sleep(0.1)
+    assert server.should_exit
+
+
+@pytest.mark.asyncio
+async def test_second_signal_exits_immediately(server, monkeypatch):
+    monkeypatch.setattr(config, "SHUTDOWN_DRAIN_DELAY", 10.0)
+    server.handle_exit(signal.SIGTERM, None)
+    server.handle_exit(signal.SIGTERM, None)
+    assert server.should_exit
+
+
+@pytest.mark.asyncio
+async def test_user_serializer_keeps_arrival_order_per_user():
+    serializer = UserSerializer()
+    events = []
+
+    async def request(user_id, name, duration):
+        async with serializer.lock(user_id):
+            events.append(f"{name} start")
+            await asyncio.sleep(duration)
+            events.append(f"{name} end")
+
+    await asyncio.gather(request(1, "a", 0.05), request(1, "b", 0), request(2, "other", 0.01))
+    assert events.index("a end") < events.index("b start")
+    # Запросы другого пользователя не ждут
+    assert events.index("other end") < events.index("a end")
+    assert serializer.stats()["serialized"] == 1
+    assert serializer.stats()["active_users"] == 0
+
+
+@pytest.mark.asyncio
+async def test_user_serializer_joins_identical_requests():
+    serializer = UserSerializer()
+    calls = 0
+
+    async def answer():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.02)
+        return "ответ"
+
+    results = await asyncio.gather(*[serializer.run_once((1, "hi"), answer) for _ in range(3)])
+    assert results == ["ответ"] * 3
+    assert calls == 1
+    assert serializer.stats()["joined"] == 2
+    # Завершенный запрос не кешируется: следующий выполняется заново
+    await serializer.run_once((1, "hi"), answer)
+    assert calls == 2
+
+
+def worker_serializers(count: int = 2):
+    """Сериализаторы воркеров с общим Redis"""
+    redis = fakeredis.aioredis.FakeRedis()
+    return [UserSerializer(SharedUserLocks(redis, ttl=1.0, poll_interval=0.01)) for _ in range(count)]
+
+
+@pytest.mark.asyncio
+async def test_shared_user_lock_orders_requests_across_workers():
+    first, second = worker_serializers()
+    events = []
+
+    async def request(serializer, name):
+        async with serializer.lock(1):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.05)
+            events.append(f"{name} end")
+
+    task = asyncio.create_task(request(first, "a"))
+    await asyncio.sleep(0.01)
+    await asyncio.gather(task, request(second, "b"))
+    assert events == ["a start", "a end", "b start", "b end"]
+
+
+@pytest.mark.asyncio
+async def test_shared_user_lock_outlives_ttl_while_held():
+    first, second = worker_serializers()
+    events = []
+
+    async def request(serializer, name, duration):
+        async with serializer.lock(1):
+            events.append(f"{name} start")
+            await asyncio.sleep(duration)
+            events.append(f"{name} end")
+
+    # Запрос дольше TTL блокировки: ее продлевает heartbeat, второй воркер ждет
+    task = asyncio.create_task(request(first, "long", 1.5))
+    await asyncio.sleep(0.01)
+    await asyncio.gather(task, request(second, "next", 0))
+    assert events == ["long start", "long end", "next start", "next end"]
+
+
+@pytest.mark.asyncio
+async def test_shared_run_once_joins_duplicate_from_other_worker():
+    first, second = worker_serializers()
+    calls = 0
+
+    async def answer():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "ответ"
+
+    results = await asyncio.gather(first.run_once((1, "hi"), answer), second.run_once((1, "hi"), answer))
+    assert results == ["ответ", "ответ"]
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_shared_run_once_retries_after_owner_failure():
+    first, second = worker_serializers()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise RuntimeError("model failed")
+
+    async def answer():
+        return "ответ"
+
+    owner = asyncio.create_task(first.run_once((1, "hi"), fail))
+    await asyncio.sleep(0.01)
+    assert await second.run_once((1, "hi"), answer) == "ответ"
+    with pytest.raises(RuntimeError):
+        await owner
+
+
+@pytest.mark.asyncio
+async def test_shared_user_lock_degrades_without_redis():
+    serializer = UserSerializer(SharedUserLocks(BrokenRedis(), ttl=1.0))
+    async with serializer.lock(1):
+        pass
+    assert await serializer.run_once((1, "hi"), lambda: asyncio.sleep(0, "ответ")) == "ответ"
+
+
+def shared_state(monkeypatch):
+    for name, value in [("USER_LOCK_STORE", "redis"), ("JOB_STORE", "redis"),
+                        ("HISTORY_CACHE_BACKEND", "redis"), ("WRITE_BEHIND", False)]:
+        monkeypatch.setattr(config, name, value)
+
+
+def test_server_refuses_workers_without_shared_state(monkeypatch):
+    monkeypatch.setattr(config, "BACKEND_WORKERS", 2)
+    monkeypatch.setattr(config, "USER_LOCK_STORE", "memory")
+    with pytest.raises(SystemExit):
+        backend_server.main()
+
+    shared_state(monkeypatch)
+    assert backend_server.shared_state_problems() == []
+
+
+def test_worker_log_file_gets_pid_placeholder():
+    assert backend_server.worker_log_file("logs/app.log", 4) == "logs/app.{pid}.log"
+    assert backend_server.worker_log_file("logs/app", 4) == "logs/app.{pid}"
+    assert backend_server.worker_log_file("logs/app-{pid}.log", 4) == "logs/app-{pid}.log"
+    assert backend_server.worker_log_file("logs/app.log", 1) == "logs/app.log"
+    assert backend_server.worker_log_file(None, 4) is None
+    assert process_log_file("logs/app.{pid}.log") == f"logs/app.{os.getpid()}.log"
+    assert process_log_file("logs/app.log") == "logs/app.log"
+
+
+def test_server_gives_each_worker_its_own_log_file(monkeypatch):
+    shared_state(monkeypatch)
+    monkeypatch.setattr(config, "BACKEND_WORKERS", 2)
+    monkeypatch.setattr(config, "BACKEND_PORT", 0)
+    monkeypatch.setattr(config, "LOG_FILE", "logs/backend.log")
+    monkeypatch.setenv("LOG_FILE", "logs/backend.log")
+    monkeypatch.setenv("BACKEND_WORKERS", "2")
+    started = []
+
+    class FakeSupervisor:
+        def __init__(self, server_config, target, sockets):
+            started.append(server_config.workers)
+            for sock in sockets:
+                sock.close()
+
+        def run(self):
+            pass
+
+    monkeypatch.setattr(backend_server, "Multiprocess", FakeSupervisor)
+    monkeypatch.setattr(backend_server, "setup_logging", lambda level: None)
+    backend_server.main()
+    # Воркеры наследуют окружение и заменяют {pid} при настройке логов
+    assert started == [2]
+    assert os.environ["LOG_FILE"] == config.LOG_FILE == "logs/backend.{pid}.log"
+
+
+def slow_then_fast(delays):
+    """Запросы к модели с заданными задержками и счетчиком одновременных"""
+    state = {"calls": 0, "running": 0, "peak": 0}
+
+    async def call():
+        delay = delays[state["calls"]]
+        state["calls"] += 1
+        state["running"] += 1
+        state["peak"] = max(state["peak"], state["running"])
+        try:
+            await asyncio.sleep(delay)
+            return delay
+        finally:
+            state["running"] -= 1
+
+    return call, state
+
+
+@pytest.mark.asyncio
+async def test_hedge_takes_free_global_slot():
+    limiter = ConcurrencyLimiter(global_limit=2, per_user_limit=1, queue_timeout=1.0)
+    call, calls = slow_then_fast([1.0, 0.01])
+    async with limiter.slot(1):
+        assert await hedged(call, 0.05, limiter) == 0.01
+        assert limiter.in_flight == 1
+    assert calls["calls"] == 2
+    assert limiter.stats()["hedges"] == 1
+    assert limiter.in_flight == 0
+    assert not limiter._global.locked()
+
+
+@pytest.mark.asyncio
+async def test_hedge_skipped_without_free_global_slot():
+    limiter = ConcurrencyLimiter(global_limit=2, per_user_limit=1, queue_timeout=1.0)
+    call, calls = slow_then_fast([0.2, 0.2, 0.01, 0.01])
+
+    async def request(user_id):
+        async with limiter.slot(user_id):
+            return await hedged(call, 0.05, limiter)
+
+    # Оба глобальных слота заняты основными запросами: дубликаты не запускаются
+    assert await asyncio.gather(request(1), request(2)) == [0.2, 0.2]
+    assert calls["peak"] == limiter.global_limit
+    assert limiter.stats()["hedges"] == 0
+    assert limiter.stats()["hedges_skipped"] == 2
+
+
+def search_index(messages):
+    """Индекс с сообщениями пользователя 1 по порядку id"""
+    index = InvertedIndex()
+    for row_id, (question, answer) in enumerate(messages, 1):
+        index.add(1, {"id": row_id, "created_at": datetime(2024, 1, 1, 0, 0, row_id),
+                      "user_message": question, "ai_response": answer})
+    return index
+
+
+def test_search_cursor_round_trip():
+    key = (0.123456, datetime(2024, 1, 2, 3, 4, 5, 678901), 42)
+    assert decode_search_cursor(encode_search_cursor(*key)) == key
+    for cursor in ["not-a-cursor", encode_search_cursor(1.0, datetime(2024, 1, 1), 1)[:-3], ""]:
+        with pytest.raises(ValueError):
+            decode_search_cursor(cursor)
+
+
+def test_bm25_ranks_frequent_term_in_short_message_first():
+    index = search_index([
+        ("asyncio", "длинный ответ " + "про потоки и процессы " * 10),
+        ("asyncio asyncio", "коротко"),
+        ("asyncio", "коротко"),
+        ("threading", "без совпадений")
+    ])
+    results = index.search(1, "asyncio", 10)["results"]
+    assert [item["id"] for item in results] == [2, 3, 1]
+    assert results[0]["rank"] > results[1]["rank"] > results[2]["rank"]
+
+
+def test_search_requires_every_term_and_rare_terms_weigh_more():
+    index = search_index([
+        ("asyncio gather", "ответ"),
+        ("asyncio", "ответ"),
+        ("asyncio", "ответ"),
+        ("asyncio semaphore", "ответ")
+    ])
+    assert [item["id"] for item in index.search(1, "asyncio gather", 10)["results"]] == [1]
+    ranks = {item["id"]: item["rank"] for item in index.search(1, "asyncio", 10)["results"]}
+    # Редкое слово дает больший вклад, чем слово из каждого сообщения
+    assert index.search(1, "gather", 10)["results"][0]["rank"] > ranks[2]
+    assert index.search(2, "asyncio", 10) == {"results": [], "next_cursor": None}
+
+
+@pytest.mark.parametrize("total", [3, 4, 7])
+def test_search_pagination_boundary(total):
+    # Одинаковый ранг: порядок по времени, страницы без пропусков и повторов
+    index = search_index([("asyncio", "ответ")] * total)
+    page = index.search(1, "asyncio", 3)
+    ids = [item["id"] for item in page["results"]]
+    while page["next_cursor"]:
+        page = index.search(1, "asyncio", 3, page["next_cursor"])
+        assert page["results"]
+        ids.extend(item["id"] for item in page["results"])
+    assert ids == list(range(total, 0, -1))
+
+
+def fake_embedder(vectors):
+    """Эмбеддинги вопросов по таблице; неизвестный вопрос - вектор, далекий от всех"""
+    async def embed(text):
+        return vectors.get(text, [0.0, 0.0, 1.0])
+    return embed
+
+
+async def cached_answer(cache, message, model="main"):
+    return (await cache.lookup(message, model, "system")).response
+
+
+async def remember(cache, message, response, model="main"):
+    await cache.store(await cache.lookup(message, model, "system"), response, latency=1.0)
+
+
+@pytest.mark.asyncio
+async def test_response_cache_exact_hit_and_miss():
+    cache = ResponseCache(ttl=60, max_entries=10)
+    assert await cached_answer(cache, "Что такое GIL?") is None
+    await remember(cache, "Что такое GIL?", "Блокировка интерпретатора")
+
+    # Регистр, пробелы и знаки в конце не влияют на ключ
+    assert await cached_answer(cache, "  что такое   gil ") == "Блокировка интерпретатора"
+    assert await cached_answer(cache, "Что такое GIL в Ruby?") is None
+    assert await cached_answer(cache, "Что такое GIL?", model="fast") is None
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["misses"]) == (1, 4)
+    assert stats["latency_saved_seconds"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_response_cache_semantic_hit_above_threshold():
+    cache = ResponseCache(ttl=60, max_entries=10, similarity_threshold=0.9, embed=fake_embedder({
+        "Что такое GIL?": [1.0, 0.0, 0.0],
+        "Объясни GIL": [0.95, 0.1, 0.0],
+        "Что такое GC?": [0.6, 0.8, 0.0]
+    }))
+    await remember(cache, "Что такое GIL?", "Блокировка интерпретатора")
+
+    assert await cached_answer(cache, "Объясни GIL") == "Блокировка интерпретатора"
+    assert await cached_answer(cache, "Что такое GC?") is None
+    # Похожий вопрос к другой модели - промах
+    assert await cached_answer(cache, "Объясни GIL", model="fast") is None
+    assert cache.stats()["semantic_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_response_cache_expires_entries():
+    cache = ResponseCache(ttl=0.05, max_entries=10, embed=fake_embedder({"GIL?": [1.0, 0.0, 0.0]}))
+    await remember(cache, "GIL?", "ответ")
+    assert await cached_answer(cache, "GIL?") == "ответ"
+    await asyncio.sleep(0.06)
+    assert await cached_answer(cache, "GIL?") is None
+    assert cache.stats()["entries"] == 0
+    assert cache._rows == {}
+
+
+@pytest.mark.asyncio
+async def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(ttl=60, max_entries=2, embed=fake_embedder({
+        "a": [1.0, 0.0, 0.0], "b": [0.0, 1.0, 0.0], "c": [0.0, 0.0, 1.0]
+    }))
+    await remember(cache, "a", "A")
+    await remember(cache, "b", "B")
+    assert await cached_answer(cache, "a") == "A"
+    await remember(cache, "c", "C")
+
+    assert await cached_answer(cache, "b") is None
+    assert [await cached_answer(cache, key) for key in ("a", "c")] == ["A", "C"]
+    # Строка матрицы вытесненного вопроса освобождена и не находится семантически
+    assert len(cache._rows) == 2
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.histogram("stage_seconds", "Этапы", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, stage="llm")
+    rendered = registry.render().splitlines()
+
+    assert rendered[:2] == ["# HELP stage_seconds Этапы", "# TYPE stage_seconds histogram"]
+    assert rendered[2:] == [
+        'stage_seconds_bucket{stage="llm",le="0.1"} 1',
+        'stage_seconds_bucket{stage="llm",le="1"} 3',
+        'stage_seconds_bucket{stage="llm",le="+Inf"} 4',
+        'stage_seconds_sum{stage="llm"} 4.25',
+        'stage_seconds_count{stage="llm"} 4'
+    ]
+    with pytest.raises(ValueError):
+        histogram.observe(1.0)
+
+
+def test_partition_months():
+    assert add_months(date(2024, 11, 1), 2) == date(2025, 1, 1)
+    assert add_months(date(2024, 1, 1), -1) == date(2023, 12, 1)
+    assert partition_name(date(2024, 3, 1)) == "conversations_p202403"
+    assert parse_partition_month("conversations_p202403") == date(2024, 3, 1)
+    for name in ["conversations_default", "conversations_p2024", "other_p202403"]:
+        assert parse_partition_month(name) is None
+
+
+class FakeMaintenanceConnection:
+    """Соединение asyncpg для миграций и обслуживания партиций: записывает выполненный SQL"""
+
+    def __init__(self, versions=(), partitions=(), rows=()):
+        self.versions = set(versions)
+        self.partitions = list(partitions)
+        self.rows = list(rows)
+        self.executed = []
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield self
+
+    @asynccontextmanager
+    async def transaction(self, **kwargs):
+        yield
+
+    async def fetchval(self, query, *args):
+        if "schema_migrations" in query and "to_regclass" in query:
+            return bool(self.versions)
+        if "MAX(version)" in query:
+            return max(self.versions, default=0)
+        if "to_regclass" in query:
+            return args[0] in self.partitions
+        return True
+
+    async def fetch(self, query, *args):
+        if "FROM schema_migrations" in query:
+            return [{"version": version} for version in self.versions]
+        return [{"relname": name} for name in self.partitions]
+
+    async def execute(self, query, *args):
+        self.executed.append(" ".join(query.split()))
+        if query.startswith("INSERT INTO schema_migrations"):
+            self.versions.add(args[0])
+
+    async def cursor(self, query, prefetch):
+        for row in self.rows:
+            yield row
+
+
+@pytest.mark.asyncio
+async def test_migrate_applies_missing_versions_in_order(monkeypatch):
+    applied = []
+
+    def step(version):
+        async def apply(conn):
+            applied.append(version)
+        return Migration(version, f"step_{version}", apply)
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", [step(1), step(2), step(3)])
+    monkeypatch.setattr(migrations, "LATEST_VERSION", 3)
+    conn = FakeMaintenanceConnection(versions={1})
+
+    assert await migrate(conn) == [2, 3]
+    assert applied == [2, 3]
+    assert any("pg_advisory_xact_lock" in query for query in conn.executed)
+    # Актуальная схема: повторный запуск ничего не выполняет
+    conn.executed.clear()
+    assert await migrate(conn) == []
+    assert conn.executed == []
+
+
+@pytest.mark.asyncio
+async def test_retention_archives_and_drops_only_expired_partitions(monkeypatch, tmp_path):
+    today = utcnow().date()
+    expired = partition_name(add_months(date(today.year, today.month, 1), -3))
+    recent = partition_name(add_months(date(today.year, today.month, 1), -1))
+    monkeypatch.setattr(config, "CONVERSATION_RETENTION_DAYS", 40)
+    monkeypatch.setattr(config, "ARCHIVE_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "ARCHIVE_BATCH_SIZE", 2)
+    upcoming = [partition_name(add_months(date(today.year, today.month, 1), i))
+                for i in range(config.CONVERSATION_PARTITIONS_AHEAD + 1)]
+    rows = [{"id": i, "user_id": 1, "username": "u", "user_message": f"q{i}", "ai_response": "a",
+             "created_at": datetime(2024, 1, 1)} for i in range(3)]
+    conn = FakeMaintenanceConnection(partitions=[expired, recent, "conversations_default", *upcoming[1:]], rows=rows)
+    db = DatabaseManager()
+    db.pool = conn
+    manager = RetentionManager(db)
+
+    result = await manager.run_once()
+    # Текущий месяц создается, существующие партиции не пересоздаются
+    assert result == {"created": [upcoming[0]], "dropped": [expired]}
+    drops = [query for query in conn.executed if query.startswith("DROP TABLE")]
+    assert drops == [f"DROP TABLE {expired}"]
+    forget = next(i for i, query in enumerate(conn.executed) if "usage_forget_messages" in query)
+    assert forget < conn.executed.index(drops[0])
+
+    with gzip.open(tmp_path / f"{expired}.jsonl.gz", "rt", encoding="utf-8") as f:
+        archived = [json.loads(line) for line in f]
+    assert [row["user_message"] for row in archived] == ["q0", "q1", "q2"]
+    assert manager.stats["rows_archived"] == 3
+
+
+async def run_jobs(handler, submissions):
+    """Задачи ставятся в очередь до запуска воркеров и дорабатываются до конца"""
+    manager = JobManager(MemoryJobStore(ttl=60.0), handler, workers=1, max_queue=10)
+    jobs = [await manager.submit(1, message, priority=priority) for message, priority in submissions]
+    manager.start()
+    finished = [await manager.get(job.id, wait=1.0) for job in jobs]
+    await manager.stop(timeout=1.0)
+    return finished
+
+
+@pytest.mark.asyncio
+async def test_jobs_run_by_priority_then_in_submission_order():
+    order = []
+
+    async def handler(job):
+        order.append(job.message)
+        return job.message.upper()
+
+    finished = await run_jobs(handler, [("low", "low"), ("normal-1", "normal"), ("high-1", "high"),
+                                           ("normal-2", "normal"), ("high-2", "high")])
+
+    assert order == ["high-1", "high-2", "normal-1", "normal-2", "low"]
+    assert [job.response for job in finished] == ["LOW", "NORMAL-1", "HIGH-1", "NORMAL-2", "HIGH-2"]
+
+
+@pytest.mark.asyncio
+async def test_job_callback_is_signed_and_allowlisted(monkeypatch):
+    monkeypatch.setattr(config, "JOB_CALLBACK_ALLOWED_HOSTS", "hooks.example.com")
+    monkeypatch.setattr(config, "JOB_CALLBACK_SECRET", "secret")
+    received = []
+
+    def handle(request):
+        received.append(request)
+        return httpx.Response(200)
+
+    async def handler(job):
+        return "answer"
+
+    manager = JobManager(MemoryJobStore(ttl=60.0), handler, workers=1, max_queue=10)
+    manager._http = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    manager.start()
+    allowed = await manager.submit(1, "q", callback_url="https://hooks.example.com/done")
+    blocked = await manager.submit(1, "q", callback_url="http://169.254.169.254/latest")
+    for job in (allowed, blocked):
+        await manager.get(job.id, wait=1.0)
+    await manager.stop(timeout=1.0)
+
+    # Хост не из списка не получает запроса
+    assert [str(request.url) for request in received] == ["https://hooks.example.com/done"]
+    body = received[0].content
+    digest = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    assert received[0].headers[SIGNATURE_HEADER] == f"sha256={digest}"
+    assert json.loads(body)["response"] == "answer"
+
+
+class FakeClock:
+    """Подмена time.time в модуле лимитов"""
+
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_quota_window_slides_with_oldest_request(monkeypatch):
+    clock = FakeClock(1000.0)
+    monkeypatch.setattr(quotas.time, "time", clock)
+    manager = QuotaManager(MemoryQuotaStore(), requests=2, window=60.0, daily_tokens=0)
+
+    await manager.check(1)
+    clock.now += 10
+    await manager.check(1)
+    clock.now += 20
+    with pytest.raises(QuotaExceededError) as error:
+        await manager.check(1)
+    assert (error.value.reason, error.value.retry_after) == ("requests", 30.0)
+    await manager.check(2)
+
+    # Первый запрос вышел из окна, второй еще в нем
+    clock.now += 30.5
+    await manager.check(1)
+    with pytest.raises(QuotaExceededError):
+        await manager.check(1)
+    assert manager.stats()["rejected"] == {"requests": 2, "tokens": 0}
+
+
+@pytest.mark.asyncio
+async def test_daily_token_budget_resets_at_utc_midnight(monkeypatch):
+    clock = FakeClock(datetime(2024, 1, 1, 23, 59, 0, tzinfo=timezone.utc).timestamp())
+    monkeypatch.setattr(quotas.time, "time", clock)
+    store = MemoryQuotaStore()
+    manager = QuotaManager(store, requests=0, window=60.0, daily_tokens=100)
+
+    await manager.record_usage(1, {"prompt_tokens": 80, "completion_tokens": 20})
+    with pytest.raises(QuotaExceededError) as error:
+        await manager.check(1)
+    assert (error.value.reason, error.value.retry_after) == ("tokens", 60.0)
+
+    clock.now += 61
+    await manager.check(1)
+    await manager.record_usage(2, {"prompt_tokens": 5})
+    # Счетчики прошлого дня удаляются с первым расходом нового
+    assert list(store._tokens) == ["2024-01-02"]
+    assert await store.tokens(1, "2024-01-01") == 0
+    assert (await manager.status(2))["tokens"]["remaining"] == 95
+
+
+FAST = ModelTier(name="fast", model="fast-model", max_tokens=100, timeout=5.0, slo_p95=1.0)
+STANDARD = ModelTier(name="standard", model="main-model", max_tokens=500, timeout=30.0, slo_p95=5.0)
+
+
+def tier_router(min_samples=5, max_error_rate=0.2):
+    return ModelRouter([FAST, STANDARD], simple_max_chars=100, simple_max_history=2,
+                       window=60.0, min_samples=min_samples, max_error_rate=max_error_rate)
+
+
+def test_router_sends_simple_questions_to_fast_tier():
+    router = tier_router()
+    assert router.choose("short question", 0) == (FAST, "simple")
+    assert router.choose("x" * 101, 0) == (STANDARD, "complex")
+    assert router.choose("```code```", 0) == (STANDARD, "complex")
+    assert router.choose("short question", 3) == (STANDARD, "complex")
+
+
+@pytest.mark.parametrize("seconds, ok", [(2.0, True), (0.1, False)])
+def test_router_falls_back_while_fast_tier_breaks_slo(monkeypatch, seconds, ok):
+    clock = FakeClock(1000.0)
+    monkeypatch.setattr(routing.time, "monotonic", clock)
+    router = tier_router()
+
+    # p95 выше SLO или доля ошибок выше порога, но наблюдений меньше min_samples
+    for _ in range(4):
+        router.observe(FAST, seconds, ok)
+    assert router.choose("short question", 0) == (FAST, "simple")
+    router.observe(FAST, seconds, ok)
+    assert router.choose("short question", 0) == (STANDARD, "fallback")
+    assert router.stats()["tiers"]["fast"]["healthy"] is False
+
+    # Нарушения выходят из окна наблюдений
+    clock.now += 61
+    assert router.choose("short question", 0) == (FAST, "simple")
+
+
+def test_router_keeps_tier_when_every_tier_breaks_slo():
+    router = tier_router(min_samples=1)
+    router.observe(FAST, 2.0, True)
+    router.observe(STANDARD, 10.0, True)
+    assert router.choose("short question", 0) == (FAST, "simple")
+
+
+class ModelEchoProvider(MockProvider):
+    """Ответ называет модель, которой адресован запрос"""
+
+    def __init__(self):
+        super().__init__(latency=0.0)
+        self.models = []
+
+    async def complete(self, model, messages, **params):
+        self.models.append(model)
+        return Completion(text=f"answer from {model}", usage={"prompt_tokens": 10, "completion_tokens": 5})
+
+
+@pytest.mark.asyncio
+async def test_response_cache_is_scoped_by_tier_model(monkeypatch):
+    monkeypatch.setattr(config, "ROUTER_FAST_MODEL", "fast-model")
+    monkeypatch.setattr(config, "ROUTER_SLO_MIN_SAMPLES", 1)
+    monkeypatch.setattr(config, "RESPONSE_CACHE", True)
+    monkeypatch.setattr(config, "RESPONSE_CACHE_SEMANTIC", False)
+    provider = ModelEchoProvider()
+    agent = AIAgent(provider=provider)
+    fast = agent.router.tiers["fast"]
+
+    assert await agent.process_message("short question", 1) == "answer from fast-model"
+    assert await agent.process_message("short question", 1) == "answer from fast-model"
+    assert provider.models == ["fast-model"]
+
+    # Быстрый уровень вне SLO: запрос уходит основной модели, ответ быстрой из кеша не подходит
+    agent.router.observe(fast, 0.1, ok=False)
+    assert await agent.process_message("short question", 1) == f"answer from {config.OPENAI_MODEL}"
+    assert provider.models == ["fast-model", config.OPENAI_MODEL]
+    assert agent.router.routes == {"fast:simple": 1, "standard:fallback": 1}
+    await agent.aclose(timeout=1.0)
@@ -0,0 +1,452 @@
+import asyncio
+import itertools
+import random
+from typing import Dict, List, Optional
+
+import aiohttp
+import fakeredis.aioredis
+import httpx
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+
+from bot import delivery
+from bot.client import BackendClient
+from bot.middlewares import UserDebounceMiddleware
+from bot.delivery import FENCE, TokenBucket, split_message
+from benchmarks.fakes import FAKE_TELEGRAM_TOKEN, FakeTelegramSession, FakeUpdateSource, make_update
+from bot.storage import MemoryUpdateDeduplicator, MemoryUpdateQueue, RedisUpdateQueue
+from bot.webhook import STATS_KEY, UpdateWorkerPool, create_webhook_app, ordered_groups, update_chat_id
+from shared.config import config
+from shared.utils import trace_id_var
+
+
+def texts(groups: List[List[dict]]) -> List[List[str]]:
+    return [[update["message"]["text"] for update in group] for group in groups]
+
+
+def test_ordered_groups_merges_plain_messages_of_one_sender():
+    batch = [make_update(1, 7, "a"), make_update(2, 7, "b"), make_update(3, 7, "c")]
+    assert texts(ordered_groups(batch)) == [["a", "b", "c"]]
+
+
+def test_ordered_groups_never_merges_commands():
+    batch = [make_update(i, 7, text) for i, text in enumerate(["a", "b", "/help", "/start", "c", "d"])]
+    assert texts(ordered_groups(batch)) == [["a", "b"], ["/help"], ["/start"], ["c", "d"]]
+
+
+def test_ordered_groups_splits_senders():
+    batch = [make_update(1, 7, "a"), make_update(2, 8, "b"), make_update(3, 8, "c")]
+    batch[1]["message"]["chat"]["id"] = batch[2]["message"]["chat"]["id"] = 7
+    assert texts(ordered_groups(batch)) == [["a"], ["b", "c"]]
+
+
+def test_update_chat_id():
+    assert update_chat_id(make_update(1, 42, "hi")) == 42
+    callback = {"update_id": 2, "callback_query": {"id": "1", "from": {"id": 5}, "message": {"chat": {"id": 9}}}}
+    assert update_chat_id(callback) == 9
+    assert update_chat_id({"update_id": 3}) == 0
+
+
+@pytest.mark.asyncio
+async def test_deduplicator_drops_repeated_update_ids():
+    deduplicator = MemoryUpdateDeduplicator(ttl=60)
+    assert await deduplicator.first_seen(1)
+    assert not await deduplicator.first_seen(1)
+    assert await deduplicator.first_seen(2)
+
+
+class WebhookHarness:
+    """Webhook-сервер, очередь по чатам и пул воркеров с обработчиком, записывающим порядок"""
+
+    def __init__(self, workers: int, handler_delay: float = 0.0, queue=None):
+        self.handled: Dict[int, List[List[str]]] = {}
+        self.handler_delay = handler_delay
+        self.dp = Dispatcher()
+        self.dp.message.register(self._handle)
+        self.bot = Bot(token=FAKE_TELEGRAM_TOKEN, session=FakeTelegramSession())
+        self.queue = queue or MemoryUpdateQueue()
+        self.pool = UpdateWorkerPool(self.bot, self.dp, self.queue, workers)
+        self.app = create_webhook_app(MemoryUpdateDeduplicator(ttl=60), self.queue)
+        self.server = TestServer(self.app)
+        self.update_ids = itertools.count(1)
+
+    async def _handle(self, message: Message, merged_text: Optional[str] = None):
+        await asyncio.sleep(self.handler_delay)
+        parts = merged_text.split("\n\n") if merged_text else [message.text]
+        self.handled.setdefault(message.chat.id, []).append(parts)
+
+    def sequence(self, chat_id: int) -> List[str]:
+        return [text for group in self.handled.get(chat_id, []) for text in group]
+
+    async def wait_idle(self, expected: int, timeout: float = 5.0):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while sum(len(self.sequence(chat_id)) for chat_id in self.handled) < expected:
+            assert loop.time() < deadline, f"handled {self.handled}"
+            await asyncio.sleep(0.01)
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        self.pool.start()
+        self.session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        await self.pool.stop(timeout=1.0)
+        await self.server.close()
+
+    def source(self, duplicate_rate: float = 0.0) -> FakeUpdateSource:
+        return FakeUpdateSource(self.session, str(self.server.make_url(config.WEBHOOK_PATH)),
+                                secret=config.WEBHOOK_SECRET, duplicate_rate=duplicate_rate)
+
+    def update(self, chat_id: int, text: str) -> dict:
+        return make_update(next(self.update_ids), chat_id, text)
+
+
+@pytest.fixture(autouse=True)
+def no_debounce(monkeypatch):
+    monkeypatch.setattr(config, "BOT_DEBOUNCE_WINDOW", 0.0)
+
+
+@pytest.mark.asyncio
+async def test_webhook_drops_duplicate_deliveries():
+    async with WebhookHarness(workers=2) as harness:
+        source = harness.source(duplicate_rate=1.0)
+        for i in range(10):
+            await source.deliver(harness.update(1 + i % 2, f"/cmd{i}"))
+        await harness.wait_idle(10)
+        await asyncio.sleep(0.05)
+
+        assert source.delivered == 20
+        assert harness.app[STATS_KEY]["duplicates"] == 10
+        assert harness.pool.stats["processed"] == 10
+        assert harness.sequence(1) == [f"/cmd{i}" for i in range(0, 10, 2)]
+
+
+@pytest.mark.asyncio
+async def test_webhook_keeps_order_within_chat():
+    async with WebhookHarness(workers=4, handler_delay=0.005) as harness:
+        # POST-запросы идут параллельно: порядок чата - порядок, в котором webhook принял обновления
+        accepted: Dict[int, List[str]] = {}
+        put = harness.queue.put
+
+        async def recording_put(chat_id: int, update: dict):
+            accepted.setdefault(chat_id, []).append(update["message"]["text"])
+            await put(chat_id, update)
+
+        harness.queue.put = recording_put
+        source = harness.source()
+        updates = [
+            harness.update(1 + i % 3, f"/c{i}" if i % 7 == 0 else f"m{i}")
+            for i in range(60)
+        ]
+        await asyncio.gather(*(source.deliver(update) for update in updates))
+        await harness.wait_idle(60)
+
+        for chat_id, expected in accepted.items():
+            assert harness.sequence(chat_id) == expected
+        assert harness.pool.stats["processed"] == 60
+
+
+@pytest.mark.asyncio
+async def test_webhook_processes_sequential_deliveries_in_order():
+    async with WebhookHarness(workers=4, handler_delay=0.01) as harness:
+        source = harness.source()
+        expected = [f"/c{i}" if i % 4 == 0 else f"m{i}" for i in range(30)]
+        for text in expected:
+            await source.deliver(harness.update(1, text))
+        await harness.wait_idle(len(expected))
+        assert harness.sequence(1) == expected
+
+
+@pytest.mark.asyncio
+async def test_webhook_never_merges_commands_into_burst():
+    async with WebhookHarness(workers=1, handler_delay=0.05) as harness:
+        source = harness.source()
+        # Первое сообщение занимает чат, остальные копятся в очереди и уходят одной пачкой
+        await source.deliver(harness.update(1, "first"))
+        await asyncio.sleep(0.01)
+        for text in ["a", "b", "/help", "c", "d"]:
+            await source.deliver(harness.update(1, text))
+        await harness.wait_idle(6)
+
+        assert harness.handled[1] == [["first"], ["a", "b"], ["/help"], ["c", "d"]]
+        assert harness.pool.stats["merged"] == 2
+
+
+@pytest.mark.asyncio
+async def test_worker_requeues_updates_arriving_after_last_pop():
+    async with WebhookHarness(workers=1) as harness:
+        queue = harness.queue
+        unlock = queue.unlock
+        injected = False
+
+        async def unlock_with_late_update(chat_id: int, token: str):
+            nonlocal injected
+            if not injected:
+                injected = True
+                # Обновление пришло после последней выборки, а его сигнал забрал другой воркер
+                await queue.put(chat_id, harness.update(1, "late"))
+                queue._ready.get_nowait()
+            await unlock(chat_id, token)
+
+        queue.unlock = unlock_with_late_update
+        await harness.source().deliver(harness.update(1, "early"))
+        await harness.wait_idle(2)
+        assert harness.sequence(1) == ["early", "late"]
+
+
+@pytest.mark.asyncio
+async def test_webhook_rejects_malformed_body():
+    async with WebhookHarness(workers=1) as harness:
+        url = harness.server.make_url(config.WEBHOOK_PATH)
+        for body in [b"not json", b"[1, 2]", b'{"message": {}}', b'{"update_id": "1"}']:
+            async with harness.session.post(url, data=body, headers={"Content-Type": "application/json"}) as response:
+                assert response.status == 400
+        assert harness.app[STATS_KEY]["received"] == 0
+
+
+@pytest.fixture
+def short_lock(monkeypatch):
+    monkeypatch.setattr(config, "UPDATE_LOCK_TTL", 0.1)
+
+
+@pytest.mark.asyncio
+async def test_chat_lock_renewed_while_update_is_processed(short_lock):
+    queue = RedisUpdateQueue(fakeredis.aioredis.FakeRedis(), lock_ttl=0.1)
+    async with WebhookHarness(workers=1, handler_delay=0.5, queue=queue) as harness:
+        await harness.source().deliver(harness.update(1, "long answer"))
+        while not await queue.client.exists(queue._lock_key(1)):
+            await asyncio.sleep(0.01)
+        # Обработка дольше TTL блокировки: другой воркер не может забрать чат
+        await asyncio.sleep(0.3)
+        assert await queue.try_lock(1) is None
+        await harness.wait_idle(1)
+
+
+@pytest.mark.asyncio
+async def test_updates_survive_worker_crash(short_lock):
+    redis = fakeredis.aioredis.FakeRedis()
+    crashed = WebhookHarness(workers=1, handler_delay=10.0, queue=RedisUpdateQueue(redis, lock_ttl=0.1))
+    async with crashed:
+        await crashed.source().deliver(crashed.update(1, "first"))
+        await crashed.source().deliver(crashed.update(1, "/second"))
+        while not await redis.exists(crashed.queue._lock_key(1)):
+            await asyncio.sleep(0.01)
+        # Падение процесса: воркеры отменены посреди обработки, блокировка не снята
+        for task in crashed.pool._tasks:
+            task.cancel()
+        crashed.pool._recovery.cancel()
+        await asyncio.gather(*crashed.pool._tasks, return_exceptions=True)
+    assert [update["message"]["text"] for update in await crashed.queue.peek(1, 10)] == ["first", "/second"]
+    # Отметки готовности в очереди тоже могли потеряться: чат вернет только recover
+    await redis.delete(crashed.queue._ready_key)
+
+    async with WebhookHarness(workers=1, queue=RedisUpdateQueue(redis, lock_ttl=0.1)) as harness:
+        # Блокировка истекла, recover возвращает чат в очередь
+        await harness.wait_idle(2)
+        assert harness.sequence(1) == ["first", "/second"]
+        assert harness.pool.stats["recovered"] >= 1
+        assert await harness.queue.peek(1, 10) == []
+
+
+@pytest.mark.asyncio
+async def test_backend_client_reuses_pooled_connections():
+    seen_trace_ids = []
+
+    async def clear(request: web.Request) -> web.Response:
+        seen_trace_ids.append(request.headers.get("X-Request-ID"))
+        return web.json_response({"status": "cleared"})
+
+    app = web.Application()
+    app.router.add_delete("/api/v1/conversations/{user_id}", clear)
+    async with TestServer(app) as server:
+        client = BackendClient(str(server.make_url("")))
+        await client.start()
+        pool = client.client
+        await client.start()
+        assert client.client is pool
+
+        trace_id_var.set("trace-1")
+        for user_id in range(10):
+            assert (await client.clear_conversation(user_id)).status_code == 200
+        await asyncio.gather(*[client.clear_conversation(user_id) for user_id in range(5)])
+        metrics = client.metrics()
+        await client.close()
+
+    assert seen_trace_ids == ["trace-1"] * 15
+    assert metrics["requests_total"] == 15
+    # Последовательные запросы идут по одному соединению, параллельные открывают не больше своего числа
+    assert metrics["connections_opened"] <= 5
+    assert metrics["connection_reuse_ratio"] >= 0.6
+    assert metrics["latency"]["clear"]["count"] == 15
+    assert client.client is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("error, attempts", [(httpx.ConnectError, 3), (httpx.ReadTimeout, 1)])
+async def test_backend_client_retries_only_unsent_requests(monkeypatch, error, attempts):
+    monkeypatch.setattr(config, "BACKEND_RETRIES", 3)
+    monkeypatch.setattr(config, "BACKEND_RETRY_DELAY", 0.001)
+    requests = []
+
+    def handle(request):
+        requests.append(request)
+        raise error("backend is unavailable", request=request)
+
+    client = BackendClient("http://backend")
+    await client.start(transport=httpx.MockTransport(handle))
+    # Запрос с истекшим ожиданием ответа мог дойти до backend: повтор создал бы второй ход
+    with pytest.raises(error):
+        await client.chat({"user_id": 1, "message": "hi"})
+    await client.close()
+
+    assert len(requests) == attempts
+    assert client.errors_total == attempts
+
+
+def debounce_harness(window: float, max_wait: float):
+    """Middleware склейки и обработчик, записывающий полученные серии"""
+    middleware = UserDebounceMiddleware(window, max_wait)
+    batches = []
+    started = asyncio.get_running_loop().time()
+
+    async def handler(event, data):
+        batches.append((data.get("merged_text", event.text), asyncio.get_running_loop().time() - started))
+
+    update_ids = itertools.count(1)
+
+    def send(user_id: int, text: str):
+        message = Message.model_validate(make_update(next(update_ids), user_id, text)["message"])
+        return asyncio.create_task(middleware(handler, message, {}))
+
+    return middleware, batches, send
+
+
+@pytest.mark.asyncio
+async def test_debounce_merges_messages_within_window():
+    middleware, batches, send = debounce_harness(window=0.1, max_wait=1.0)
+    tasks = []
+    for text in ["первая", "вторая", "третья"]:
+        tasks.append(send(1, text))
+        await asyncio.sleep(0.02)
+    tasks.append(send(2, "другой пользователь"))
+    tasks.append(send(1, "/help"))
+    await asyncio.gather(*tasks)
+
+    texts = [text for text, _ in batches]
+    # Команда не ждет серию, сообщения разных пользователей не склеиваются
+    assert texts[0] == "/help"
+    assert sorted(texts[1:]) == sorted(["первая\n\nвторая\n\nтретья", "другой пользователь"])
+    assert middleware.merged == 2
+
+
+@pytest.mark.asyncio
+async def test_debounce_flushes_at_max_wait():
+    middleware, batches, send = debounce_harness(window=0.1, max_wait=0.25)
+    tasks = []
+    for index in range(10):
+        tasks.append(send(1, str(index)))
+        await asyncio.sleep(0.05)
+    await asyncio.gather(*tasks)
+
+    # Непрерывный поток сообщений не откладывает ответ дольше max_wait
+    _, first_at = batches[0]
+    assert first_at < 0.25 + 0.05
+    assert len(batches) >= 2
+    assert "\n\n".join(text for text, _ in batches) == "\n\n".join(str(index) for index in range(10))
+
+
+def test_split_message_reopens_code_fence():
+    code = "\n".join(f"print({i})  # строка {i}" for i in range(200))
+    text = f"Пример:\n\n```python\n{code}\n```\n\nГотово."
+    chunks = split_message(text, 500)
+
+    fenced = [chunk for chunk in chunks if FENCE in chunk]
+    assert len(fenced) > 1
+    body = []
+    for chunk in fenced:
+        block = chunk[chunk.index("```python"):chunk.rindex("\n```") + len("\n```")]
+        # Каждый кусок кода закрыт и открыт заново с тем же языком
+        assert block.startswith("```python\n") and block.endswith("\n```")
+        body.extend(block[len("```python\n"):-len("\n```")].split("\n"))
+    assert body == code.split("\n")
+    assert chunks[0].startswith("Пример:") and chunks[-1].endswith("Готово.")
+
+
+@pytest.mark.parametrize("limit", [20, 64, 200, 4096])
+def test_split_message_chunks_within_limit(limit):
+    rng = random.Random(limit)
+    parts = []
+    for i in range(60):
+        kind = rng.random()
+        if kind < 0.2:
+            parts.append("```" + "x" * rng.randint(0, 40) + "\n" + "\n".join(
+                "y" * rng.randint(0, 120) for _ in range(rng.randint(1, 20))) + "\n```")
+        elif kind < 0.3:
+            parts.append("z" * rng.randint(limit, limit * 3))
+        else:
+            parts.append(" ".join("w" * rng.randint(1, 15) for _ in range(rng.randint(1, 80))))
+    text = "\n\n".join(parts)
+
+    chunks = split_message(text, limit)
+    assert chunks
+    assert all(0 < len(chunk) <= limit for chunk in chunks)
+    # Текст не теряется: без пробельных символов и ограждений кода совпадает с исходным
+    def letters(value: str) -> str:
+        return "".join(value.replace(FENCE, "").split())
+    assert letters("".join(chunks)).replace("x", "") == letters(text).replace("x", "")
+
+
+def test_split_fence_with_long_header_stays_within_limit():
+    block = "```" + "a" * 30 + "\n" + "code\n" * 10 + "```"
+    chunks = split_message(block, 32)
+    assert all(len(chunk) <= 32 for chunk in chunks)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(delivery.time, "monotonic", fake)
+    return fake
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2.0, burst=3)
+    # Запас burst уходит без ожидания, дальше - по одному токену в 1/rate секунд
+    assert [bucket.reserve() for _ in range(5)] == pytest.approx([0.0, 0.0, 0.0, 0.5, 1.0])
+    assert not bucket.idle()
+
+    clock.now += 10
+    assert bucket.idle()
+    assert bucket.reserve() == 0.0
+
+
+def test_token_bucket_serves_waiters_in_order(clock):
+    bucket = TokenBucket(rate=1.0, burst=1)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits == pytest.approx([0.0, 1.0, 2.0, 3.0])
+    clock.now += 1.5
+    assert bucket.reserve() == pytest.approx(2.5)
+
+
+def test_token_bucket_block_pauses_without_burst(clock):
+    bucket = TokenBucket(rate=1.0, burst=5)
+    bucket.block(3.0)
+    assert bucket.blocked()
+    # После паузы RetryAfter запас burst не используется: отправки идут с интервалом 1/rate
+    assert [bucket.reserve() for _ in range(3)] == pytest.approx([3.0, 4.0, 5.0])
+    clock.now += 3.0
+    assert not bucket.blocked()
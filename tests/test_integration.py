@@ -0,0 +1,312 @@
+import itertools
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+import pytest_asyncio
+from aiogram import Bot
+
+import backend.utils as backend_utils
+from backend.ai_agent import AIAgent
+from backend.chat import run_chat_turn
+from backend.concurrency import UserSerializer
+from backend.database import DatabaseManager, PendingTurn, utcnow
+from backend.jobs import JobManager, MemoryJobStore
+from backend.main import app
+from backend.quotas import MemoryQuotaStore, QuotaManager
+from benchmarks.fakes import FAKE_TELEGRAM_TOKEN, FakeTelegramSession, InMemoryDatabaseManager, make_update
+from bot.client import backend_client
+from shared.config import config
+
+
+@pytest.fixture
+def mock_llm(monkeypatch):
+    monkeypatch.setattr(config, "LLM_PROVIDER", "mock")
+    monkeypatch.setattr(config, "MOCK_LLM_LATENCY", 0.0)
+    monkeypatch.setattr(config, "MOCK_LLM_TOKENS_PER_SECOND", 0.0)
+
+
+@pytest_asyncio.fixture
+async def backend(monkeypatch, mock_llm):
+    """Backend в процессе, как после lifespan, с хранилищами в памяти"""
+    db = InMemoryDatabaseManager(latency=0.0)
+    agent = AIAgent(summary_store=db)
+    serializer = UserSerializer()
+    quotas = QuotaManager(MemoryQuotaStore(), requests=0, window=60.0, daily_tokens=0)
+    agent.on_usage = quotas.record_usage
+    jobs = JobManager(
+        store=MemoryJobStore(config.JOB_RESULT_TTL),
+        handler=lambda job: run_chat_turn(agent, db, serializer, job.user_id, job.message, job.username),
+        workers=2,
+        max_queue=10
+    )
+    for name, value in [("db_manager", db), ("ai_agent", agent), ("user_serializer", serializer),
+                        ("quota_manager", quotas), ("job_manager", jobs)]:
+        monkeypatch.setattr(backend_utils, name, value)
+    jobs.start()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://backend") as client:
+        yield client
+    await jobs.stop(timeout=1.0)
+    await agent.aclose(timeout=1.0)
+
+
+@pytest_asyncio.fixture
+async def telegram(backend, monkeypatch):
+    """Обработчики bot/handlers.py поверх backend в процессе; sent - ответы бота"""
+    from bot.handlers import dp
+
+    # Серии сообщений склеиваются отдельно (test_bot.py), здесь каждое сообщение - запрос
+    debounce, = dp.message.middleware
+    monkeypatch.setattr(debounce, "window", 0.0)
+    session = FakeTelegramSession()
+    bot = Bot(token=FAKE_TELEGRAM_TOKEN, session=session)
+    update_ids = itertools.count(1)
+    await backend_client.start(transport=httpx.ASGITransport(app=app))
+
+    async def send(user_id: int, text: str):
+        await dp.feed_raw_update(bot, make_update(next(update_ids), user_id, text))
+        return session.sent[-1]
+
+    send.session = session
+    yield send
+    await backend_client.close()
+
+
+def sse_events(body: str):
+    """События SSE из тела ответа: (event, data)"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines.get("event", "message"), json.loads(lines["data"])))
+    return events
+
+
+def metric_value(text: str, sample: str) -> float:
+    """Значение строки метрики из ответа /metrics (0, если ее еще нет)"""
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+async def save_turns(user_id: int, turns):
+    for question, answer in turns:
+        await backend_utils.db_manager.save_message(user_id, question, answer)
+
+
+@pytest.mark.asyncio
+async def test_search_endpoint_pages_by_relevance(backend):
+    await save_turns(1, [(f"вопрос {i} про asyncio", "ответ " + "asyncio " * i) for i in range(1, 6)])
+    await save_turns(2, [("asyncio у другого пользователя", "ответ")])
+
+    seen, cursor = [], None
+    while True:
+        response = await backend.get("/api/v1/conversations/1/search",
+                                     params={"q": "asyncio", "limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        page = response.json()
+        seen.extend(page["results"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert [item["user_message"] for item in seen] == [f"вопрос {i} про asyncio" for i in range(5, 0, -1)]
+    assert "«asyncio»" in seen[0]["snippet"]
+
+
+@pytest.mark.asyncio
+async def test_search_endpoint_rejects_bad_parameters(backend):
+    url = "/api/v1/conversations/1/search"
+    assert (await backend.get(url, params={"q": "asyncio", "cursor": "not-a-cursor"})).status_code == 400
+    assert (await backend.get(url, params={"q": ""})).status_code == 422
+    assert (await backend.get(url, params={"q": "x" * (config.SEARCH_QUERY_MAX_LENGTH + 1)})).status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_bot_search_command(telegram):
+    await save_turns(7, [("Как отменить задачу asyncio?", "Вызовите task.cancel()"), ("Что такое GIL?", "Блокировка")])
+
+    answer = await telegram(7, "/search cancel")
+    assert answer.startswith("🔎 Найдено по запросу «cancel»")
+    assert "«cancel»" in answer
+    assert "GIL" not in answer
+
+    assert await telegram(7, "/search kubernetes") == "Ничего не найдено."
+    assert await telegram(7, "/search") == "Укажите, что искать: /search <запрос>"
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_sends_deltas_then_full_answer(backend):
+    response = await backend.post("/api/v1/chat/stream", json={"user_id": 3, "message": "Что такое asyncio?"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = sse_events(response.text)
+    deltas = [data["delta"] for event, data in events if event == "message"]
+    assert len(deltas) == backend_utils.ai_agent.provider.response_tokens
+    assert events[-1] == ("done", {"response": "".join(deltas).strip()})
+    # Потоковый ответ сохраняется в историю так же, как обычный
+    history = await backend_utils.db_manager.get_conversation_history(3)
+    assert [(item["user_message"], item["ai_response"]) for item in history] == [
+        ("Что такое asyncio?", events[-1][1]["response"])
+    ]
+
+
+@pytest.mark.asyncio
+async def test_bot_streams_answer_into_one_edited_message(telegram, monkeypatch):
+    # ASGITransport отдает тело целиком: проверяется сборка ответа из событий и правка сообщения
+    monkeypatch.setattr(config, "BOT_STREAMING", True)
+    await telegram(4, "/start")
+
+    answer = await telegram(4, "Объясни декораторы")
+    calls = telegram.session.calls
+    assert calls["SendMessage"] == 2  # приветствие /start и первый фрагмент ответа
+    assert calls["EditMessageText"] >= 1
+    history = await backend_utils.db_manager.get_conversation_history(4)
+    assert answer == history[-1]["ai_response"]
+
+
+@pytest.mark.asyncio
+async def test_chat_records_stage_metrics_and_echoes_trace_id(backend):
+    samples = [f'chat_stage_seconds_count{{stage="{name}"}}' for name in ("history_fetch", "prompt_build", "llm", "db_save")]
+    samples.append('chat_requests_total{endpoint="chat",status="ok"}')
+    before = (await backend.get("/metrics")).text
+
+    response = await backend.post("/api/v1/chat", json={"user_id": 5, "message": "Что такое корутина?"},
+                                  headers={"X-Request-ID": "bot-trace-1"})
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"] == "bot-trace-1"
+
+    metrics = await backend.get("/metrics")
+    assert metrics.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert [metric_value(metrics.text, sample) - metric_value(before, sample) for sample in samples] == [1] * 5
+
+    # Без заголовка backend создает свой идентификатор
+    generated = (await backend.get("/metrics")).headers["X-Request-ID"]
+    assert len(generated) == 16 and generated != "bot-trace-1"
+
+
+class KeysetPool:
+    """Таблица conversations для запросов страниц истории и выгрузки курсором"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield self
+
+    @asynccontextmanager
+    async def transaction(self, **kwargs):
+        yield
+
+    def _user_rows(self, user_id):
+        return sorted((row for row in self.rows if row["user_id"] == user_id),
+                      key=lambda row: (row["created_at"], row["id"]))
+
+    async def fetch(self, query, user_id, limit, *before):
+        rows = [row for row in reversed(self._user_rows(user_id))
+                if not before or (row["created_at"], row["id"]) < tuple(before)]
+        return rows[:limit]
+
+    async def cursor(self, query, user_id, prefetch):
+        for row in self._user_rows(user_id):
+            yield row
+
+
+@pytest.fixture
+def keyset_db(backend, monkeypatch):
+    """DatabaseManager с 7 записанными ходами (два с одинаковым временем) и одним незаписанным"""
+    start = datetime(2024, 5, 1, 12, 0)
+    times = [start + timedelta(minutes=i) for i in (0, 1, 2, 2, 3, 4, 5)]
+    rows = [{"id": i + 1, "user_id": 1, "username": "u", "user_message": f"q{i}", "ai_response": f"a{i}",
+             "created_at": created_at} for i, created_at in enumerate(times)]
+    rows.append({**rows[0], "id": 100, "user_id": 2})
+    db = DatabaseManager()
+    db.pool = KeysetPool(rows)
+    db._pending[1] = [PendingTurn(1, "u", "pending", "a", utcnow())]
+    monkeypatch.setattr(backend_utils, "db_manager", db)
+    return db
+
+
+@pytest.mark.asyncio
+async def test_history_pages_walk_back_without_gaps(backend, keyset_db):
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+        response = await backend.get("/api/v1/conversations/1/history", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        pages.append([item["user_message"] for item in page["history"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    # Новые страницы первыми, внутри страницы - по времени; одинаковое время различает id
+    assert pages == [["q5", "q6", "pending"], ["q2", "q3", "q4"], ["q0", "q1"]]
+
+
+@pytest.mark.asyncio
+async def test_history_fields_and_bad_parameters(backend, keyset_db):
+    url = "/api/v1/conversations/1/history"
+    page = (await backend.get(url, params={"limit": 2, "fields": "id,user_message"})).json()
+    assert page["history"] == [{"id": 7, "user_message": "q6"}, {"id": None, "user_message": "pending"}]
+
+    assert (await backend.get(url, params={"fields": "password"})).status_code == 400
+    assert (await backend.get(url, params={"cursor": "garbage"})).status_code == 400
+    assert (await backend.get(url, params={"limit": config.HISTORY_PAGE_MAX + 1})).status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_export_streams_ndjson_in_order(backend, keyset_db):
+    response = await backend.get("/api/v1/conversations/1/export", params={"fields": "user_message,created_at"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert 'filename="conversation_1.ndjson"' in response.headers["content-disposition"]
+
+    items = [json.loads(line) for line in response.text.splitlines()]
+    assert [item["user_message"] for item in items] == [f"q{i}" for i in range(7)] + ["pending"]
+    assert set(items[0]) == {"user_message", "created_at"}
+    assert (await backend.get("/api/v1/conversations/1/export", params={"fields": "x"})).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_job_long_poll_returns_finished_answer(backend):
+    response = await backend.post("/api/v1/jobs", json={"user_id": 1, "message": "hello", "priority": "high"})
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+
+    response = await backend.get(f"/api/v1/jobs/{job_id}", params={"wait": 5})
+    assert response.json()["status"] == "done"
+    assert response.json()["response"]
+    assert (await backend.get("/api/v1/jobs/missing")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_job_rejects_callback_off_the_allowlist_and_full_queue(backend, monkeypatch):
+    monkeypatch.setattr(config, "JOB_CALLBACK_ALLOWED_HOSTS", "hooks.example.com")
+    response = await backend.post("/api/v1/jobs", json={"user_id": 1, "message": "hello",
+                                                        "callback_url": "http://127.0.0.1:8000/admin"})
+    assert response.status_code == 422
+
+    monkeypatch.setattr(backend_utils.job_manager, "max_queue", 0)
+    response = await backend.post("/api/v1/jobs", json={"user_id": 1, "message": "hello"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+
+
+@pytest.mark.asyncio
+async def test_chat_over_request_quota_gets_429_with_retry_after(backend, monkeypatch):
+    monkeypatch.setattr(backend_utils.quota_manager, "requests", 2)
+    for _ in range(2):
+        assert (await backend.post("/api/v1/chat", json={"user_id": 1, "message": "hi"})).status_code == 200
+
+    response = await backend.post("/api/v1/chat", json={"user_id": 1, "message": "hi"})
+    assert response.status_code == 429
+    assert response.json()["reason"] == "requests"
+    assert 1 <= int(response.headers["Retry-After"]) <= 60
+    assert response.json()["retry_after"] == int(response.headers["Retry-After"])
+    # Лимит у каждого пользователя свой
+    assert (await backend.post("/api/v1/chat", json={"user_id": 2, "message": "hi"})).status_code == 200